@@ -0,0 +1,59 @@
+"""
+Compares signature verification cost of supported sensor key types.
+
+Usage: python benchmarks/signatures.py [iterations]
+"""
+import base64
+import sys
+import timeit
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, padding, rsa
+
+from rain_server.authenticate import check_signature
+
+MESSAGE = "2022-01-01 00:00:002022-01-01 00:00:0021.5sensor_1"
+
+
+def encode_public_key(private_key) -> str:
+    """Base64 DER encoding of the public key, as stored in o_sensors.pubkey"""
+    return base64.b64encode(
+        private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
+        ),
+    ).decode("utf-8")
+
+
+def schemes() -> dict[str, tuple[str, str]]:
+    """(public key, signature) of MESSAGE for each scheme"""
+    message = MESSAGE.encode("utf-8")
+    rsa_2048 = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    rsa_4096 = rsa.generate_private_key(public_exponent=65537, key_size=4096)
+    pss = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH)
+    ed = ed25519.Ed25519PrivateKey.generate()
+    p256 = ec.generate_private_key(ec.SECP256R1())
+
+    return {
+        "rsa-2048-pss": (encode_public_key(rsa_2048),
+                         rsa_2048.sign(message, pss, hashes.SHA256())),
+        "rsa-4096-pss": (encode_public_key(rsa_4096),
+                         rsa_4096.sign(message, pss, hashes.SHA256())),
+        "ed25519": (encode_public_key(ed), ed.sign(message)),
+        "ecdsa-p256": (encode_public_key(p256), p256.sign(message, ec.ECDSA(hashes.SHA256()))),
+    }
+
+
+def main(iterations: int = 2000):
+    """Prints verifications per second of each scheme"""
+    print(f"{'scheme':<15}{'us/verify':>12}{'verify/s':>12}")
+    for name, (pubkey, signature) in schemes().items():
+        encoded = base64.b64encode(signature).decode("utf-8")
+        assert check_signature(MESSAGE, pubkey, encoded)
+        seconds = timeit.timeit(lambda: check_signature(MESSAGE, pubkey, encoded),
+                                number=iterations)
+        print(f"{name:<15}{seconds / iterations * 1e6:>12.1f}{iterations / seconds:>12.0f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,53 @@
+"""
+Compares the cost of resolving query windows with and without the expression cache.
+
+Usage: python benchmarks/time_window.py [iterations]
+"""
+import datetime
+import sys
+import timeit
+
+from rain_server.schema.time_window import parse_expression, resolve_window
+
+WINDOWS = {
+    "absolute": ("2022-01-01T00:00:00", "2022-01-02T00:00:00+02:00"),
+    "relative": ("-15m", "NOW"),
+    "today": ("TODAY", "TODAY"),
+    "last": ("NOW", "NOW"),
+}
+GRANULARITY = datetime.timedelta(minutes=1)
+
+
+def uncached(start_time: str, end_time: str, now: datetime.datetime):
+    """Parses both dates on every call, as done before the expression cache"""
+    parse = parse_expression.__wrapped__
+    return parse(start_time).resolve(now), parse(end_time).resolve(now, is_end=True)
+
+
+def main(iterations: int = 100000):
+    """Prints microseconds per window of each expression type"""
+    now = datetime.datetime.utcnow()
+    print(f"{'window':<12}{'us/uncached':>14}{'us/cached':>12}{'us/aligned':>12}")
+    for name, (start_time, end_time) in WINDOWS.items():
+        timings = [
+            timeit.timeit(function, number=iterations) / iterations * 1e6
+            for function in [
+                lambda: uncached(start_time, end_time, now),
+                lambda: resolve_window(start_time, end_time, now),
+                lambda: resolve_window(start_time, end_time, now, granularity=GRANULARITY),
+            ]
+        ]
+        print(f"{name:<12}{timings[0]:>14.2f}{timings[1]:>12.2f}{timings[2]:>12.2f}")
+
+    # Relative windows resolved within the same minute share a cache key.
+    minute = now.replace(second=0, microsecond=0)
+    keys = {
+        resolve_window("-15m", "NOW", minute + datetime.timedelta(seconds=s),
+                       granularity=GRANULARITY)
+        for s in range(60)
+    }
+    print(f"distinct windows over a minute of '-15m'..'NOW' queries: {len(keys)}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -1,5 +1,34 @@
-from .main import main
+"""
+Rain API Server
+
+Heavy dependencies (strawberry, SQLAlchemy, cryptography) are only imported when the
+related part of the public API is first used.
+"""
+import importlib
+
 from .version import __schema_version__, __version__
 
+__all__ = ["__schema_version__", "__version__", "create_app", "get_database", "main"]
+
+_LAZY_ATTRIBUTES = {
+    "create_app": ".server",
+    "get_database": ".configuration",
+    "main": ".main",
+}
+
+
+def __getattr__(name: str):
+    """Imports the module defining a public attribute on first access."""
+    try:
+        module_name = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
 if __name__ == '__main__':  # pragma: no cover
+    from .main import main
     main()
@@ -0,0 +1,4 @@
+"""Aggregates of measurements"""
+__all__ = ["QuantileSketch"]
+
+from .sketch import QuantileSketch
@@ -0,0 +1,169 @@
+"""Mergeable quantile sketch"""
+import json
+import math
+import typing
+
+# Values closer to zero are counted as zero.
+MIN_VALUE = 1e-9
+
+
+class QuantileSketch:
+    """
+    Summary of a distribution answering quantiles with a bounded relative error.
+
+    Values are counted in logarithmic bins (DDSketch): the quantiles returned are within
+    relative_accuracy of an actual value at that rank. Sketches with the same accuracy merge
+    exactly, so sketches of time buckets and sensors can be combined in any order. The
+    number of bins grows with the logarithm of the range of values, not with their count.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        """
+        Setups an empty sketch.
+
+        :param relative_accuracy: Relative error of quantiles, between 0 and 1 excluded
+        """
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"Invalid relative accuracy: {relative_accuracy!r}")
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.positive: dict[int, int] = {}
+        self.negative: dict[int, int] = {}
+        self.zero = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, value: float) -> int:
+        """Bin of a positive value"""
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, index: int) -> float:
+        """Value representing a bin, within the relative accuracy of all its values"""
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def add(self, value: float, count: int = 1) -> "QuantileSketch":
+        """
+        Counts a value.
+
+        :param value: Value
+        :param count: Number of occurrences
+        :return: The sketch
+        """
+        if value > MIN_VALUE:
+            index = self._index(value)
+            self.positive[index] = self.positive.get(index, 0) + count
+        elif value < -MIN_VALUE:
+            index = self._index(-value)
+            self.negative[index] = self.negative.get(index, 0) + count
+        else:
+            self.zero += count
+        self.count += count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        return self
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        """
+        Adds the values counted by another sketch.
+
+        Merging is exact for sketches with the same relative accuracy. Otherwise, the bins of
+        the other sketch are added as values, adding its error to the one of this sketch.
+
+        :param other: Sketch
+        :return: The sketch
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            for value, count in other._bins():
+                self.add(value, count)
+            if other.count:
+                self.min = min(self.min, other.min)
+                self.max = max(self.max, other.max)
+            return self
+        for index, count in other.positive.items():
+            self.positive[index] = self.positive.get(index, 0) + count
+        for index, count in other.negative.items():
+            self.negative[index] = self.negative.get(index, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def _bins(self) -> typing.Iterator[tuple[float, int]]:
+        """Bin values and counts, in increasing order of values"""
+        for index in sorted(self.negative, reverse=True):
+            yield -self._value(index), self.negative[index]
+        if self.zero:
+            yield 0.0, self.zero
+        for index in sorted(self.positive):
+            yield self._value(index), self.positive[index]
+
+    def quantiles(self, quantiles: typing.Iterable[float]) -> list[float | None]:
+        """
+        Estimates quantiles.
+
+        :param quantiles: Quantiles between 0 and 1
+        :return: Estimated values, None for an empty sketch
+        """
+        quantiles = list(quantiles)
+        for quantile in quantiles:
+            if not 0 <= quantile <= 1:
+                raise ValueError(f"Invalid quantile: {quantile!r}")
+        if not self.count:
+            return [None] * len(quantiles)
+
+        results: dict[float, float] = {}
+        pending = sorted(set(quantiles))
+        seen = 0
+        for value, count in self._bins():
+            seen += count
+            while pending and pending[0] * (self.count - 1) < seen:
+                results[pending.pop(0)] = min(max(value, self.min), self.max)
+        for quantile in pending:
+            results[quantile] = self.max
+        # The extremes are known exactly.
+        if 0 in results:
+            results[0] = self.min
+        if 1 in results:
+            results[1] = self.max
+        return [results[quantile] for quantile in quantiles]
+
+    def quantile(self, quantile: float) -> float | None:
+        """
+        Estimates a quantile.
+
+        :param quantile: Quantile between 0 and 1
+        :return: Estimated value, None for an empty sketch
+        """
+        return self.quantiles([quantile])[0]
+
+    def to_json(self) -> str:
+        """Serializes the sketch."""
+        return json.dumps({
+            "a": self.relative_accuracy,
+            "p": sorted(self.positive.items()),
+            "n": sorted(self.negative.items()),
+            "z": self.zero,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, value: str) -> "QuantileSketch":
+        """
+        Deserializes a sketch.
+
+        :param value: Sketch serialized by to_json
+        """
+        data = json.loads(value)
+        sketch = cls(data["a"])
+        sketch.positive = {index: count for index, count in data["p"]}
+        sketch.negative = {index: count for index, count in data["n"]}
+        sketch.zero = data["z"]
+        sketch.count = sketch.zero + sum(sketch.positive.values()) + sum(sketch.negative.values())
+        if sketch.count:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        return sketch
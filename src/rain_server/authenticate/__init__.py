@@ -1,4 +1,6 @@
 """All authentication methods"""
-__all__ = ["check_signature"]
+__all__ = ["Session", "SessionStore", "check_hmac", "check_signature", "get_key_type",
+           "get_session_store"]
 
-from .check_signature import check_signature
+from .check_signature import check_signature, get_key_type
+from .session import Session, SessionStore, check_hmac, get_session_store
@@ -1,19 +1,60 @@
 """All methods that check message signatures."""
 import base64
+import binascii
+import functools
 
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, padding, rsa
 from cryptography.hazmat.primitives.serialization import load_der_public_key
 
 from rain_server.configuration.logger import get_logger
 
+from ..monitoring.instruments import SIGNATURE_CHECKS
+
+SUPPORTED_CURVES = (ec.SECP256R1,)
+
+
+@functools.lru_cache(maxsize=4096)
+def load_public_key(pubkey: str):
+    """
+    Loads a base64 encoded DER public key.
+
+    Keys are cached, so each sensor key is only parsed once.
+
+    :param pubkey: The public key
+    :return: The key object
+    """
+    return load_der_public_key(base64.b64decode(pubkey), default_backend())
+
+
+def get_key_type(pubkey: str) -> str:
+    """
+    Detects the type of a public key.
+
+    :param pubkey: The public key
+    :return: "rsa", "ed25519", "ecdsa-<curve>" or "unsupported"
+    """
+    key = load_public_key(pubkey)
+    if isinstance(key, rsa.RSAPublicKey):
+        return "rsa"
+    if isinstance(key, ed25519.Ed25519PublicKey):
+        return "ed25519"
+    if isinstance(key, ec.EllipticCurvePublicKey):
+        return f"ecdsa-{key.curve.name}"
+    return "unsupported"
+
 
 def check_signature(message: str, pubkey: str, signature: str) -> bool:
     """
     Checks if the message signature is valid.
 
+    Supported keys are:
+    - RSA, signed with RSA-PSS and SHA-256
+    - Ed25519
+    - ECDSA on P-256, signed with SHA-256
+
     :param message: The message to check signature
     :param pubkey: The public key
     :param signature: The signature to check
@@ -21,20 +62,38 @@ def check_signature(message: str, pubkey: str, signature: str) -> bool:
     """
     message_bytes = message.encode('utf-8')
 
-    pubkey_key = load_der_public_key(base64.b64decode(pubkey), default_backend())
-    signature_bytes = base64.b64decode(signature)
+    pubkey_key = load_public_key(pubkey)
+    try:
+        signature_bytes = base64.b64decode(signature, validate=True)
+    except binascii.Error as err:
+        get_logger().error(f"Invalid signature encoding: {err}")
+        SIGNATURE_CHECKS.inc(result="invalid")
+        return False
+
     try:
-        pubkey_key.verify(
-            signature_bytes,
-            message_bytes,
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()),
-                salt_length=padding.PSS.MAX_LENGTH,
-            ),
-            hashes.SHA256(),
-        )
+        if isinstance(pubkey_key, rsa.RSAPublicKey):
+            pubkey_key.verify(
+                signature_bytes,
+                message_bytes,
+                padding.PSS(
+                    mgf=padding.MGF1(hashes.SHA256()),
+                    salt_length=padding.PSS.MAX_LENGTH,
+                ),
+                hashes.SHA256(),
+            )
+        elif isinstance(pubkey_key, ed25519.Ed25519PublicKey):
+            pubkey_key.verify(signature_bytes, message_bytes)
+        elif isinstance(pubkey_key, ec.EllipticCurvePublicKey) \
+                and isinstance(pubkey_key.curve, SUPPORTED_CURVES):
+            pubkey_key.verify(signature_bytes, message_bytes, ec.ECDSA(hashes.SHA256()))
+        else:
+            get_logger().error(f"Unsupported public key type: {type(pubkey_key).__name__}")
+            SIGNATURE_CHECKS.inc(result="unsupported")
+            return False
     except InvalidSignature as err:
         get_logger().error(err)
+        SIGNATURE_CHECKS.inc(result="invalid")
         return False
     else:
+        SIGNATURE_CHECKS.inc(result="valid")
         return True
@@ -0,0 +1,167 @@
+"""Symmetric sessions opened after a public key signature."""
+import base64
+import binascii
+import collections
+import dataclasses
+import datetime
+import hashlib
+import hmac
+import secrets
+import threading
+
+from ..configuration import get_server_config
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+@dataclasses.dataclass(frozen=True)
+class Session:
+    """Sensor session"""
+
+    token: str
+    sensor_id: str
+    key: bytes
+    expires: datetime.datetime
+
+
+class SessionStore:
+    """
+    Issues and validates sensor sessions.
+
+    Tokens are authenticated with the store secret and session keys are derived from the
+    token, so every process sharing the secret can validate a session. Validated sessions
+    are kept in a bounded LRU cache.
+    """
+
+    def __init__(
+            self,
+            secret: bytes,
+            *,
+            ttl: datetime.timedelta = datetime.timedelta(hours=1),
+            max_size: int = 10000,
+    ):
+        """
+        Setups the store.
+
+        :param secret: Secret used to sign tokens and derive session keys
+        :param ttl: Session lifetime
+        :param max_size: Maximum number of cached sessions
+        """
+        self._secret = secret
+        self.ttl = ttl
+        self.max_size = max_size
+        self._sessions: collections.OrderedDict[str, Session] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _mac(self, payload: str) -> str:
+        """Authenticates a token payload."""
+        digest = hmac.new(self._secret, b"token:" + payload.encode("utf-8"), hashlib.sha256)
+        return base64.urlsafe_b64encode(digest.digest()).decode("ascii").rstrip("=")
+
+    def _derive_key(self, token: str) -> bytes:
+        """Session key of a token."""
+        return hmac.new(self._secret, b"key:" + token.encode("utf-8"), hashlib.sha256).digest()
+
+    def _cache(self, session: Session):
+        """Adds a session to the cache, evicting the least recently used ones."""
+        with self._lock:
+            self._sessions[session.token] = session
+            self._sessions.move_to_end(session.token)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+
+    def open(self, sensor_id: str, now: datetime.datetime | None = None) -> Session:
+        """
+        Opens a new session.
+
+        :param sensor_id: Authenticated sensor
+        :param now: Current UTC time
+        """
+        now = now or datetime.datetime.utcnow()
+        expires = int((now + self.ttl - EPOCH).total_seconds())
+        payload = f"{sensor_id}.{expires}.{secrets.token_urlsafe(12)}"
+        token = f"{payload}.{self._mac(payload)}"
+        session = Session(
+            token=token,
+            sensor_id=sensor_id,
+            key=self._derive_key(token),
+            expires=EPOCH + datetime.timedelta(seconds=expires),
+        )
+        self._cache(session)
+        return session
+
+    def get(self, token: str, now: datetime.datetime | None = None) -> Session | None:
+        """
+        Validates a session token.
+
+        :param token: Session token
+        :param now: Current UTC time
+        :return: The session, None if the token is invalid or expired
+        """
+        now = now or datetime.datetime.utcnow()
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is not None:
+                self._sessions.move_to_end(token)
+
+        if session is None:
+            # Token format is "<sensor_id>.<expires>.<nonce>.<mac>", sensor_id may contain dots.
+            payload, _, mac = token.rpartition(".")
+            if not hmac.compare_digest(self._mac(payload).encode("ascii"), mac.encode("utf-8")):
+                return None
+            sensor_id, _, expires = payload.rpartition(".")[0].rpartition(".")
+            session = Session(
+                token=token,
+                sensor_id=sensor_id,
+                key=self._derive_key(token),
+                expires=EPOCH + datetime.timedelta(seconds=int(expires)),
+            )
+            self._cache(session)
+
+        if session.expires <= now:
+            with self._lock:
+                self._sessions.pop(token, None)
+            return None
+        return session
+
+
+def check_hmac(message: str, key: bytes, signature: str) -> bool:
+    """
+    Checks a HMAC-SHA256 message signature in constant time.
+
+    :param message: The signed message
+    :param key: The session key
+    :param signature: Base64 encoded HMAC of the message
+    :return: True if the signature is valid
+    """
+    try:
+        signature_bytes = base64.b64decode(signature, validate=True)
+    except binascii.Error:
+        return False
+    expected = hmac.new(key, message.encode("utf-8"), hashlib.sha256).digest()
+    return hmac.compare_digest(expected, signature_bytes)
+
+
+_store: SessionStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """
+    Returns the process session store, creating it on first call.
+
+    Without a configured session_secret, a random secret is generated: the store must
+    then be created before forking workers so they all share it.
+    """
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            cfg = get_server_config()
+            secret = cfg.get("session_secret")
+            _store = SessionStore(
+                base64.b64decode(secret) if secret else secrets.token_bytes(32),
+                ttl=datetime.timedelta(seconds=cfg.get_int("session_ttl")),
+                max_size=cfg.get_int("session_store_size"),
+            )
+        return _store
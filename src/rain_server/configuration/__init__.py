@@ -1,4 +1,5 @@
-__all__ = ["get_database", "get_logger"]
+__all__ = ["get_database", "get_logger", "get_server_config", "reset_database"]
 
-from .db_engine import get_database
+from .db_engine import get_database, reset_database
 from .logger import get_logger
+from .server import get_server_config
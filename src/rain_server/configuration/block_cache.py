@@ -0,0 +1,341 @@
+"""Cache of measurements of closed time blocks"""
+import collections
+import contextlib
+import datetime
+import itertools
+import threading
+import typing
+
+import sqlalchemy.engine
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from .db_engine import DataBase
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class MeasurementRow(typing.NamedTuple):
+    """Measurement of a series"""
+
+    series_id: int
+    measurement_datetime: datetime.datetime
+    measurement_value: float
+
+
+class BlockCache:
+    """
+    Caches measurements per series and aligned time block.
+
+    Only closed blocks, ended for more than grace seconds, are cached: recent blocks are
+    always read from the database. The grace period covers writes that started before the
+    end of a block and commit after it. Blocks to cache are read on the primary database,
+    a lagging replica could miss such writes. Writes landing in a closed block record a marker in
+    s_block_invalidations, every process reads new markers before using its cache and drops
+    the matching blocks. Markers older than marker_ttl seconds may be purged, a process that
+    did not read markers for that long drops its whole cache.
+
+    The cache holds at most max_rows measurements, least recently used blocks are evicted.
+    """
+
+    def __init__(
+            self,
+            database: "DataBase",
+            *,
+            block: datetime.timedelta = datetime.timedelta(hours=1),
+            max_rows: int = 1000000,
+            marker_ttl: datetime.timedelta = datetime.timedelta(hours=1),
+            grace: datetime.timedelta = datetime.timedelta(minutes=1),
+    ):
+        """
+        Setups an empty cache.
+
+        :param database: Database holding the measurements
+        :param block: Size of the time blocks
+        :param max_rows: Maximum number of cached measurements
+        :param marker_ttl: Age after which invalidation markers may be purged
+        :param grace: Delay after the end of a block before it is cached
+        """
+        self.database = database
+        self.block = block
+        self.max_rows = max_rows
+        self.marker_ttl = marker_ttl
+        self.grace = grace
+
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._blocks: collections.OrderedDict[
+            tuple[int, datetime.datetime],
+            tuple[tuple[datetime.datetime, float], ...],
+        ] = collections.OrderedDict()
+        self._rows = 0
+        # Incremented by invalidations, blocks read before one are not cached.
+        self._generation = 0
+        self._applied: dict[int, datetime.datetime] = {}
+        self._polled_at: datetime.datetime | None = None
+
+    def align(self, value: datetime.datetime) -> datetime.datetime:
+        """Start of the block holding a date."""
+        return EPOCH + ((value - EPOCH) // self.block) * self.block
+
+    def __len__(self) -> int:
+        """Number of cached measurements."""
+        return self._rows
+
+    def clear(self):
+        """Drops all cached blocks."""
+        with self._lock:
+            self._blocks.clear()
+            self._rows = 0
+            self._generation += 1
+
+    def _store(self, key: tuple[int, datetime.datetime], values: tuple, generation: int):
+        """Caches a block read at a generation, evicting the least recently used ones."""
+        with self._lock:
+            if generation != self._generation:
+                return
+            previous = self._blocks.pop(key, None)
+            if previous is not None:
+                self._rows -= len(previous)
+            self._blocks[key] = values
+            self._rows += len(values)
+            while self._rows > self.max_rows and self._blocks:
+                _, evicted = self._blocks.popitem(last=False)
+                self._rows -= len(evicted)
+
+    def _invalidate(self, series_id: int | None, start: datetime.datetime,
+                    end: datetime.datetime):
+        """Drops cached blocks of a series, or of all series if None, overlapping [start, end)"""
+        with self._lock:
+            self._generation += 1
+            if series_id is None:
+                keys = [
+                    key for key in self._blocks
+                    if start < key[1] + self.block and key[1] < end
+                ]
+            else:
+                keys = []
+                block_start = self.align(start)
+                while block_start < end:
+                    keys.append((series_id, block_start))
+                    block_start += self.block
+            for key in keys:
+                self._rows -= len(self._blocks.pop(key, ()))
+
+    def invalidation_markers(
+            self,
+            rows: typing.Iterable[dict],
+            now: datetime.datetime,
+    ) -> list[dict]:
+        """
+        Builds the markers of measurement rows written to closed blocks.
+
+        :param rows: Inserted d_measurements rows
+        :param now: Current UTC time
+        :return: s_block_invalidations rows
+        """
+        open_block = self.align(now)
+        blocks = {
+            (row["series_id"], self.align(row["measurement_datetime"]))
+            for row in rows
+            if row["measurement_datetime"] < open_block
+        }
+        return [
+            {
+                "series_id": series_id,
+                "block_start": block_start,
+                "block_end": block_start + self.block,
+                "d_created_date_utc": now,
+            }
+            for series_id, block_start in blocks
+        ]
+
+    def poll(self, conn: sqlalchemy.engine.Connection, now: datetime.datetime):
+        """
+        Applies invalidation markers written since the last poll.
+
+        Markers are read by creation date rather than by id: ids are not allocated in commit
+        order, so markers created up to grace seconds before the last poll are read again.
+        They are read on the primary database, a lagging replica could show a marker after
+        that window.
+
+        :param conn: Database connection, markers are read on it if it is on the primary
+        :param now: Current UTC time
+        """
+        with self._poll_lock:
+            if self._polled_at is None or now - self._polled_at > self.marker_ttl:
+                self.clear()
+                self._applied.clear()
+                self._polled_at = now
+                return
+
+            since = self._polled_at - self.grace
+            with self._primary(conn) as primary:
+                rows = self._read_markers(primary, since)
+            for row in rows:
+                if row.marker_id not in self._applied:
+                    self._invalidate(row.series_id, row.block_start, row.block_end)
+                    self._applied[row.marker_id] = row.d_created_date_utc
+            self._applied = {
+                marker_id: created
+                for marker_id, created in self._applied.items()
+                if created >= since
+            }
+            self._polled_at = now
+
+    @contextlib.contextmanager
+    def _primary(
+            self,
+            conn: sqlalchemy.engine.Connection,
+    ) -> typing.Iterator[sqlalchemy.engine.Connection]:
+        """Yields conn if it is on the primary database, else a connection to the primary."""
+        if conn.engine is self.database.engine:
+            yield conn
+        else:
+            with self.database.engine.connect() as primary:
+                yield primary
+
+    def _read_markers(self, conn: sqlalchemy.engine.Connection,
+                      since: datetime.datetime) -> list:
+        """Reads invalidation markers created since a date."""
+        markers = self.database.block_invalidations
+        return conn.execute(
+            sqlalchemy.select(
+                markers.c.marker_id,
+                markers.c.series_id,
+                markers.c.block_start,
+                markers.c.block_end,
+                markers.c.d_created_date_utc,
+            ).where(
+                markers.c.d_created_date_utc >= since,
+            ),
+        ).all()
+
+    def _fetch(self, conn: sqlalchemy.engine.Connection, series_ids: typing.Collection[int],
+               start: datetime.datetime, end: datetime.datetime) -> dict:
+        """
+        Reads and caches the closed blocks of series in [start, end)
+
+        :param conn: Database connection, blocks are read on it if it is on the primary
+        :return: Measurements by series and block
+        """
+        generation = self._generation
+        measurements = self.database.measurements
+
+        def read(shard_conn: sqlalchemy.engine.Connection, shard_series_ids: list[int]):
+            return shard_conn.execute(
+                sqlalchemy.select(
+                    measurements.c.series_id,
+                    measurements.c.measurement_datetime,
+                    measurements.c.measurement_value,
+                ).where(
+                    measurements.c.series_id.in_(shard_series_ids),
+                    measurements.c.measurement_datetime >= start,
+                    measurements.c.measurement_datetime < end,
+                ).order_by(measurements.c.measurement_datetime),
+            ).all()
+
+        with self._primary(conn) as primary:
+            shard_rows = self.database.scatter_measurements(primary, series_ids, read)
+        values: dict[tuple[int, datetime.datetime], list] = {}
+        for row in itertools.chain(*shard_rows):
+            values.setdefault((row.series_id, self.align(row.measurement_datetime)), []).append(
+                (row.measurement_datetime, row.measurement_value),
+            )
+
+        blocks = {}
+        block_start = start
+        while block_start < end:
+            for series_id in series_ids:
+                key = (series_id, block_start)
+                blocks[key] = tuple(values.get(key, ()))
+                self._store(key, blocks[key], generation)
+            block_start += self.block
+        return blocks
+
+    def _cached(self, key: tuple[int, datetime.datetime]) -> tuple | None:
+        """Returns a cached block, marking it as recently used."""
+        with self._lock:
+            values = self._blocks.get(key)
+            if values is not None:
+                self._blocks.move_to_end(key)
+            return values
+
+    def measurements(
+            self,
+            conn: sqlalchemy.engine.Connection,
+            series_ids: typing.Collection[int],
+            start: datetime.datetime,
+            end: datetime.datetime,
+            now: datetime.datetime,
+    ) -> list[MeasurementRow]:
+        """
+        Reads measurements of series, closed blocks from the cache.
+
+        :param conn: Database connection
+        :param series_ids: Series ids
+        :param start: Measurements from this date (included)
+        :param end: Measurements until this date (included)
+        :param now: Current UTC time
+        :return: Measurements sorted by date
+        """
+        if not series_ids:
+            return []
+        self.poll(conn, now)
+
+        first_block = self.align(start)
+        closed_end = min(self.align(now - self.grace), self.align(end) + self.block)
+        blocks = []
+        block_start = first_block
+        while block_start < closed_end:
+            blocks.append(block_start)
+            block_start += self.block
+
+        cached = {}
+        missing = set()
+        for series_id in series_ids:
+            for block_start in blocks:
+                values = self._cached((series_id, block_start))
+                if values is None:
+                    missing.add((series_id, block_start))
+                else:
+                    cached[(series_id, block_start)] = values
+        if missing:
+            cached.update(self._fetch(
+                conn,
+                sorted({series_id for series_id, _ in missing}),
+                min(block_start for _, block_start in missing),
+                max(block_start for _, block_start in missing) + self.block,
+            ))
+
+        rows = [
+            MeasurementRow(series_id, date, value)
+            for (series_id, _), values in cached.items()
+            for date, value in values
+            if start <= date <= end
+        ]
+
+        if end >= closed_end:
+            measurements = self.database.measurements
+
+            def read(shard_conn: sqlalchemy.engine.Connection, shard_series_ids: list[int]):
+                return shard_conn.execute(
+                    sqlalchemy.select(
+                        measurements.c.series_id,
+                        measurements.c.measurement_datetime,
+                        measurements.c.measurement_value,
+                    ).where(
+                        measurements.c.series_id.in_(shard_series_ids),
+                        measurements.c.measurement_datetime >= max(start, closed_end),
+                        measurements.c.measurement_datetime <= end,
+                    ),
+                ).all()
+
+            rows.extend(
+                MeasurementRow(*row)
+                for row in itertools.chain(
+                    *self.database.scatter_measurements(conn, series_ids, read),
+                )
+            )
+
+        rows.sort(key=lambda row: row.measurement_datetime)
+        return rows
@@ -0,0 +1,59 @@
+"""Time bucket expressions per dialect"""
+import datetime
+
+import sqlalchemy
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# Buckets date_trunc aligns as date_bin from the epoch does. Not weeks, date_trunc starts
+# them on a Monday and the epoch is a Thursday.
+DATE_TRUNC_UNITS = {
+    datetime.timedelta(minutes=1): "minute",
+    datetime.timedelta(hours=1): "hour",
+    datetime.timedelta(days=1): "day",
+}
+
+
+def align(value: datetime.datetime, bucket: datetime.timedelta) -> datetime.datetime:
+    """Start of the bucket of a date, buckets are aligned on the epoch."""
+    return EPOCH + ((value - EPOCH) // bucket) * bucket
+
+
+def bucket_start(
+        column: sqlalchemy.sql.ColumnElement,
+        bucket: datetime.timedelta,
+        dialect: str,
+) -> sqlalchemy.sql.ColumnElement:
+    """
+    Expression of the start of the bucket of a date column, as align() computes it.
+
+    - PostgreSQL: date_trunc for a minute, an hour or a day, else date_bin (PostgreSQL 14).
+    - SQLite: integer arithmetic on the epoch seconds of the date.
+
+    :param column: Date column
+    :param bucket: Bucket size, a whole number of seconds
+    :param dialect: Name of the dialect executing the statement
+    :return: Date expression
+    """
+    if bucket <= datetime.timedelta(0) or bucket % datetime.timedelta(seconds=1):
+        raise ValueError(f"Invalid bucket: {bucket}")
+
+    if dialect == "postgresql":
+        if bucket in DATE_TRUNC_UNITS:
+            return sqlalchemy.func.date_trunc(
+                DATE_TRUNC_UNITS[bucket], column, type_=sqlalchemy.DateTime,
+            )
+        return sqlalchemy.func.date_bin(
+            sqlalchemy.literal(bucket, sqlalchemy.Interval),
+            column,
+            sqlalchemy.literal(EPOCH, sqlalchemy.DateTime),
+            type_=sqlalchemy.DateTime,
+        )
+
+    if dialect == "sqlite":
+        seconds = int(bucket.total_seconds())
+        epoch = sqlalchemy.cast(sqlalchemy.func.strftime("%s", column), sqlalchemy.Integer)
+        # Floors dates before the epoch too, % truncates towards zero.
+        start = epoch - (epoch % seconds + seconds) % seconds
+        return sqlalchemy.func.datetime(start, "unixepoch", type_=sqlalchemy.DateTime)
+
+    raise ValueError(f"Time buckets are not supported on {dialect}.")
@@ -1,20 +1,86 @@
 """Create DB engine from configuration"""
+import contextlib
+import datetime
 import os.path
+import threading
+import typing
 
 import config
 import sqlalchemy.dialects.sqlite
 import sqlalchemy.engine
+import sqlalchemy.exc
 import sqlalchemy.orm
 
+from ..monitoring import SlowQueryLogger, instrument_engine
+from ..version import __schema_version__
+from .block_cache import BlockCache
+from .buckets import bucket_start
+from .logger import get_logger
+from .metadata_index import MetadataIndex
 from .paths import CONFIG_PATH
+from .replicas import ReplicaSet
+from .series import SeriesCache
+from .shards import ShardSet
+from .sketches import SketchStore
+from .snapshot import ConfigSnapshot, ConfigSource, changed_keys
+from .sqlite import (get_sqlite_engine_options, install_sqlite_pragmas,
+                     is_file_database)
 
+T = typing.TypeVar("T")
 
-def get_db_config() -> config.ConfigurationSet:
+# Settings applied by DataBase.apply_config without restart.
+RELOADABLE_KEYS = {
+    "log_queries",
+    "replica_max_lag",
+    "replica_check_interval",
+    "replica_retry_interval",
+    "metadata_refresh_interval",
+    "metadata_rebuild_interval",
+    "block_cache_max_rows",
+}
+# Settings of the connection pools, only applied when the engines are created.
+POOL_KEYS = {"pool_size", "max_overflow", "pool_timeout", "pool_recycle"}
+DB_DEFAULTS = {
+    "dialect": "sqlite",
+    "log_queries": False,
+    "query_cache_size": 1200,
+    "path": ":memory:",
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 268435456,
+    "cache_size": -65536,
+    "busy_timeout": 5000,
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30,
+    "pool_recycle": -1,
+    "retention_interval": 3600,
+    "metadata_refresh_interval": 5,
+    "metadata_rebuild_interval": 3600,
+    "block_cache_block_minutes": 60,
+    "block_cache_max_rows": 1000000,
+    "block_cache_marker_ttl": 3600,
+    "sketch_bucket_minutes": 60,
+    "sketch_relative_accuracy": 0.01,
+    "retention_chunk_minutes": 60,
+    "slow_query_explain": True,
+    "slow_query_explain_analyze": False,
+    "slow_query_log_interval": 60,
+    "slow_query_max_per_interval": 10,
+    "replica_check_interval": 5,
+    "replica_retry_interval": 30,
+    "shard_virtual_nodes": 64,
+    "shard_threads": 8,
+}
+
+
+def get_db_config() -> ConfigSnapshot:
     """
     Reads DB configuration from configuration.
 
     Environment variable must start with RAIN_DB_ and be upper case.
     Configuration file is stored in the default configuration path and name db.json.
+    Values are loaded once and reloaded when the file changes, see ConfigSource.
 
     Valid parameters are:
     - dialect: "sqlite"|"postgresql" or any dialect supported by sqlalchemy
@@ -25,39 +91,101 @@ def get_db_config() -> config.ConfigurationSet:
     - host: DB Host if any.
     - port: DB port if not default.
     - schema: DB schema/logical DB.
+    - path: SQLite database file. Default is ":memory:".
+    - journal_mode: SQLite journal mode. Default is "WAL".
+    - synchronous: SQLite synchronous setting. Default is "NORMAL".
+    - mmap_size: SQLite memory mapped I/O size in bytes. Default is 268435456 (256MiB).
+    - cache_size: SQLite page cache size, in pages or in KiB when negative.
+    Default is -65536 (64MiB).
+    - busy_timeout: Time in milliseconds SQLite waits for a lock. Default is 5000.
+    - pool_size: Connections kept open by the pool of each engine. Default is 5.
+    - max_overflow: Connections opened above pool_size under load. Default is 10.
+    - pool_timeout: Time in seconds waiting for a connection of a full pool. Default is 30.
+    - pool_recycle: Age in seconds after which connections are replaced, -1 to never replace
+    them. Default is -1.
+    Changes to pool_size, max_overflow, pool_timeout and pool_recycle need a restart, a
+    reload only logs a warning.
+    - retention_interval: Delay in seconds between two runs of the retention job.
+    Default is 3600.
+    - retention_chunk_minutes: Time range of measurements deleted or downsampled in a single
+    transaction by the retention job. Default is 60.
+    - metadata_refresh_interval: Delay in seconds between two incremental refreshes of the
+    location, sensor and measurement type index. Default is 5.
+    - metadata_rebuild_interval: Delay in seconds between two full rebuilds of the index,
+    dropping deleted rows. Default is 3600.
+    - block_cache_block_minutes: Size in minutes of the time blocks of historical measurements
+    cached by each process. Default is 60.
+    - block_cache_max_rows: Maximum number of measurements held by the block cache.
+    Default is 1000000.
+    - block_cache_marker_ttl: Delay in seconds after which invalidation markers of late writes
+    are purged by the retention job. Default is 3600.
+    - sketch_bucket_minutes: Time range in minutes summarized by each quantile sketch.
+    Default is 60.
+    - sketch_relative_accuracy: Relative error of the percentiles computed from quantile
+    sketches. Default is 0.01.
     - log_queries: True/False Display queries in logs? Default is False.
+    - query_cache_size: Number of compiled statements cached by each engine. Default is 1200.
+    - slow_query_threshold: Duration in seconds above which statements are logged with their
+    execution plan. Default is None (disabled).
+    - slow_query_explain: True/False Capture EXPLAIN plan of slow queries? Default is True.
+    - slow_query_explain_analyze: True/False Use EXPLAIN ANALYZE for slow SELECT statements?
+    Default is False.
+    - slow_query_log_interval: Minimum delay in seconds between two logs of the same statement.
+    Default is 60.
+    - slow_query_max_per_interval: Maximum number of slow queries logged per interval.
+    Default is 10.
+    - read_urls: List (or comma separated string) of SQLAlchemy URLs of read replicas.
+    Queries are load balanced across them, mutations always use the primary.
+    Default is no replica.
+    - replica_max_lag: Replication lag in seconds above which a replica is not used.
+    Default is None (never checked).
+    - replica_check_interval: Delay in seconds between two lag checks. Default is 5.
+    - replica_retry_interval: Delay in seconds before using a failing replica again.
+    Default is 30.
+    - shard_urls: List (or comma separated string) of SQLAlchemy URLs of measurement shards.
+    d_measurements is stored in the shards, sensors are assigned to them by consistent hashing
+    of sensor_id. Other tables stay in the database above. Default is no shard.
+    - shard_names: Names of the shards on the hash ring, in the order of shard_urls. Sensors
+    only keep their shard while its name is unchanged. Default is the shard index.
+    - shard_virtual_nodes: Number of points of each shard on the hash ring. Default is 64.
+    - shard_threads: Number of threads querying shards concurrently. Default is 8.
+
+    Changes to log_queries, replica lag checks, the metadata index intervals and
+    block_cache_max_rows apply without restart, other changes need a restart.
 
     Priority is:
     1. Environment variables
     2. Configuration file
     3. Default configuration
 
-    :return: ConfigurationSet
+    :return: Current configuration snapshot
     """
-    default = {
-        "dialect": "sqlite",
-        "log_queries": False,
-    }
+    return get_db_config_source().snapshot()
+
+
+_db_config_source: ConfigSource | None = None
+_db_config_source_lock = threading.Lock()
 
-    try:
-        with open(os.path.join(CONFIG_PATH, "db.json"), "r") as fp:
-            json_file = fp.read()
-    except FileNotFoundError:
-        # Ignores the configuration if the file do not exist.
-        json_file = "{}"
-
-    return config.ConfigurationSet(
-        config.config_from_env(prefix="RAIN_DB"),
-        config.config_from_json(json_file, read_from_file=False),
-        config.config_from_dict(default),
-    )
+
+def get_db_config_source() -> ConfigSource:
+    """Returns the process DB configuration source."""
+    global _db_config_source
+
+    with _db_config_source_lock:
+        if _db_config_source is None:
+            _db_config_source = ConfigSource(
+                os.path.join(CONFIG_PATH, "db.json"),
+                "RAIN_DB",
+                DB_DEFAULTS,
+            )
+        return _db_config_source
 
 
 def get_db_url(cfg: config.ConfigurationSet) -> sqlalchemy.engine.URL:
     """Creates the database URL from configuration"""
     if cfg.dialect == "sqlite":
         return sqlalchemy.engine.URL(
-            cfg.dialect, database=":memory:",
+            cfg.dialect, database=cfg.get("path"),
         )
 
     return sqlalchemy.engine.URL(
@@ -70,35 +198,190 @@ def get_db_url(cfg: config.ConfigurationSet) -> sqlalchemy.engine.URL:
     )
 
 
-def get_engine() -> sqlalchemy.engine.Engine:
-    """Returns the DB Engine"""
-    cfg = get_db_config()
-    url = get_db_url(cfg)
+def _read_list(cfg: config.ConfigurationSet, key: str) -> list[str]:
+    """Reads a list, or a comma separated string, from configuration"""
+    values: typing.Any = cfg.get(key) or []
+    if isinstance(values, str):
+        values = [value.strip() for value in values.split(",") if value.strip()]
+    return list(values)
+
 
-    return sqlalchemy.create_engine(
+def get_read_urls(cfg: config.ConfigurationSet) -> list[sqlalchemy.engine.URL]:
+    """Reads replicas URLs from configuration"""
+    return [sqlalchemy.engine.make_url(url) for url in _read_list(cfg, "read_urls")]
+
+
+def get_shard_urls(cfg: config.ConfigurationSet) -> list[sqlalchemy.engine.URL]:
+    """Reads measurement shards URLs from configuration"""
+    return [sqlalchemy.engine.make_url(url) for url in _read_list(cfg, "shard_urls")]
+
+
+def create_engine(
+        cfg: config.ConfigurationSet,
+        url: sqlalchemy.engine.URL,
+        name: str = "primary",
+) -> sqlalchemy.engine.Engine:
+    """
+    Creates an instrumented engine.
+
+    :param cfg: Database configuration
+    :param url: Database URL
+    :param name: Engine name used in metrics
+    """
+    engine = sqlalchemy.create_engine(
         url=url,
         echo=cfg.get_bool("log_queries"),
         future=True,
+        query_cache_size=cfg.get_int("query_cache_size"),
+        **get_pool_options(cfg, url),
+        **get_sqlite_engine_options(url),
+    )
+    instrument_engine(engine, name)
+    if url.get_backend_name() == "sqlite":
+        install_sqlite_pragmas(engine, cfg)
+    if "slow_query_threshold" in cfg:
+        SlowQueryLogger(
+            get_logger(),
+            cfg.get_float("slow_query_threshold"),
+            explain=cfg.get_bool("slow_query_explain"),
+            analyze=cfg.get_bool("slow_query_explain_analyze"),
+            interval=cfg.get_float("slow_query_log_interval"),
+            max_per_interval=cfg.get_int("slow_query_max_per_interval"),
+        ).install(engine)
+
+    return engine
+
+
+def get_pool_options(
+        cfg: config.ConfigurationSet,
+        url: sqlalchemy.engine.URL,
+) -> dict:
+    """
+    Engine options sizing the connection pool.
+
+    In memory SQLite databases use a connection per thread and take no pool options.
+
+    :param cfg: Database configuration
+    :param url: Database URL
+    """
+    if url.get_backend_name() == "sqlite" and not is_file_database(url):
+        return {}
+
+    return {
+        "pool_size": cfg.get_int("pool_size"),
+        "max_overflow": cfg.get_int("max_overflow"),
+        "pool_timeout": cfg.get_float("pool_timeout"),
+        "pool_recycle": cfg.get_int("pool_recycle"),
+    }
+
+
+def get_engine() -> sqlalchemy.engine.Engine:
+    """Returns the DB Engine"""
+    cfg = get_db_config()
+    return create_engine(cfg, get_db_url(cfg))
+
+
+def get_replica_set(primary: sqlalchemy.engine.Engine) -> ReplicaSet:
+    """Creates read replicas engines from configuration"""
+    cfg = get_db_config()
+    return ReplicaSet(
+        primary,
+        [
+            create_engine(cfg, url, f"replica{i}")
+            for i, url in enumerate(get_read_urls(cfg))
+        ],
+        max_lag=cfg.get_float("replica_max_lag") if "replica_max_lag" in cfg else None,
+        check_interval=cfg.get_float("replica_check_interval"),
+        retry_interval=cfg.get_float("replica_retry_interval"),
+    )
+
+
+def get_shard_set() -> ShardSet | None:
+    """Creates measurement shards engines from configuration, None without shards"""
+    cfg = get_db_config()
+    urls = get_shard_urls(cfg)
+    if not urls:
+        return None
+
+    names = _read_list(cfg, "shard_names") or None
+    if names is not None and len(names) != len(urls):
+        raise ValueError("shard_names must name every shard of shard_urls.")
+    return ShardSet(
+        [create_engine(cfg, url, f"shard{i}") for i, url in enumerate(urls)],
+        names=names,
+        virtual_nodes=cfg.get_int("shard_virtual_nodes"),
+        max_workers=cfg.get_int("shard_threads"),
     )
 
 
 class DataBase:
     """Defines all database tables for the engine."""
 
-    def __init__(self, engine: sqlalchemy.engine.Engine):
+    def __init__(
+            self,
+            engine: sqlalchemy.engine.Engine,
+            replicas: ReplicaSet | None = None,
+            *,
+            metadata_refresh_interval: float = 5.0,
+            metadata_rebuild_interval: float = 3600.0,
+            block_cache_block: datetime.timedelta = datetime.timedelta(hours=1),
+            block_cache_max_rows: int = 1000000,
+            block_cache_marker_ttl: datetime.timedelta = datetime.timedelta(hours=1),
+            sketch_bucket: datetime.timedelta = datetime.timedelta(hours=1),
+            sketch_relative_accuracy: float = 0.01,
+            shards: ShardSet | None = None,
+    ):
         """
         Setups database engine.
 
         :param engine:SQLAlchemy engine
+        :param replicas: Read replicas, reads use the engine if None
+        :param metadata_refresh_interval: Delay in seconds between two incremental refreshes
+        of the metadata index
+        :param metadata_rebuild_interval: Delay in seconds between two full rebuilds of the
+        metadata index
+        :param block_cache_block: Size of the time blocks cached by the block cache
+        :param block_cache_max_rows: Maximum number of measurements held by the block cache
+        :param block_cache_marker_ttl: Age after which invalidation markers are purged
+        :param sketch_bucket: Time range summarized by each quantile sketch
+        :param sketch_relative_accuracy: Relative error of the quantile sketches
+        :param shards: Measurement shards, measurements are stored with the other tables
+        if None
         """
         self.engine = engine
+        self.replicas = replicas or ReplicaSet(engine)
+        self.shards = shards
+        self.metadata_index = MetadataIndex(
+            self,
+            refresh_interval=metadata_refresh_interval,
+            rebuild_interval=metadata_rebuild_interval,
+        )
         self.meta = sqlalchemy.MetaData()
         self.__create_sensors()
         self.__create_locations()
         self.__create_measurements()
+        self.__create_series()
         self.__create_measurement_types()
         self.__create_sensors_measurements()
+        self.__create_schema_version()
+        self.__create_retention_state()
+        self.__create_block_invalidations()
+        self.__create_measurement_sketches()
+        self.__create_journal_offsets()
+        self.__create_statements()
+        self.sketches = SketchStore(
+            self,
+            bucket=sketch_bucket,
+            relative_accuracy=sketch_relative_accuracy,
+        )
         self.setup()
+        self.series_cache = SeriesCache(self)
+        self.block_cache = BlockCache(
+            self,
+            block=block_cache_block,
+            max_rows=block_cache_max_rows,
+            marker_ttl=block_cache_marker_ttl,
+        )
 
     def __create_sensors(self):
         """Creates the sensor table."""
@@ -115,18 +398,40 @@ class DataBase:
         )
 
     def __create_measurements(self):
-        """Creates the measurement table."""
+        """
+        Creates the measurement table.
+
+        Rows only hold the series key, the date and the value, sensor, measurement type and
+        location are read from d_series and the dimension tables.
+        """
         self._measurements = sqlalchemy.Table(
             "d_measurements",
             self.meta,
-            sqlalchemy.Column("location_id", sqlalchemy.String),
-            sqlalchemy.Column("sensor_id", sqlalchemy.String),
-            sqlalchemy.Column("measurement_name", sqlalchemy.String),
-            sqlalchemy.Column("unit", sqlalchemy.String),
-            sqlalchemy.Column("measurement_datetime", sqlalchemy.DateTime),
-            sqlalchemy.Column("measurement_value", sqlalchemy.Numeric),
-            sqlalchemy.Column("d_created_date_utc", sqlalchemy.DateTime),
-            sqlalchemy.Column("d_updated_date_utc", sqlalchemy.DateTime),
+            sqlalchemy.Column("series_id", sqlalchemy.Integer, nullable=False),
+            sqlalchemy.Column("measurement_datetime", sqlalchemy.DateTime, nullable=False),
+            sqlalchemy.Column("measurement_value", sqlalchemy.Float(precision=53)),
+            sqlalchemy.Index(
+                "ix_d_measurements_series_datetime",
+                "series_id",
+                "measurement_datetime",
+            ),
+        )
+
+    def __create_series(self):
+        """Creates the series table, one row per sensor, measurement type and location."""
+        self._series = sqlalchemy.Table(
+            "d_series",
+            self.meta,
+            sqlalchemy.Column("series_id", sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column("sensor_id", sqlalchemy.String, nullable=False),
+            sqlalchemy.Column("measurement_name", sqlalchemy.String, nullable=False),
+            sqlalchemy.Column("location_id", sqlalchemy.String, nullable=False),
+            sqlalchemy.UniqueConstraint(
+                "sensor_id",
+                "measurement_name",
+                "location_id",
+                name="uq_d_series_key",
+            ),
         )
 
     def __create_measurement_types(self):
@@ -141,6 +446,9 @@ class DataBase:
             ),
             sqlalchemy.Column("unit", sqlalchemy.String),
             sqlalchemy.Column("string_format", sqlalchemy.String),
+            sqlalchemy.Column("retention_days", sqlalchemy.Integer),
+            sqlalchemy.Column("retention_action", sqlalchemy.String),
+            sqlalchemy.Column("downsample_minutes", sqlalchemy.Integer),
             sqlalchemy.Column("d_created_date_utc", sqlalchemy.DateTime),
             sqlalchemy.Column("d_updated_date_utc", sqlalchemy.DateTime),
         )
@@ -172,9 +480,176 @@ class DataBase:
             sqlalchemy.Column("d_updated_date_utc", sqlalchemy.DateTime),
         )
 
+    def __create_schema_version(self):
+        """Version of the schema the tables were created for"""
+        self._schema_version = sqlalchemy.Table(
+            "s_schema_version",
+            self.meta,
+            sqlalchemy.Column("schema_version", sqlalchemy.String, primary_key=True),
+            sqlalchemy.Column("d_updated_date_utc", sqlalchemy.DateTime),
+        )
+
+    def __create_retention_state(self):
+        """Progress of the retention job per measurement type"""
+        self._retention_state = sqlalchemy.Table(
+            "s_retention_state",
+            self.meta,
+            sqlalchemy.Column("measurement_name", sqlalchemy.String, primary_key=True),
+            sqlalchemy.Column("downsampled_until", sqlalchemy.DateTime),
+            sqlalchemy.Column("d_updated_date_utc", sqlalchemy.DateTime),
+        )
+
+    def __create_block_invalidations(self):
+        """Markers of measurements written to closed time blocks, read by block caches"""
+        self._block_invalidations = sqlalchemy.Table(
+            "s_block_invalidations",
+            self.meta,
+            sqlalchemy.Column("marker_id", sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column("series_id", sqlalchemy.Integer),
+            sqlalchemy.Column("block_start", sqlalchemy.DateTime, nullable=False),
+            sqlalchemy.Column("block_end", sqlalchemy.DateTime, nullable=False),
+            sqlalchemy.Column("d_created_date_utc", sqlalchemy.DateTime, nullable=False),
+            sqlalchemy.Index("ix_s_block_invalidations_created", "d_created_date_utc"),
+        )
+
+    def __create_measurement_sketches(self):
+        """Quantile sketches of measurements per series and time bucket"""
+        self._measurement_sketches = sqlalchemy.Table(
+            "d_measurement_sketches",
+            self.meta,
+            sqlalchemy.Column("series_id", sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column("bucket_start", sqlalchemy.DateTime, primary_key=True),
+            sqlalchemy.Column("sketch", sqlalchemy.Text, nullable=False),
+            sqlalchemy.Column("d_updated_date_utc", sqlalchemy.DateTime),
+        )
+
+    def __create_journal_offsets(self):
+        """Position of the ingest journals written to d_measurements"""
+        self._journal_offsets = sqlalchemy.Table(
+            "s_journal_offsets",
+            self.meta,
+            sqlalchemy.Column("journal_id", sqlalchemy.String, primary_key=True),
+            sqlalchemy.Column("segment", sqlalchemy.Integer, nullable=False),
+            sqlalchemy.Column("offset", sqlalchemy.BigInteger, nullable=False),
+            sqlalchemy.Column("d_updated_date_utc", sqlalchemy.DateTime),
+        )
+
+    def get_schema_version(self) -> tuple[int, ...] | None:
+        """
+        Reads the schema version stored in the database.
+
+        :return: The stored version, None if the database was never setup
+        """
+        try:
+            with self.engine.connect() as conn:
+                version = conn.execute(
+                    sqlalchemy.select(self._schema_version.c.schema_version),
+                ).scalar()
+        except sqlalchemy.exc.DBAPIError:
+            # The version table does not exist yet.
+            return None
+
+        if not version:
+            return None
+        return tuple(int(v) for v in version.split("."))
+
     def setup(self):
-        """Create all required tables."""
+        """
+        Create all required tables.
+
+        Tables are only created when the stored schema version is older than
+        __schema_version__, so an up-to-date database costs a single query instead of
+        reflecting every table. The measurement table is created in shards missing it at the
+        same time, so shards are added along with a schema upgrade.
+        """
+        version = self.get_schema_version()
+        if version is not None and version >= __schema_version__:
+            return
+
+        wide_measurements = self._has_wide_measurements()
+        if version is None and wide_measurements:
+            # Created before the schema version table, by the first release.
+            version = (0, 0, 0)
+        migrate_measurements = version is not None and version < (0, 4, 0) and wide_measurements
+        if version is not None and version < (0, 4, 0):
+            with self.engine.begin() as conn:
+                if version < (0, 3, 0):
+                    self._add_missing_columns(conn, self.measurement_types)
+                if migrate_measurements:
+                    conn.exec_driver_sql(
+                        "ALTER TABLE d_measurements RENAME TO d_measurements_legacy",
+                    )
+                    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_d_measurements_name_datetime")
+
         self.meta.create_all(self.engine)
+        if self.shards is not None:
+            for shard in self.shards.engines:
+                self.meta.create_all(shard, tables=[self.measurements])
+        with self.engine.begin() as conn:
+            if migrate_measurements:
+                self._migrate_measurements(conn)
+            if version is not None and version < (0, 6, 0):
+                self.sketches.backfill(conn)
+            conn.execute(self._schema_version.delete())
+            conn.execute(
+                self._schema_version.insert().values(
+                    schema_version=".".join(str(v) for v in __schema_version__),
+                    d_updated_date_utc=datetime.datetime.utcnow(),
+                ),
+            )
+
+    @staticmethod
+    def _add_missing_columns(conn: sqlalchemy.engine.Connection, table: sqlalchemy.Table):
+        """Adds the columns of a table created by a previous release, if it exists."""
+        inspector = sqlalchemy.inspect(conn)
+        if not inspector.has_table(table.name):
+            return
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                conn.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                    f"{column.type.compile(conn.dialect)}",
+                )
+
+    def _has_wide_measurements(self) -> bool:
+        """Tells whether d_measurements has the wide layout used before 0.4.0."""
+        inspector = sqlalchemy.inspect(self.engine)
+        return inspector.has_table("d_measurements") and "sensor_id" in {
+            column["name"] for column in inspector.get_columns("d_measurements")
+        }
+
+    def _migrate_measurements(self, conn: sqlalchemy.engine.Connection):
+        """Moves measurements of the wide layout used before 0.4.0 into series."""
+        legacy = sqlalchemy.table(
+            "d_measurements_legacy",
+            sqlalchemy.column("sensor_id"),
+            sqlalchemy.column("measurement_name"),
+            sqlalchemy.column("location_id"),
+            sqlalchemy.column("measurement_datetime"),
+            sqlalchemy.column("measurement_value"),
+        )
+        keys = ["sensor_id", "measurement_name", "location_id"]
+        conn.execute(self.series.insert().from_select(
+            keys,
+            sqlalchemy.select(*(legacy.c[key] for key in keys)).distinct().where(
+                *(legacy.c[key].is_not(None) for key in keys),
+            ),
+        ))
+        conn.execute(self.measurements.insert().from_select(
+            ["series_id", "measurement_datetime", "measurement_value"],
+            sqlalchemy.select(
+                self.series.c.series_id,
+                legacy.c.measurement_datetime,
+                sqlalchemy.cast(legacy.c.measurement_value, sqlalchemy.Float(precision=53)),
+            ).select_from(
+                legacy.join(
+                    self.series,
+                    sqlalchemy.and_(*(legacy.c[key] == self.series.c[key] for key in keys)),
+                ),
+            ).where(legacy.c.measurement_datetime.is_not(None)),
+        ))
+        conn.exec_driver_sql("DROP TABLE d_measurements_legacy")
 
     @property
     def sensors(self) -> sqlalchemy.Table:
@@ -186,6 +661,11 @@ class DataBase:
         """Measurements table."""
         return self._measurements
 
+    @property
+    def series(self) -> sqlalchemy.Table:
+        """Series table."""
+        return self._series
+
     @property
     def measurement_types(self) -> sqlalchemy.Table:
         """Measurement types table."""
@@ -201,39 +681,467 @@ class DataBase:
         """Location table."""
         return self._locations
 
-    def select_sensors_measurement(self, sensor_id: str, measurement_name: str):
+    @property
+    def retention_state(self) -> sqlalchemy.Table:
+        """Retention job state table."""
+        return self._retention_state
+
+    @property
+    def block_invalidations(self) -> sqlalchemy.Table:
+        """Block cache invalidation markers table."""
+        return self._block_invalidations
+
+    @property
+    def measurement_sketches(self) -> sqlalchemy.Table:
+        """Quantile sketches table."""
+        return self._measurement_sketches
+
+    @property
+    def journal_offsets(self) -> sqlalchemy.Table:
+        """Ingest journal positions table."""
+        return self._journal_offsets
+
+    def __create_statements(self):
+        """
+        Builds the statements executed for every measurement once.
+
+        Reusing the same statement objects with bind parameters skips building the statement
+        and its cache key on each call.
+        """
+        self._sensor_measurement = sqlalchemy.select(
+            self.sensors.c.sensor_id,
+            self.sensors.c.sensor_name,
+            self.sensors.c.location_id,
+            self.sensors.c.pubkey,
+            self.locations.c.location_name,
+            self.measurement_types.c.measurement_name,
+            self.measurement_types.c.unit,
+            self.measurement_types.c.string_format,
+        ).select_from(
+            self.sensors.join(
+                self.sensor_measurements,
+                self.sensors.c.sensor_id == self.sensor_measurements.c.sensor_id,
+            ).join(
+                self.measurement_types,
+                self.measurement_types.c.measurement_name
+                == self.sensor_measurements.c.measurement_name,  # noqa
+            ).join(
+                self.locations,
+                self.sensors.c.location_id == self.locations.c.location_id,
+            ),
+        ).where(
+            self.sensors.c.sensor_id == sqlalchemy.bindparam("sensor_id"),
+            self.sensors.c.is_active != "N",
+            self.sensor_measurements.c.measurement_name
+            == sqlalchemy.bindparam("measurement_name"),  # noqa
+        )
+        self._insert_measurement = self.measurements.insert()
+
+    def select_sensors_measurement(self) -> sqlalchemy.sql.Select:
         """
         Retrieve sensor, measurements and location details.
 
-        :param sensor_id: Sensor ID
-        :param measurement_name: Name for the measurement
+        The statement is prebuilt, it is executed with the sensor_id and measurement_name
+        parameters.
+
         :return: SQLAlchemy Select statement
         """
-        return self.sensors.select().where(
-            sqlalchemy.and_(
-                self.sensors.c.sensor_id == sensor_id,
-                self.sensors.c.is_active != "N",
+        return self._sensor_measurement
+
+    @property
+    def insert_measurement(self) -> sqlalchemy.sql.Insert:
+        """Prebuilt insert of d_measurements rows, executed with the row values."""
+        return self._insert_measurement
+
+    def insert_measurements(
+            self,
+            conn: sqlalchemy.engine.Connection,
+            rows: list[dict],
+            now: datetime.datetime | None = None,
+    ):
+        """
+        Inserts d_measurements rows.
+
+        The sketches of their buckets are updated, and the closed time blocks they land in
+        are marked as stale.
+
+        :param conn: Connection of the writing transaction
+        :param rows: d_measurements rows
+        :param now: Current UTC time
+        """
+        if not rows:
+            return
+        if self.shards is None:
+            conn.execute(self.insert_measurement, rows)
+        else:
+            self._insert_sharded(conn, rows)
+        self.sketches.update(conn, rows)
+        markers = self.block_cache.invalidation_markers(rows, now or datetime.datetime.utcnow())
+        if markers:
+            conn.execute(self.block_invalidations.insert(), markers)
+
+    def _insert_sharded(self, conn: sqlalchemy.engine.Connection, rows: list[dict]):
+        """
+        Inserts d_measurements rows in their shards, concurrently.
+
+        Each shard commits its rows before the transaction of conn commits, a failure of
+        this transaction leaves the rows stored without their sketches updated, and a retry
+        of the same rows stores them twice.
+        """
+        keys = self.series_cache.keys(conn, {row["series_id"] for row in rows})
+
+        def insert(shard: sqlalchemy.engine.Engine, shard_rows: list[dict]):
+            with shard.begin() as shard_conn:
+                shard_conn.execute(self.insert_measurement, shard_rows)
+
+        self.shards.scatter(
+            insert,
+            self.shards.partition((keys[row["series_id"]].sensor_id, row) for row in rows),
+        )
+
+    def scatter_measurements(
+            self,
+            conn: sqlalchemy.engine.Connection,
+            series_ids: typing.Iterable[int],
+            read: typing.Callable[[sqlalchemy.engine.Connection, list[int]], T],
+    ) -> list[T]:
+        """
+        Reads measurements of series where they are stored.
+
+        Without shards, read is called with conn. With shards, it is called concurrently
+        for each shard holding some of the series, with a connection to the shard.
+
+        :param conn: Connection to the database
+        :param series_ids: Series ids
+        :param read: Called with a connection and the ids of the series it holds
+        :return: Results of the calls
+        """
+        series_ids = list(series_ids)
+        if not series_ids:
+            return []
+        if self.shards is None:
+            return [read(conn, series_ids)]
+
+        def shard_read(shard: sqlalchemy.engine.Engine, shard_series_ids: list[int]) -> T:
+            with shard.connect() as shard_conn:
+                return read(shard_conn, shard_series_ids)
+
+        keys = self.series_cache.keys(conn, series_ids)
+        return self.shards.scatter(
+            shard_read,
+            self.shards.partition(
+                (keys[series_id].sensor_id, series_id)
+                for series_id in series_ids
+                if series_id in keys
             ),
-        ).join(
-            self.sensor_measurements,
-            self.sensors.c.sensor_id == self.sensor_measurements.c.sensor_id,
-        ).join(
-            self.measurement_types,
-            sqlalchemy.and_(
-                self.sensor_measurements.c.measurement_name == measurement_name,
+        )
+
+    def measurement_connections(
+            self,
+            conn: sqlalchemy.engine.Connection,
+            series_ids: typing.Iterable[int],
+            stack: contextlib.ExitStack,
+    ) -> list[tuple[sqlalchemy.engine.Connection, list[int]]]:
+        """
+        Opens connections to the shards holding measurements of series.
+
+        :param conn: Connection to the database, the only one returned without shards
+        :param series_ids: Series ids
+        :param stack: Closes the opened connections
+        :return: Connections and the ids of the series they hold
+        """
+        series_ids = list(series_ids)
+        if not series_ids:
+            return []
+        if self.shards is None:
+            return [(conn, series_ids)]
+
+        keys = self.series_cache.keys(conn, series_ids)
+        groups = self.shards.partition(
+            (keys[series_id].sensor_id, series_id)
+            for series_id in series_ids
+            if series_id in keys
+        )
+        return [
+            (stack.enter_context(self.shards.engines[index].connect()), groups[index])
+            for index in sorted(groups)
+        ]
+
+    def select_locations(self):
+        """
+        Retrieve all locations.
+
+        :return: SQLAlchemy Select statement
+        """
+        return sqlalchemy.select(
+            self.locations.c.location_id,
+            self.locations.c.location_name,
+        ).order_by(self.locations.c.location_id)
+
+    def select_sensors(
+            self,
+            *,
+            sensor_ids: list[str] | None = None,
+    ):
+        """
+        Retrieve active sensors with their location and measurement types.
+
+        One row is returned per sensor and measurement type.
+
+        :param sensor_ids: Only those sensors
+        :return: SQLAlchemy Select statement
+        """
+        query = sqlalchemy.select(
+            self.sensors.c.sensor_id,
+            self.sensors.c.sensor_name,
+            self.locations.c.location_id,
+            self.locations.c.location_name,
+            self.measurement_types.c.measurement_name,
+            self.measurement_types.c.unit,
+            self.measurement_types.c.string_format,
+        ).select_from(
+            self.sensors.join(
+                self.locations,
+                self.sensors.c.location_id == self.locations.c.location_id,
+            ).outerjoin(
+                self.sensor_measurements,
+                self.sensors.c.sensor_id == self.sensor_measurements.c.sensor_id,
+            ).outerjoin(
+                self.measurement_types,
                 self.measurement_types.c.measurement_name
                 == self.sensor_measurements.c.measurement_name,  # noqa
             ),
-        ).join(
-            self.locations,
-            self.sensors.c.location_id == self.locations.c.location_id,
+        ).where(
+            self.sensors.c.is_active != "N",
+        ).order_by(
+            self.sensors.c.sensor_id,
+            self.measurement_types.c.measurement_name,
         )
 
+        if sensor_ids is not None:
+            query = query.where(self.sensors.c.sensor_id.in_(sensor_ids))
+
+        return query
+
+    def select_series_ids(
+            self,
+            measurement_names: list[str],
+            *,
+            sensor_ids: list[str] | None = None,
+            location_ids: list[str] | None = None,
+    ):
+        """
+        Retrieve the ids of series of measurement types.
+
+        :param measurement_names: Names of the measurements
+        :param sensor_ids: Only series of those sensors
+        :param location_ids: Only series of those locations ids
+        :return: SQLAlchemy Select statement
+        """
+        query = sqlalchemy.select(self.series.c.series_id).where(
+            self.series.c.measurement_name.in_(measurement_names),
+        )
+        if sensor_ids is not None:
+            query = query.where(self.series.c.sensor_id.in_(sensor_ids))
+        if location_ids is not None:
+            query = query.where(self.series.c.location_id.in_(location_ids))
+
+        return query
+
+    def select_measurements(
+            self,
+            series_ids: typing.Collection[int],
+            *,
+            start_time: datetime.datetime | None = None,
+            end_time: datetime.datetime | None = None,
+            last_only: bool = False,
+    ):
+        """
+        Retrieve measurements of series, sorted by date and series id.
+
+        Only d_measurements is read, so the statement runs on measurement shards too.
+        Sensor, location and type details are read from the series and dimension caches.
+
+        :param series_ids: Ids of the series, from select_series_ids
+        :param start_time: Measurements from this date (included)
+        :param end_time: Measurements until this date (included)
+        :param last_only: Only the last measurement of each series
+        :return: SQLAlchemy Select statement
+        """
+        measurements = self.measurements
+        source = measurements
+        if last_only:
+            latest = sqlalchemy.select(
+                measurements.c.series_id,
+                sqlalchemy.func.max(measurements.c.measurement_datetime).label("latest"),
+            ).where(
+                measurements.c.series_id.in_(series_ids),
+            ).group_by(measurements.c.series_id).subquery()
+            source = measurements.join(
+                latest,
+                sqlalchemy.and_(
+                    measurements.c.series_id == latest.c.series_id,
+                    measurements.c.measurement_datetime == latest.c.latest,
+                ),
+            )
+
+        query = sqlalchemy.select(
+            measurements.c.series_id,
+            measurements.c.measurement_datetime,
+            measurements.c.measurement_value,
+        ).select_from(source).where(
+            measurements.c.series_id.in_(series_ids),
+        ).order_by(
+            measurements.c.measurement_datetime,
+            measurements.c.series_id,
+        )
+
+        if start_time is not None:
+            query = query.where(measurements.c.measurement_datetime >= start_time)
+        if end_time is not None:
+            query = query.where(measurements.c.measurement_datetime <= end_time)
+
+        return query
+
+    def select_buckets(
+            self,
+            series_ids: typing.Collection[int],
+            bucket: datetime.timedelta,
+            dialect: str,
+            *,
+            start_time: datetime.datetime | None = None,
+            end_time: datetime.datetime | None = None,
+    ):
+        """
+        Retrieve the average of measurements of series per time bucket.
+
+        Buckets are grouped by the database, they are returned as measurements dated at the
+        start of their bucket, sorted by date and series id. Empty buckets are left out.
+
+        :param series_ids: Ids of the series, from select_series_ids
+        :param bucket: Bucket size
+        :param dialect: Name of the dialect executing the statement
+        :param start_time: Measurements from this date (included)
+        :param end_time: Measurements until this date (included)
+        :return: SQLAlchemy Select statement
+        """
+        measurements = self.measurements
+        start = bucket_start(measurements.c.measurement_datetime, bucket, dialect).label(
+            "measurement_datetime",
+        )
+        query = sqlalchemy.select(
+            measurements.c.series_id,
+            start,
+            sqlalchemy.func.avg(measurements.c.measurement_value).label("measurement_value"),
+        ).where(
+            measurements.c.series_id.in_(series_ids),
+        ).group_by(
+            measurements.c.series_id,
+            start,
+        ).order_by(
+            start,
+            measurements.c.series_id,
+        )
+
+        if start_time is not None:
+            query = query.where(measurements.c.measurement_datetime >= start_time)
+        if end_time is not None:
+            query = query.where(measurements.c.measurement_datetime <= end_time)
+
+        return query
+
+    def apply_config(self, previous: ConfigSnapshot, cfg: ConfigSnapshot):
+        """
+        Applies a reloaded configuration to the engines and caches.
+
+        :param previous: Configuration in use until now
+        :param cfg: New configuration
+        """
+        changed = changed_keys(previous, cfg)
+        pool = changed.intersection(POOL_KEYS)
+        if pool:
+            get_logger().warning(
+                f"Connection pools keep their settings until a restart: {sorted(pool)}",
+            )
+        restart = changed.difference(RELOADABLE_KEYS, POOL_KEYS)
+        if restart:
+            get_logger().warning(f"Changed DB settings need a restart: {sorted(restart)}")
+
+        shards = self.shards.engines if self.shards is not None else []
+        for engine in [self.engine, *self.replicas.replicas, *shards]:
+            engine.echo = cfg.get_bool("log_queries")
+
+        self.replicas.max_lag = (
+            cfg.get_float("replica_max_lag") if "replica_max_lag" in cfg else None
+        )
+        self.replicas.check_interval = cfg.get_float("replica_check_interval")
+        self.replicas.retry_interval = cfg.get_float("replica_retry_interval")
+        self.metadata_index.refresh_interval = cfg.get_float("metadata_refresh_interval")
+        self.metadata_index.rebuild_interval = cfg.get_float("metadata_rebuild_interval")
+        self.block_cache.max_rows = cfg.get_int("block_cache_max_rows")
+
     def get_session(self) -> sqlalchemy.orm.Session:
         """Creates a new database session."""
         return sqlalchemy.orm.Session(self.engine)
 
+    def read_connection(self) -> typing.ContextManager[sqlalchemy.engine.Connection]:
+        """Opens a connection for read only queries, on a replica when available."""
+        return self.replicas.connect()
+
+    def dispose(self, close: bool = True):
+        """
+        Disposes all engines.
+
+        :param close: Close pooled connections, use False in forked processes
+        """
+        self.replicas.dispose(close=close)
+        if self.shards is not None:
+            self.shards.dispose(close=close)
+
+
+_database: DataBase | None = None
+_database_lock = threading.Lock()
+
 
 def get_database() -> DataBase:
-    """Creates a database."""
-    return DataBase(get_engine())
+    """Returns the process database, creating it on first call."""
+    global _database
+
+    with _database_lock:
+        if _database is None:
+            cfg = get_db_config()
+            engine = get_engine()
+            _database = DataBase(
+                engine,
+                get_replica_set(engine),
+                metadata_refresh_interval=cfg.get_float("metadata_refresh_interval"),
+                metadata_rebuild_interval=cfg.get_float("metadata_rebuild_interval"),
+                block_cache_block=datetime.timedelta(
+                    minutes=cfg.get_int("block_cache_block_minutes"),
+                ),
+                block_cache_max_rows=cfg.get_int("block_cache_max_rows"),
+                block_cache_marker_ttl=datetime.timedelta(
+                    seconds=cfg.get_float("block_cache_marker_ttl"),
+                ),
+                sketch_bucket=datetime.timedelta(minutes=cfg.get_int("sketch_bucket_minutes")),
+                sketch_relative_accuracy=cfg.get_float("sketch_relative_accuracy"),
+                shards=get_shard_set(),
+            )
+            get_db_config_source().subscribe(_database.apply_config)
+        return _database
+
+
+def reset_database():
+    """
+    Forgets the process database.
+
+    Must be called in forked processes: connections inherited from the parent are
+    dropped without being closed, so they stay usable by the parent.
+    """
+    global _database
+
+    with _database_lock:
+        if _database is not None:
+            get_db_config_source().unsubscribe(_database.apply_config)
+            _database.dispose(close=False)
+        _database = None
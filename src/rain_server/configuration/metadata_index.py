@@ -0,0 +1,301 @@
+"""In-process index of locations, sensors and measurement types"""
+import datetime
+import threading
+import time
+import typing
+
+import sqlalchemy
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from .db_engine import DataBase
+
+
+class MeasurementTypeDetails(typing.NamedTuple):
+    """Cached details of a measurement type"""
+
+    unit: str | None
+    string_format: str | None
+
+
+class Dimensions(typing.NamedTuple):
+    """Cached names of sensors and locations, and measurement type details"""
+
+    sensor_names: dict[str, str]
+    location_names: dict[str, str]
+    measurement_types: dict[str, MeasurementTypeDetails]
+
+
+class MetadataIndex:
+    """
+    Maps location names to ids, locations to active sensors and sensors to measurement types.
+
+    It also caches the names of sensors and locations and the details of measurement types
+    so measurements can be returned without joining the dimension tables.
+
+    The index is built on first use. Every refresh_interval seconds, rows updated since the
+    last load are applied incrementally using their d_updated_date_utc, or d_created_date_utc
+    for rows never updated. Deleted rows are only dropped by the full rebuild, every
+    rebuild_interval seconds. Looking up an unknown location name triggers an incremental
+    refresh, at most once per miss_interval seconds.
+    """
+
+    def __init__(
+            self,
+            database: "DataBase",
+            *,
+            refresh_interval: float = 5.0,
+            rebuild_interval: float = 3600.0,
+            miss_interval: float = 1.0,
+            clock: typing.Callable[[], float] = time.monotonic,
+    ):
+        """
+        Setups an empty index.
+
+        :param database: Database the index is loaded from
+        :param refresh_interval: Delay in seconds between two incremental refreshes
+        :param rebuild_interval: Delay in seconds between two full rebuilds
+        :param miss_interval: Minimum delay in seconds between two refreshes caused by misses
+        :param clock: Monotonic clock
+        """
+        self.database = database
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.miss_interval = miss_interval
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._built = False
+        self._refreshed_at = 0.0
+        self._rebuilt_at = 0.0
+        self._clear()
+
+    def _clear(self):
+        """Empties the index."""
+        self._location_names: dict[str, str] = {}
+        self._location_ids: dict[str, set[str]] = {}
+        self._sensor_locations: dict[str, str] = {}
+        self._location_sensors: dict[str, set[str]] = {}
+        self._sensor_measurements: dict[str, set[str]] = {}
+        self._sensor_names: dict[str, str] = {}
+        self._measurement_types: dict[str, MeasurementTypeDetails] = {}
+        self._watermarks: dict[str, datetime.datetime | None] = {
+            "locations": None,
+            "sensors": None,
+            "sensor_measurements": None,
+            "measurement_types": None,
+        }
+
+    def _changed_rows(
+            self,
+            conn: sqlalchemy.engine.Connection,
+            watermark: datetime.datetime | None,
+            name: str,
+            *columns: str,
+    ) -> list:
+        """Reads the rows of a table updated since the watermark, all rows if None."""
+        table = getattr(self.database, name)
+        updated = sqlalchemy.func.coalesce(table.c.d_updated_date_utc, table.c.d_created_date_utc)
+        query = sqlalchemy.select(
+            *(table.c[column] for column in columns),
+            updated.label("d_updated_date_utc"),
+        )
+        if watermark is not None:
+            # Rows updated at the watermark are read again, applying them is idempotent.
+            query = query.where(updated >= watermark)
+        return conn.execute(query).all()
+
+    def _set_location(self, location_id: str, name: str):
+        """Adds or renames a location."""
+        previous = self._location_names.get(location_id)
+        if previous is not None:
+            self._location_ids[previous].discard(location_id)
+            if not self._location_ids[previous]:
+                del self._location_ids[previous]
+        self._location_names[location_id] = name
+        self._location_ids.setdefault(name, set()).add(location_id)
+
+    def _set_sensor(self, sensor_id: str, location_id: str | None, is_active: str | None):
+        """Adds, moves or deactivates a sensor."""
+        previous = self._sensor_locations.pop(sensor_id, None)
+        if previous is not None:
+            self._location_sensors[previous].discard(sensor_id)
+        if is_active != "N":
+            self._sensor_locations[sensor_id] = location_id
+            self._location_sensors.setdefault(location_id, set()).add(sensor_id)
+
+    def _update_watermark(self, name: str, rows):
+        """Moves the watermark of a table to its last update."""
+        dates = [row.d_updated_date_utc for row in rows if row.d_updated_date_utc is not None]
+        if dates:
+            current = self._watermarks[name]
+            self._watermarks[name] = max(dates) if current is None else max(current, *dates)
+
+    def _load(self, full: bool):
+        """Reads changed rows and applies them to the index."""
+        requested = self.clock()
+        with self._load_lock:
+            if (self._rebuilt_at if full else self._refreshed_at) > requested:
+                # Another thread loaded the index while this one was waiting.
+                return
+            now = self.clock()
+            with self._lock:
+                watermarks = {} if full else dict(self._watermarks)
+
+            with self.database.read_connection() as conn:
+                locations = self._changed_rows(
+                    conn, watermarks.get("locations"), "locations",
+                    "location_id", "location_name",
+                )
+                sensors = self._changed_rows(
+                    conn, watermarks.get("sensors"), "sensors",
+                    "sensor_id", "sensor_name", "location_id", "is_active",
+                )
+                sensor_measurements = self._changed_rows(
+                    conn, watermarks.get("sensor_measurements"), "sensor_measurements",
+                    "sensor_id", "measurement_name",
+                )
+                measurement_types = self._changed_rows(
+                    conn, watermarks.get("measurement_types"), "measurement_types",
+                    "measurement_name", "unit", "string_format",
+                )
+
+            with self._lock:
+                if full:
+                    # The previous index stays readable while the new one is loaded.
+                    self._clear()
+                for row in locations:
+                    self._set_location(row.location_id, row.location_name)
+                for row in sensors:
+                    self._sensor_names[row.sensor_id] = row.sensor_name
+                    self._set_sensor(row.sensor_id, row.location_id, row.is_active)
+                for row in sensor_measurements:
+                    self._sensor_measurements.setdefault(row.sensor_id, set()).add(
+                        row.measurement_name,
+                    )
+                self._update_watermark("locations", locations)
+                self._update_watermark("sensors", sensors)
+                for row in measurement_types:
+                    self._measurement_types[row.measurement_name] = MeasurementTypeDetails(
+                        row.unit, row.string_format,
+                    )
+                self._update_watermark("sensor_measurements", sensor_measurements)
+                self._update_watermark("measurement_types", measurement_types)
+
+                self._refreshed_at = now
+                if full:
+                    self._rebuilt_at = now
+                    self._built = True
+
+    def rebuild(self):
+        """Reloads the whole index."""
+        self._load(full=True)
+
+    def refresh(self):
+        """Applies rows updated since the last load."""
+        self._load(full=False)
+
+    def _ensure_fresh(self):
+        """Builds or refreshes the index when due."""
+        if not self._built:
+            self.rebuild()
+            return
+
+        now = self.clock()
+        if now - self._rebuilt_at >= self.rebuild_interval:
+            self.rebuild()
+        elif now - self._refreshed_at >= self.refresh_interval:
+            self.refresh()
+
+    def _refresh_missing(self, is_missing: typing.Callable[[], bool]):
+        """Refreshes the index when keys are missing, at most once per miss_interval."""
+        self._ensure_fresh()
+        with self._lock:
+            missing = is_missing()
+        if missing and self.clock() - self._refreshed_at >= self.miss_interval:
+            self.refresh()
+
+    def location_ids(self, location_names: typing.Iterable[str]) -> list[str]:
+        """
+        Resolves location names.
+
+        :param location_names: Location names
+        :return: Ids of the locations with those names, sorted
+        """
+        location_names = list(location_names)
+        self._refresh_missing(
+            lambda: any(name not in self._location_ids for name in location_names),
+        )
+
+        with self._lock:
+            return sorted({
+                location_id
+                for name in location_names
+                for location_id in self._location_ids.get(name, ())
+            })
+
+    def sensor_ids(self, location_ids: typing.Iterable[str]) -> list[str]:
+        """
+        Lists the active sensors of locations.
+
+        :param location_ids: Location ids
+        :return: Sensor ids, sorted
+        """
+        self._ensure_fresh()
+        with self._lock:
+            return sorted({
+                sensor_id
+                for location_id in location_ids
+                for sensor_id in self._location_sensors.get(location_id, ())
+            })
+
+    def measurement_names(self, sensor_id: str) -> set[str]:
+        """
+        Lists the measurement types of a sensor.
+
+        :param sensor_id: Sensor id
+        :return: Measurement names
+        """
+        self._ensure_fresh()
+        with self._lock:
+            return set(self._sensor_measurements.get(sensor_id, ()))
+
+    def dimensions(
+            self,
+            sensor_ids: typing.Iterable[str],
+            location_ids: typing.Iterable[str],
+            measurement_names: typing.Iterable[str],
+    ) -> Dimensions:
+        """
+        Returns cached dimension details.
+
+        Unknown keys trigger a refresh and are left out if still unknown.
+
+        :param sensor_ids: Sensor ids
+        :param location_ids: Location ids
+        :param measurement_names: Measurement type names
+        """
+        sensor_ids, location_ids = set(sensor_ids), set(location_ids)
+        measurement_names = set(measurement_names)
+        self._refresh_missing(
+            lambda: not (
+                sensor_ids.issubset(self._sensor_names)
+                and location_ids.issubset(self._location_names)  # noqa
+                and measurement_names.issubset(self._measurement_types)  # noqa
+            ),
+        )
+
+        with self._lock:
+            return Dimensions(
+                {key: self._sensor_names[key] for key in sensor_ids if key in self._sensor_names},
+                {
+                    key: self._location_names[key]
+                    for key in location_ids
+                    if key in self._location_names
+                },
+                {
+                    key: self._measurement_types[key]
+                    for key in measurement_names
+                    if key in self._measurement_types
+                },
+            )
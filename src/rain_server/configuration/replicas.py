@@ -0,0 +1,128 @@
+"""Routes read only queries to replica databases"""
+import contextlib
+import itertools
+import threading
+import time
+import typing
+
+import sqlalchemy.engine
+import sqlalchemy.exc
+
+from .logger import get_logger
+
+LAG_QUERIES = {
+    "postgresql": "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)",
+}
+
+
+class ReplicaSet:
+    """
+    Load balances read connections across replicas.
+
+    Replicas are used round-robin. A replica failing to connect is skipped for
+    retry_interval seconds, a replica lagging more than max_lag seconds is skipped until
+    its next check. When no replica can be used, reads fall back to the primary.
+    """
+
+    def __init__(
+            self,
+            primary: sqlalchemy.engine.Engine,
+            replicas: typing.Sequence[sqlalchemy.engine.Engine] = (),
+            *,
+            max_lag: float | None = None,
+            check_interval: float = 5.0,
+            retry_interval: float = 30.0,
+    ):
+        """
+        Setups the replica set.
+
+        :param primary: Primary engine, used when no replica is available
+        :param replicas: Replica engines
+        :param max_lag: Maximum replication lag in seconds, None to never check
+        :param check_interval: Delay in seconds between two lag checks of a replica
+        :param retry_interval: Delay in seconds before retrying a failed replica
+        """
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        self._next = itertools.cycle(range(len(self.replicas))) if self.replicas else None
+        self._unavailable_until: dict[int, float] = {}
+        self._lag_checks: dict[int, tuple[float, bool]] = {}
+
+    def mark_unavailable(self, index: int):
+        """Skips a replica for retry_interval seconds."""
+        with self._lock:
+            self._unavailable_until[index] = time.monotonic() + self.retry_interval
+
+    def _is_fresh(self, index: int) -> bool:
+        """Checks the replication lag of a replica, at most once per check_interval."""
+        if self.max_lag is None:
+            return True
+
+        engine = self.replicas[index]
+        query = LAG_QUERIES.get(engine.dialect.name)
+        if query is None:
+            return True
+
+        now = time.monotonic()
+        checked_at, is_fresh = self._lag_checks.get(index, (None, True))
+        if checked_at is not None and now - checked_at < self.check_interval:
+            return is_fresh
+
+        with engine.connect() as conn:
+            lag = float(conn.exec_driver_sql(query).scalar())
+        is_fresh = lag <= self.max_lag
+        if not is_fresh:
+            get_logger().warning(f"Replica {engine.url!r} is {lag:.1f}s behind, skipping it")
+        self._lag_checks[index] = (now, is_fresh)
+        return is_fresh
+
+    def candidates(self) -> typing.Iterator[tuple[int | None, sqlalchemy.engine.Engine]]:
+        """
+        Yields usable engines in preference order.
+
+        :return: (replica index, engine) pairs, the primary comes last with a None index
+        """
+        if self._next is not None:
+            with self._lock:
+                start = next(self._next)
+            now = time.monotonic()
+            for offset in range(len(self.replicas)):
+                index = (start + offset) % len(self.replicas)
+                if self._unavailable_until.get(index, 0) > now:
+                    continue
+                try:
+                    is_fresh = self._is_fresh(index)
+                except sqlalchemy.exc.DBAPIError as err:
+                    get_logger().error(f"Replica lag check failed: {err}")
+                    self.mark_unavailable(index)
+                    continue
+                if is_fresh:
+                    yield index, self.replicas[index]
+
+        yield None, self.primary
+
+    @contextlib.contextmanager
+    def connect(self) -> typing.Iterator[sqlalchemy.engine.Connection]:
+        """Opens a read connection on the first available engine."""
+        for index, engine in self.candidates():
+            try:
+                conn = engine.connect()
+                break
+            except sqlalchemy.exc.DBAPIError as err:
+                if index is None:
+                    raise
+                get_logger().error(f"Replica connection failed: {err}")
+                self.mark_unavailable(index)
+
+        with conn:
+            yield conn
+
+    def dispose(self, close: bool = True):
+        """Disposes all engines."""
+        for engine in [self.primary, *self.replicas]:
+            engine.dispose(close=close)
@@ -0,0 +1,165 @@
+"""Integer surrogate keys of measurement series"""
+import threading
+import typing
+
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.dialects.sqlite
+import sqlalchemy.engine
+import sqlalchemy.event
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from .db_engine import DataBase
+
+PENDING_KEY = "rain_pending_series"
+INSERTS = {
+    "postgresql": sqlalchemy.dialects.postgresql.insert,
+    "sqlite": sqlalchemy.dialects.sqlite.insert,
+}
+
+
+class SeriesKey(typing.NamedTuple):
+    """Natural key of a series of measurements"""
+
+    sensor_id: str
+    measurement_name: str
+    location_id: str
+
+
+class SeriesCache:
+    """
+    Maps series natural keys to the series_id of d_series, both ways.
+
+    Series rows are never updated, so cached entries never go stale. Series created by a
+    transaction are only cached once it commits, a rolled back series id is never reused.
+    """
+
+    def __init__(self, database: "DataBase"):
+        """
+        Setups an empty cache and follows transactions of the database engine.
+
+        :param database: Database holding d_series
+        """
+        self.database = database
+        self._lock = threading.Lock()
+        self._ids: dict[SeriesKey, int] = {}
+        self._keys: dict[int, SeriesKey] = {}
+
+        sqlalchemy.event.listen(database.engine, "commit", self._on_commit)
+        sqlalchemy.event.listen(database.engine, "rollback", self._on_rollback)
+        sqlalchemy.event.listen(database.engine.pool, "reset", self._on_reset)
+
+    def _add(self, series_id: int, key: SeriesKey):
+        """Caches a committed series."""
+        with self._lock:
+            self._ids[key] = series_id
+            self._keys[series_id] = key
+
+    def _on_commit(self, conn: sqlalchemy.engine.Connection):
+        """Caches the series created by the committed transaction."""
+        for series_id, key in conn.info.pop(PENDING_KEY, ()):
+            self._add(series_id, key)
+
+    def _on_rollback(self, conn: sqlalchemy.engine.Connection):
+        """Forgets the series created by the rolled back transaction."""
+        conn.info.pop(PENDING_KEY, None)
+
+    def _on_reset(self, dbapi_connection, connection_record):
+        """Forgets the series of a transaction rolled back when its connection is released."""
+        connection_record.info.pop(PENDING_KEY, None)
+
+    def _select_id(self, conn: sqlalchemy.engine.Connection, key: SeriesKey) -> int | None:
+        """Reads the id of a series."""
+        series = self.database.series
+        return conn.execute(
+            sqlalchemy.select(series.c.series_id).where(
+                series.c.sensor_id == key.sensor_id,
+                series.c.measurement_name == key.measurement_name,
+                series.c.location_id == key.location_id,
+            ),
+        ).scalar()
+
+    def series_id(
+            self,
+            conn: sqlalchemy.engine.Connection,
+            sensor_id: str,
+            measurement_name: str,
+            location_id: str,
+    ) -> int:
+        """
+        Returns the id of a series, creating it in the connection transaction if needed.
+
+        :param conn: Connection of the transaction writing measurements of the series
+        :param sensor_id: Sensor id
+        :param measurement_name: Measurement type
+        :param location_id: Location of the sensor
+        """
+        key = SeriesKey(sensor_id, measurement_name, location_id)
+        with self._lock:
+            series_id = self._ids.get(key)
+        if series_id is not None:
+            return series_id
+
+        for pending_id, pending_key in conn.info.get(PENDING_KEY, ()):
+            if pending_key == key:
+                return pending_id
+
+        series_id = self._select_id(conn, key)
+        if series_id is not None:
+            self._add(series_id, key)
+            return series_id
+
+        insert = INSERTS.get(conn.dialect.name, sqlalchemy.insert)(self.database.series)
+        if hasattr(insert, "on_conflict_do_nothing"):
+            # Another transaction may create the same series concurrently.
+            insert = insert.on_conflict_do_nothing()
+        conn.execute(insert, key._asdict())
+        series_id = self._select_id(conn, key)
+        conn.info.setdefault(PENDING_KEY, []).append((series_id, key))
+        return series_id
+
+    def keys(
+            self,
+            conn: sqlalchemy.engine.Connection,
+            series_ids: typing.Iterable[int],
+    ) -> dict[int, SeriesKey]:
+        """
+        Returns the natural keys of series, reading unknown series from d_series.
+
+        Series created by the transaction of conn are returned without being cached.
+
+        :param conn: Database connection
+        :param series_ids: Series ids
+        """
+        series_ids = set(series_ids)
+        pending = {
+            series_id: key
+            for series_id, key in conn.info.get(PENDING_KEY, ())
+            if series_id in series_ids
+        }
+        with self._lock:
+            missing = series_ids.difference(self._keys, pending)
+        if missing:
+            series = self.database.series
+            rows = conn.execute(
+                sqlalchemy.select(
+                    series.c.series_id,
+                    series.c.sensor_id,
+                    series.c.measurement_name,
+                    series.c.location_id,
+                ).where(series.c.series_id.in_(missing)),
+            )
+            for row in rows:
+                self._add(
+                    row.series_id,
+                    SeriesKey(row.sensor_id, row.measurement_name, row.location_id),
+                )
+
+        with self._lock:
+            return {
+                **{
+                    series_id: self._keys[series_id]
+                    for series_id in series_ids
+                    if series_id in self._keys
+                },
+                **pending,
+            }
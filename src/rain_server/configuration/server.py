@@ -0,0 +1,127 @@
+"""Reads HTTP server configuration"""
+import os
+import os.path
+import threading
+
+from .paths import CONFIG_PATH
+from .snapshot import ConfigSnapshot, ConfigSource
+
+SERVER_DEFAULTS = {
+    "host": "127.0.0.1",
+    "port": 8000,
+    "workers": os.cpu_count() or 1,
+    "threads": 16,
+    "backlog": 2048,
+    "keep_alive": 5,
+    "graceful_timeout": 30,
+    "session_ttl": 3600,
+    "session_store_size": 10000,
+    "session_replay_window": 300,
+    "batch_max_operations": 32,
+    "batch_threads": 8,
+    "stream_chunk_size": 1000,
+    "query_time_granularity": 0,
+    "profile_sample_rate": 0.0,
+    "profile_interval": 0.005,
+    "profile_max_files": 100,
+    "journal_segment_bytes": 64 * 1024 * 1024,
+    "journal_sync_delay": 0.0,
+    "journal_batch_size": 1000,
+    "journal_replay_interval": 1.0,
+    "journal_retry_interval": 5.0,
+}
+
+
+def get_server_config() -> ConfigSnapshot:
+    """
+    Reads HTTP server configuration from configuration.
+
+    Environment variable must start with RAIN_SERVER_ and be upper case.
+    Configuration file is stored in the default configuration path and name server.json.
+    Values are loaded once and reloaded when the file changes, see ConfigSource.
+
+    Valid parameters are:
+    - host: Address to listen to. Default is 127.0.0.1.
+    - port: Port to listen to. Default is 8000.
+    - workers: Number of pre-forked worker processes. Default is the number of CPUs.
+    - threads: Number of concurrent requests per worker. Default is 16.
+    - backlog: Listen queue size of the server socket. Default is 2048.
+    - keep_alive: Idle time in seconds before closing a keep-alive connection. Default is 5.
+    - graceful_timeout: Time in seconds given to workers to finish in-flight requests on
+    shutdown before they are killed. Default is 30.
+    - session_secret: Base64 secret signing sensor session tokens, shared by all servers.
+    Default is a random secret per server.
+    - session_ttl: Sensor session lifetime in seconds. Default is 3600.
+    - session_store_size: Maximum number of sessions cached per worker. Default is 10000.
+    - session_replay_window: Maximum difference in seconds between the date of a reading
+    authenticated by a session and the server time. A captured reading can be replayed
+    within this window. Default is 300.
+    - batch_max_operations: Maximum number of GraphQL operations in a batch request.
+    Default is 32.
+    - batch_threads: Number of threads executing the operations of batch requests,
+    shared by all requests of a worker. Default is 8.
+    - rate_limit_global_rate, rate_limit_global_burst: Measurements per second accepted from
+    all sensors together and burst size. Unlimited by default.
+    - rate_limit_sensor_rate, rate_limit_sensor_burst: Measurements per second accepted from
+    each sensor and burst size. Unlimited by default.
+    - rate_limit_sensors: Per sensor overrides, as {sensor_id: {"rate": r, "burst": b}}.
+    - rate_limit_measurements: Per sensor limits of specific measurement types,
+    as {measurement_name: {"rate": r, "burst": b}}.
+    - stream_chunk_size: Number of measurements read and encoded at once by the streamed
+    /measurements endpoint. Default is 1000.
+    - query_time_granularity: Precision in seconds of the current time in queries relative to
+    it ("NOW", "TODAY", "-nP"). Such queries get the same window until the next multiple of
+    the granularity and leave out the measurements received since. Default is 0 (exact).
+    - profile_sample_rate: Fraction of GraphQL operations profiled, between 0 and 1.
+    Default is 0 (disabled).
+    - profile_token: Secret of the X-Rain-Profile request header forcing profiling of an
+    operation. Default is None (header ignored).
+    - profile_interval: Delay in seconds between two stack samples of a profiled operation.
+    Default is 0.005.
+    - profile_directory: Directory of the profiles, in folded stacks format for flame graphs.
+    Default is rain_profiles in the temporary directory.
+    - profile_max_files: Number of profiles kept in the directory. Default is 100.
+    - journal_directory: Directory of the ingest journal. When set, verified measurements are
+    acknowledged once written to the journal and replayed into the database in the
+    background. Default is None (measurements are written to the database directly).
+    - journal_node: Name of the server in s_journal_offsets, unique among servers sharing the
+    database. Default is the host name.
+    - journal_segment_bytes: Size of a journal segment file. Default is 64 MiB.
+    - journal_sync_delay: Delay in seconds before each fsync of the journal, trading latency
+    for larger batches. Default is 0.
+    - journal_batch_size: Maximum number of measurements replayed per transaction.
+    Default is 1000.
+    - journal_replay_interval: Maximum delay in seconds before replaying new measurements.
+    Default is 1.
+    - journal_retry_interval: Delay in seconds before retrying a failed replay. Default is 5.
+
+    Changes to session_replay_window, stream_chunk_size, query_time_granularity, the rate
+    limits and the profiling
+    settings apply without restart, other changes need a restart.
+
+    Priority is:
+    1. Environment variables
+    2. Configuration file
+    3. Default configuration
+
+    :return: Current configuration snapshot
+    """
+    return get_server_config_source().snapshot()
+
+
+_server_config_source: ConfigSource | None = None
+_server_config_source_lock = threading.Lock()
+
+
+def get_server_config_source() -> ConfigSource:
+    """Returns the process HTTP server configuration source."""
+    global _server_config_source
+
+    with _server_config_source_lock:
+        if _server_config_source is None:
+            _server_config_source = ConfigSource(
+                os.path.join(CONFIG_PATH, "server.json"),
+                "RAIN_SERVER",
+                SERVER_DEFAULTS,
+            )
+        return _server_config_source
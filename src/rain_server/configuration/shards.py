@@ -0,0 +1,132 @@
+"""Spreads measurements across several databases by sensor"""
+import bisect
+import concurrent.futures
+import hashlib
+import typing
+
+import sqlalchemy.engine
+
+T = typing.TypeVar("T")
+R = typing.TypeVar("R")
+
+
+def ring_hash(value: str) -> int:
+    """Position of a value on the hash ring, stable across processes and versions."""
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to shards.
+
+    Each shard is placed at virtual_nodes points of the ring, a key belongs to the shard of
+    the first point after its hash. Adding a shard only moves the keys it takes over from
+    the others.
+    """
+
+    def __init__(self, names: typing.Sequence[str], virtual_nodes: int = 64):
+        """
+        Setups the ring.
+
+        :param names: Stable names of the shards, their index is returned by owner()
+        :param virtual_nodes: Number of points per shard, more points spread keys more evenly
+        """
+        if not names:
+            raise ValueError("At least one shard is required.")
+        points = sorted(
+            (ring_hash(f"{name}#{i}"), index)
+            for index, name in enumerate(names)
+            for i in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [index for _, index in points]
+
+    def owner(self, key: str) -> int:
+        """Index of the shard owning a key."""
+        position = bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)
+        return self._owners[position]
+
+
+class ShardSet:
+    """
+    Measurement shards, each holding d_measurements for the sensors it owns.
+
+    Sensors are assigned to shards by consistent hashing of sensor_id, so all measurements
+    of a series live in the same shard. Other tables stay in the primary database.
+    """
+
+    def __init__(
+            self,
+            engines: typing.Sequence[sqlalchemy.engine.Engine],
+            *,
+            names: typing.Sequence[str] | None = None,
+            virtual_nodes: int = 64,
+            max_workers: int = 8,
+    ):
+        """
+        Setups the shard set.
+
+        :param engines: Shard engines
+        :param names: Stable names of the shards on the hash ring, their index by default.
+        Renaming or reordering shards moves sensors to other shards.
+        :param virtual_nodes: Number of points per shard on the hash ring
+        :param max_workers: Number of threads querying shards concurrently
+        """
+        self.engines = list(engines)
+        self.ring = HashRing(
+            names if names is not None else [str(i) for i in range(len(self.engines))],
+            virtual_nodes,
+        )
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="shards",
+        )
+
+    def shard(self, sensor_id: str) -> int:
+        """Index of the shard holding the measurements of a sensor."""
+        return self.ring.owner(sensor_id)
+
+    def partition(self, items: typing.Iterable[tuple[str, T]]) -> dict[int, list[T]]:
+        """
+        Groups items by shard.
+
+        :param items: (sensor_id, item) pairs
+        :return: Items by shard index
+        """
+        groups: dict[int, list[T]] = {}
+        for sensor_id, item in items:
+            groups.setdefault(self.shard(sensor_id), []).append(item)
+        return groups
+
+    def scatter(
+            self,
+            function: typing.Callable[[sqlalchemy.engine.Engine, T], R],
+            work: dict[int, T],
+    ) -> list[R]:
+        """
+        Calls a function for several shards concurrently.
+
+        :param function: Called with the engine of a shard and its work
+        :param work: Work by shard index
+        :return: Results in shard order, the first error is raised once all calls ended
+        """
+        if len(work) == 1:
+            (index, item), = work.items()
+            return [function(self.engines[index], item)]
+
+        futures = [
+            self._executor.submit(function, self.engines[index], work[index])
+            for index in sorted(work)
+        ]
+        concurrent.futures.wait(futures)
+        return [future.result() for future in futures]
+
+    def dispose(self, close: bool = True):
+        """
+        Disposes the shard engines.
+
+        :param close: Close pooled connections, use False in forked processes
+        """
+        for engine in self.engines:
+            engine.dispose(close=close)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,205 @@
+"""Quantile sketches of measurements per series and time bucket"""
+import contextlib
+import datetime
+import typing
+
+import sqlalchemy.engine
+
+from ..aggregation import QuantileSketch
+from .series import INSERTS
+
+if typing.TYPE_CHECKING:  # pragma: no cover
+    from .db_engine import DataBase
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class SketchStore:
+    """
+    Maintains a quantile sketch per series and aligned time bucket in d_measurement_sketches.
+
+    Sketches are updated in the transaction inserting the measurements, so they count every
+    measurement ever written: deleting or downsampling old measurements keeps their sketches.
+    """
+
+    def __init__(
+            self,
+            database: "DataBase",
+            *,
+            bucket: datetime.timedelta = datetime.timedelta(hours=1),
+            relative_accuracy: float = 0.01,
+    ):
+        """
+        Setups the store.
+
+        :param database: Database holding the sketches
+        :param bucket: Time range summarized by a sketch
+        :param relative_accuracy: Relative error of the quantiles of new sketches
+        """
+        self.database = database
+        self.bucket = bucket
+        self.relative_accuracy = relative_accuracy
+
+    def align(self, value: datetime.datetime) -> datetime.datetime:
+        """Start of the bucket holding a date."""
+        return EPOCH + ((value - EPOCH) // self.bucket) * self.bucket
+
+    def build(self, rows: typing.Iterable) -> dict[tuple[int, datetime.datetime], QuantileSketch]:
+        """
+        Summarizes measurement rows.
+
+        :param rows: d_measurements rows, as mappings
+        :return: Sketches by series and bucket
+        """
+        sketches: dict[tuple[int, datetime.datetime], QuantileSketch] = {}
+        for row in rows:
+            key = (row["series_id"], self.align(row["measurement_datetime"]))
+            sketch = sketches.get(key)
+            if sketch is None:
+                sketch = sketches[key] = QuantileSketch(self.relative_accuracy)
+            sketch.add(row["measurement_value"])
+        return sketches
+
+    def _merge_stored(self, conn: sqlalchemy.engine.Connection,
+                      key: tuple[int, datetime.datetime], sketch: QuantileSketch):
+        """Merges a sketch into the stored sketch of its bucket, creating it if needed."""
+        table = self.database.measurement_sketches
+        values = {
+            "series_id": key[0],
+            "bucket_start": key[1],
+            "sketch": sketch.to_json(),
+            "d_updated_date_utc": datetime.datetime.utcnow(),
+        }
+        insert = INSERTS.get(conn.dialect.name)
+        where = sqlalchemy.and_(table.c.series_id == key[0], table.c.bucket_start == key[1])
+        if insert is not None:
+            # Concurrent transactions can not both create the row of a bucket.
+            if conn.execute(insert(table).on_conflict_do_nothing(), values).rowcount:
+                return
+        stored = conn.execute(
+            sqlalchemy.select(table.c.sketch).where(where).with_for_update(),
+        ).scalar()
+        if stored is None:
+            conn.execute(table.insert(), values)
+            return
+        values["sketch"] = QuantileSketch.from_json(stored).merge(sketch).to_json()
+        conn.execute(table.update().where(where).values(
+            sketch=values["sketch"],
+            d_updated_date_utc=values["d_updated_date_utc"],
+        ))
+
+    def update(self, conn: sqlalchemy.engine.Connection, rows: list[dict]):
+        """
+        Adds inserted measurements to the sketches of their buckets.
+
+        :param conn: Connection of the transaction inserting the measurements
+        :param rows: Inserted d_measurements rows
+        """
+        for key, sketch in sorted(self.build(rows).items()):
+            # Buckets are locked in a stable order, so concurrent writers never deadlock.
+            self._merge_stored(conn, key, sketch)
+
+    def backfill(self, conn: sqlalchemy.engine.Connection):
+        """
+        Builds the sketches of all stored measurements.
+
+        :param conn: Connection of the transaction creating d_measurement_sketches
+        """
+        measurements = self.database.measurements
+        query = sqlalchemy.select(
+            measurements.c.series_id,
+            measurements.c.measurement_datetime,
+            measurements.c.measurement_value,
+        ).where(
+            measurements.c.measurement_value.is_not(None),
+        ).order_by(measurements.c.series_id, measurements.c.measurement_datetime)
+
+        with contextlib.ExitStack() as stack:
+            if self.database.shards is None:
+                sources = [conn]
+            else:
+                sources = [
+                    stack.enter_context(shard.connect())
+                    for shard in self.database.shards.engines
+                ]
+
+            for source in sources:
+                batch: list[dict] = []
+                for row in source.execute(query).mappings():
+                    if batch and (
+                            batch[-1]["series_id"] != row["series_id"]
+                            or self.align(batch[-1]["measurement_datetime"])  # noqa
+                            != self.align(row["measurement_datetime"])  # noqa
+                    ):
+                        self.update(conn, batch)
+                        batch = []
+                    batch.append(dict(row))
+                self.update(conn, batch)
+
+    def _raw(self, conn: sqlalchemy.engine.Connection, series_ids: typing.Collection[int],
+             start: datetime.datetime, end: datetime.datetime, sketch: QuantileSketch,
+             include_end: bool):
+        """Adds raw measurements of [start, end) or [start, end] to a sketch."""
+        measurements = self.database.measurements
+        if include_end:
+            before_end = measurements.c.measurement_datetime <= end
+        else:
+            before_end = measurements.c.measurement_datetime < end
+
+        def read(shard_conn: sqlalchemy.engine.Connection, shard_series_ids: list[int]):
+            return shard_conn.execute(
+                sqlalchemy.select(measurements.c.measurement_value).where(
+                    measurements.c.series_id.in_(shard_series_ids),
+                    measurements.c.measurement_datetime >= start,
+                    before_end,
+                    measurements.c.measurement_value.is_not(None),
+                ),
+            ).scalars().all()
+
+        for values in self.database.scatter_measurements(conn, series_ids, read):
+            for value in values:
+                sketch.add(value)
+
+    def merged(
+            self,
+            conn: sqlalchemy.engine.Connection,
+            series_ids: typing.Collection[int],
+            start: datetime.datetime,
+            end: datetime.datetime,
+    ) -> QuantileSketch:
+        """
+        Merges the sketches of series over a time range.
+
+        Buckets entirely in the range are read from their sketches, measurements of the
+        partial buckets at both ends are read from d_measurements.
+
+        :param conn: Database connection
+        :param series_ids: Series ids
+        :param start: Measurements from this date (included)
+        :param end: Measurements until this date (included)
+        """
+        sketch = QuantileSketch(self.relative_accuracy)
+        if not series_ids:
+            return sketch
+
+        first_full = self.align(start)
+        if first_full < start:
+            first_full += self.bucket
+        last_full = self.align(end)
+        if first_full >= last_full:
+            self._raw(conn, series_ids, start, end, sketch, include_end=True)
+            return sketch
+
+        self._raw(conn, series_ids, start, first_full, sketch, include_end=False)
+        table = self.database.measurement_sketches
+        stored = conn.execute(
+            sqlalchemy.select(table.c.sketch).where(
+                table.c.series_id.in_(series_ids),
+                table.c.bucket_start >= first_full,
+                table.c.bucket_start < last_full,
+            ),
+        ).scalars()
+        for value in stored:
+            sketch.merge(QuantileSketch.from_json(value))
+        self._raw(conn, series_ids, last_full, end, sketch, include_end=True)
+        return sketch
@@ -0,0 +1,155 @@
+"""Configuration snapshots reloaded when their file changes"""
+import json
+import os
+import threading
+import time
+import typing
+
+import config
+
+from .logger import get_logger
+
+POLL_INTERVAL = 2.0
+
+
+class ConfigSnapshot(config.Configuration):
+    """Read only configuration values, as loaded at a point in time"""
+
+    def _read_only(self, *args, **kwargs):
+        """Rejects changes, a new snapshot is loaded instead."""
+        raise TypeError("Configuration snapshots are read only.")
+
+    __setitem__ = __delitem__ = _read_only
+    update = setdefault = pop = clear = reload = _read_only
+
+
+Subscriber = typing.Callable[[ConfigSnapshot, ConfigSnapshot], None]
+
+
+class ConfigSource:
+    """
+    Configuration read from environment variables, a JSON file and defaults, in that priority.
+
+    Values are loaded once into a ConfigSnapshot. When the snapshot is read, the modification
+    time and size of the file are checked at most every poll_interval seconds. A changed
+    file is loaded into a new snapshot, swapped in atomically, and subscribers are called
+    with the previous and new snapshots. A file that can not be parsed is ignored until it
+    changes again, the previous snapshot stays in use.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            prefix: str,
+            defaults: dict,
+            *,
+            poll_interval: float = POLL_INTERVAL,
+            clock: typing.Callable[[], float] = time.monotonic,
+    ):
+        """
+        Setups the source, the configuration is loaded on first read.
+
+        :param path: JSON configuration file, may not exist
+        :param prefix: Prefix of the environment variables
+        :param defaults: Default values
+        :param poll_interval: Minimum delay in seconds between two checks of the file
+        :param clock: Monotonic clock
+        """
+        self.path = path
+        self.prefix = prefix
+        self.defaults = defaults
+        self.poll_interval = poll_interval
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._snapshot: ConfigSnapshot | None = None
+        self._stat: tuple[int, int] | None = None
+        self._checked_at = 0.0
+        self._subscribers: list[Subscriber] = []
+        # Subscribers see reloads one at a time, in order.
+        self._notify_lock = threading.Lock()
+
+    def _file_stat(self) -> tuple[int, int] | None:
+        """Modification time and size of the file, None if it does not exist"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self) -> ConfigSnapshot:
+        """Reads all sources into a snapshot."""
+        try:
+            with open(self.path, "r") as fp:
+                json_file = fp.read()
+        except FileNotFoundError:
+            # Ignores the configuration if the file do not exist.
+            json_file = "{}"
+
+        return ConfigSnapshot(config.ConfigurationSet(
+            config.config_from_env(prefix=self.prefix),
+            config.config_from_json(json_file, read_from_file=False),
+            config.config_from_dict(self.defaults),
+        ).as_dict())
+
+    def snapshot(self) -> ConfigSnapshot:
+        """Returns the current snapshot, reloading it first if the file changed."""
+        snapshot = self._snapshot
+        if snapshot is None or self.clock() - self._checked_at >= self.poll_interval:
+            self.poll()
+            snapshot = self._snapshot
+        return snapshot
+
+    def poll(self) -> bool:
+        """
+        Reloads the configuration if the file changed.
+
+        :return: True if a new snapshot was swapped in
+        """
+        with self._lock:
+            self._checked_at = self.clock()
+            stat = self._file_stat()
+            if self._snapshot is not None and stat == self._stat:
+                return False
+
+            previous = self._snapshot
+            try:
+                snapshot = self._load()
+            except json.JSONDecodeError:
+                if previous is None:
+                    raise
+                get_logger().exception(f"Invalid configuration file {self.path}, ignored")
+                self._stat = stat
+                return False
+            self._snapshot, self._stat = snapshot, stat
+            subscribers = list(self._subscribers)
+
+        if previous is not None:
+            get_logger().info(f"Configuration file {self.path} reloaded")
+            with self._notify_lock:
+                for subscriber in subscribers:
+                    try:
+                        subscriber(previous, snapshot)
+                    except Exception:
+                        get_logger().exception(f"Failed to apply configuration of {self.path}")
+        return True
+
+    def subscribe(self, subscriber: Subscriber):
+        """
+        Calls a function with the previous and new snapshots when the configuration changes.
+
+        :param subscriber: Function called in the thread detecting the change
+        """
+        with self._lock:
+            self._subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """Stops calling a subscriber."""
+        with self._lock:
+            self._subscribers.remove(subscriber)
+
+
+def changed_keys(previous: ConfigSnapshot, current: ConfigSnapshot) -> set[str]:
+    """Keys added, removed or changed between two snapshots."""
+    before, after = previous.as_dict(), current.as_dict()
+    return {key for key in before.keys() | after.keys() if before.get(key) != after.get(key)}
@@ -0,0 +1,59 @@
+"""SQLite specific engine setup"""
+import config
+import sqlalchemy.engine
+import sqlalchemy.event
+import sqlalchemy.pool
+
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+
+def is_file_database(url: sqlalchemy.engine.URL) -> bool:
+    """Checks if the URL is a file backed SQLite database"""
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def get_sqlite_engine_options(url: sqlalchemy.engine.URL) -> dict:
+    """
+    Engine options for SQLite databases.
+
+    File backed databases use a connection pool shared across threads, so pragmas are
+    applied once per connection instead of once per checkout.
+    """
+    if not is_file_database(url):
+        return {}
+
+    return {
+        "poolclass": sqlalchemy.pool.QueuePool,
+        "connect_args": {"check_same_thread": False},
+    }
+
+
+def get_sqlite_pragmas(cfg: config.ConfigurationSet) -> list[tuple[str, str]]:
+    """Reads and validates pragmas from configuration"""
+    journal_mode = str(cfg.get("journal_mode")).upper()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"Invalid SQLite journal_mode: {journal_mode}")
+    synchronous = str(cfg.get("synchronous")).upper()
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Invalid SQLite synchronous: {synchronous}")
+
+    return [
+        ("busy_timeout", str(cfg.get_int("busy_timeout"))),
+        ("journal_mode", journal_mode),
+        ("synchronous", synchronous),
+        ("mmap_size", str(cfg.get_int("mmap_size"))),
+        ("cache_size", str(cfg.get_int("cache_size"))),
+    ]
+
+
+def install_sqlite_pragmas(engine: sqlalchemy.engine.Engine, cfg: config.ConfigurationSet):
+    """Applies configured pragmas on every new connection of the engine"""
+    pragmas = get_sqlite_pragmas(cfg)
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
@@ -0,0 +1,17 @@
+"""Measurement ingestion"""
+__all__ = [
+    "IngestRecord",
+    "Journal",
+    "JournalRecord",
+    "RateLimiter",
+    "TokenBucket",
+    "get_journal",
+    "get_rate_limiter",
+    "parse_line_protocol",
+    "parse_msgpack",
+    "reset_journal",
+]
+
+from .journal import Journal, JournalRecord, get_journal, reset_journal
+from .protocols import IngestRecord, parse_line_protocol, parse_msgpack
+from .rate_limit import RateLimiter, TokenBucket, get_rate_limiter
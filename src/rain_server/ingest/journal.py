@@ -0,0 +1,763 @@
+"""Durable local journal of verified measurements, replayed into the database."""
+import datetime
+import fcntl
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import typing
+import zlib
+
+import sqlalchemy
+
+from ..configuration import get_database, get_logger, get_server_config
+from ..configuration.db_engine import DataBase
+from ..monitoring.instruments import (JOURNAL_LAG_BYTES, JOURNAL_LAG_SECONDS,
+                                      JOURNAL_RECORDS, JOURNAL_SYNC_SECONDS)
+
+# Length and CRC32 of the payload.
+FRAME_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".seg"
+LOCK_FILE = "LOCK"
+QUARANTINE_FILE = "quarantine"
+# Bytes read from a segment at once by the replay.
+READ_BYTES = 256 * 1024
+SLOT_PREFIX = "slot-"
+
+
+class JournalRecord(typing.NamedTuple):
+    """Verified measurement waiting to be written to d_measurements"""
+
+    sensor_id: str
+    measurement_name: str
+    location_id: str
+    measurement_date: datetime.datetime
+    measurement_value: float
+    journaled_at: float
+
+
+class JournalPosition(typing.NamedTuple):
+    """Position in a journal, the offset of a frame in a segment"""
+
+    segment: int
+    offset: int
+
+
+def encode_record(record: JournalRecord) -> bytes:
+    """Encodes a record as a frame."""
+    payload = json.dumps([
+        record.sensor_id,
+        record.measurement_name,
+        record.location_id,
+        record.measurement_date.isoformat(),
+        record.measurement_value,
+        record.journaled_at,
+    ], separators=(",", ":")).encode("utf-8")
+    return FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def frame_payloads(
+        data: bytes,
+        max_frames: int | None = None,
+) -> typing.Iterator[tuple[bytes, int]]:
+    """
+    Yields the payloads of the complete and valid frames at the start of data.
+
+    :param data: Frames
+    :param max_frames: Maximum number of frames read
+    :return: Payloads with the offset after their frame
+    """
+    offset = 0
+    count = 0
+    while offset + FRAME_HEADER.size <= len(data) and count != max_frames:
+        length, crc = FRAME_HEADER.unpack_from(data, offset)
+        payload = data[offset + FRAME_HEADER.size:offset + FRAME_HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        offset += FRAME_HEADER.size + length
+        count += 1
+        yield payload, offset
+
+
+def decode_frames(
+        data: bytes,
+        max_records: int | None = None,
+) -> tuple[list[JournalRecord], int]:
+    """
+    Decodes the complete and valid frames at the start of data.
+
+    :param data: Frames
+    :param max_records: Maximum number of records decoded
+    :return: The records and the length of the frames they were read from
+    :raise ValueError: A valid frame does not hold a record
+    """
+    records: list[JournalRecord] = []
+    offset = 0
+    for payload, end in frame_payloads(data, max_records):
+        try:
+            (sensor_id, measurement_name, location_id, date, value,
+             journaled_at) = json.loads(payload)
+            records.append(JournalRecord(
+                sensor_id,
+                measurement_name,
+                location_id,
+                datetime.datetime.fromisoformat(date),
+                value,
+                journaled_at,
+            ))
+        except (ValueError, TypeError) as err:
+            raise ValueError(f"Invalid journal record at offset {offset}: {err}") from err
+        offset = end
+    return records, offset
+
+
+def frame_size(data: bytes) -> int:
+    """Size of the frame at the start of data, the header size until it is complete."""
+    if len(data) < FRAME_HEADER.size:
+        return FRAME_HEADER.size
+    return FRAME_HEADER.size + FRAME_HEADER.unpack_from(data)[0]
+
+
+class Journal:
+    """
+    Append-only journal stored as numbered segment files in a directory.
+
+    Records are acknowledged once fsynced. Appenders arriving while an fsync is running
+    wait for it and share the next one, so concurrent requests cost one fsync per batch;
+    sync_delay adds a delay before each fsync to gather larger batches.
+
+    A journal is used by one process at a time, enforced with a lock file. When opened,
+    a torn frame at the end of the last two segments, left by a crash before their fsync,
+    is truncated. Any other invalid frame is corruption of durable records: reading it
+    raises a ValueError instead of skipping the rest of its segment.
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            *,
+            segment_bytes: int = 64 * 1024 * 1024,
+            sync_delay: float = 0.0,
+    ):
+        """
+        Setups the journal, open() must be called before use.
+
+        :param directory: Directory of the segments, created if needed
+        :param segment_bytes: Size in bytes after which a new segment is started
+        :param sync_delay: Delay in seconds before an fsync, gathering more records
+        """
+        self.directory = directory
+        self.name = os.path.basename(os.path.normpath(directory))
+        self.segment_bytes = segment_bytes
+        self.sync_delay = sync_delay
+
+        self._lock_fd: int | None = None
+        self._file: typing.BinaryIO | None = None
+        # Segment being replayed, kept open between reads.
+        self._reader: tuple[int, typing.BinaryIO] | None = None
+        self._unsynced_files: list[typing.BinaryIO] = []
+        self._end = self._synced_end = JournalPosition(0, 0)
+        self._written = 0
+        self._synced = 0
+        self._write_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._appended = threading.Event()
+
+    def _path(self, segment: int) -> str:
+        """Path of a segment file"""
+        return os.path.join(self.directory, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> list[int]:
+        """Numbers of the segment files, oldest first."""
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def open(self, blocking: bool = True) -> bool:
+        """
+        Locks the journal and opens its last segment for writing.
+
+        :param blocking: Wait for the process using the journal to close it
+        :return: False if the journal is used by another process and blocking is False
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+
+        segments = self.segments() or [1]
+        # Records of the previous segment are synced with the first ones of the last.
+        for segment in segments[-2:]:
+            valid = self._truncate_torn(segment)
+        self._file = open(self._path(segment), "ab")
+        self._end = self._synced_end = JournalPosition(segment, valid)
+        return True
+
+    def _truncate_torn(self, segment: int) -> int:
+        """
+        Truncates a segment after its last valid frame.
+
+        :return: Size of the segment
+        """
+        with open(self._path(segment), "ab+") as fp:
+            fp.seek(0)
+            valid = 0
+            for _, valid in frame_payloads(fp.read()):
+                pass
+            if fp.tell() != valid:
+                get_logger().warning(
+                    f"Truncating torn journal record at {self._path(segment)}:{valid}",
+                )
+                fp.truncate(valid)
+                os.fsync(fp.fileno())
+        return valid
+
+    def close(self):
+        """Syncs and closes the journal, releasing its lock."""
+        if self._file is None:
+            return
+        self._sync(self._written)
+        self._file.close()
+        self._file = None
+        self._close_reader()
+        os.close(self._lock_fd)
+        self._lock_fd = None
+
+    @property
+    def end(self) -> JournalPosition:
+        """Position after the last durable record"""
+        return self._synced_end
+
+    def append(self, records: list[JournalRecord]) -> JournalPosition:
+        """
+        Writes records and waits until they are durable.
+
+        :param records: Records to write
+        :return: Position after the records
+        """
+        data = b"".join(encode_record(record) for record in records)
+        with self._write_lock:
+            if self._end.offset and self._end.offset + len(data) > self.segment_bytes:
+                self._roll()
+            self._file.write(data)
+            self._file.flush()
+            self._end = JournalPosition(self._end.segment, self._end.offset + len(data))
+            self._written += 1
+            sequence, end = self._written, self._end
+
+        self._sync(sequence)
+        JOURNAL_RECORDS.inc(len(records), operation="appended")
+        self.notify()
+        return end
+
+    def _roll(self):
+        """Starts a new segment, the previous one is synced and closed by the next fsync."""
+        self._unsynced_files.append(self._file)
+        segment = self._end.segment + 1
+        self._file = open(self._path(segment), "ab")
+        self._end = JournalPosition(segment, 0)
+
+    def _sync(self, sequence: int):
+        """Fsyncs the journal unless an fsync started after the write of sequence did."""
+        with self._sync_lock:
+            if self._synced >= sequence:
+                return
+            if self.sync_delay:
+                time.sleep(self.sync_delay)
+
+            with self._write_lock:
+                target, end = self._written, self._end
+                files, self._unsynced_files = self._unsynced_files, []
+                current = self._file
+
+            with JOURNAL_SYNC_SECONDS.time(journal=self.name):
+                for fp in files:
+                    os.fsync(fp.fileno())
+                    fp.close()
+                os.fsync(current.fileno())
+                if files:
+                    # Makes the new segment files durable.
+                    dir_fd = os.open(self.directory, os.O_RDONLY)
+                    try:
+                        os.fsync(dir_fd)
+                    finally:
+                        os.close(dir_fd)
+            self._synced, self._synced_end = target, end
+
+    def read(
+            self,
+            position: JournalPosition,
+            max_records: int,
+    ) -> tuple[list[JournalRecord], JournalPosition]:
+        """
+        Reads records written after a position.
+
+        A position before the first segment starts at the first segment. A position after
+        the end of the journal, left by a journal that was deleted, starts over from the
+        first segment. Segments are read READ_BYTES at a time, more for larger records.
+
+        :param position: Position of the first record
+        :param max_records: Maximum number of records returned
+        :return: The records and the position after them
+        :raise ValueError: The next frame is corrupted or does not hold a record
+        """
+        start = position
+        for start, limit in self._segment_ranges(position):
+            records, length = self._read_records(start, limit, max_records)
+            if records:
+                return records, JournalPosition(start.segment, start.offset + length)
+        return [], start
+
+    def _read_records(
+            self,
+            start: JournalPosition,
+            limit: int,
+            max_records: int,
+    ) -> tuple[list[JournalRecord], int]:
+        """
+        Decodes the records of a segment from a position.
+
+        :param start: Position of the first record
+        :param limit: Durable size of the segment
+        :param max_records: Maximum number of records decoded
+        :return: The records and the length of their frames
+        """
+        records: list[JournalRecord] = []
+        data = b""
+        length = 0
+        while True:
+            decoded, used = decode_frames(data, max_records - len(records))
+            records.extend(decoded)
+            data = data[used:]
+            length += used
+            loaded = start.offset + length + len(data)
+            size = frame_size(data)
+            if len(records) == max_records or not data and loaded == limit:
+                break
+            if size <= len(data) or start.offset + length + size > limit:
+                # Invalid frame, raised by the next read when records were decoded.
+                if records:
+                    break
+                raise ValueError(
+                    f"Corrupted journal frame at {start.segment}:{start.offset + length}",
+                )
+            chunk = self._read_at(
+                JournalPosition(start.segment, loaded),
+                min(max(READ_BYTES, size - len(data)), limit - loaded),
+            )
+            if not chunk:
+                raise ValueError(f"Journal segment {start.segment} is shorter than expected")
+            data += chunk
+        return records, length
+
+    def skip(self, position: JournalPosition) -> tuple[bytes | None, JournalPosition]:
+        """
+        Reads the frame at a position without decoding its record.
+
+        :param position: Position of the frame
+        :return: The frame, None at the end of the journal, and the position after it
+        :raise ValueError: The length of the frame is corrupted, the next frame is unknown
+        """
+        for start, limit in self._segment_ranges(position):
+            if start.offset == limit:
+                continue
+            frame = self._read_at(start, FRAME_HEADER.size)
+            size = frame_size(frame)
+            if len(frame) < FRAME_HEADER.size or start.offset + size > limit:
+                raise ValueError(f"Corrupted journal frame length at {start}")
+            frame += self._read_at(
+                JournalPosition(start.segment, start.offset + len(frame)),
+                size - len(frame),
+            )
+            return frame, JournalPosition(start.segment, start.offset + size)
+        return None, position
+
+    def _segment_ranges(
+            self,
+            position: JournalPosition,
+    ) -> typing.Iterator[tuple[JournalPosition, int]]:
+        """Yields the position to read each segment from, with its durable size."""
+        end = self._synced_end
+        if position > end:
+            get_logger().warning(f"Journal {self.directory} is behind {position}, replaying it")
+            position = JournalPosition(0, 0)
+
+        for segment in self.segments():
+            if not position.segment <= segment <= end.segment:
+                continue
+            if segment != position.segment:
+                position = JournalPosition(segment, 0)
+            if segment == end.segment:
+                yield position, end.offset
+            else:
+                yield position, os.path.getsize(self._path(segment))
+
+    def _read_at(self, position: JournalPosition, size: int) -> bytes:
+        """Reads data of a segment, keeping the segment open for the next reads."""
+        if self._reader is None or self._reader[0] != position.segment:
+            self._close_reader()
+            self._reader = position.segment, open(self._path(position.segment), "rb")
+        fp = self._reader[1]
+        fp.seek(position.offset)
+        return fp.read(size)
+
+    def _close_reader(self):
+        """Closes the segment being replayed."""
+        if self._reader is not None:
+            self._reader[1].close()
+            self._reader = None
+
+    def lag_bytes(self, position: JournalPosition) -> int:
+        """Size of the records written after a position."""
+        end = self._synced_end
+        if position >= end:
+            return 0
+        total = 0
+        for segment in self.segments():
+            if position.segment <= segment < end.segment:
+                total += os.path.getsize(self._path(segment))
+        return total + end.offset - position.offset
+
+    def release(self, position: JournalPosition):
+        """Deletes the segments before the one of a position, they were replayed."""
+        for segment in self.segments():
+            if segment >= min(position.segment, self._synced_end.segment):
+                break
+            if self._reader is not None and self._reader[0] == segment:
+                self._close_reader()
+            os.remove(self._path(segment))
+
+    def notify(self):
+        """Wakes up the callers of wait()."""
+        self._appended.set()
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Waits for records to be appended.
+
+        :return: True if records were appended since the last call
+        """
+        appended = self._appended.wait(timeout)
+        self._appended.clear()
+        return appended
+
+
+class JournalReplayer(threading.Thread):
+    """
+    Writes journaled measurements to d_measurements in batches.
+
+    The position reached in each journal is stored in s_journal_offsets in the
+    transaction inserting the measurements. Without shards, each record is written exactly
+    once. With shards, the rows are committed in their shards before that transaction, so
+    a crash in between replays the batch again: records are written at least once and may
+    be duplicated in the shards. Segments already replayed are deleted.
+
+    Besides the journal of the process, the replayer drains the journals of other slots
+    it can lock, left by workers that are not running anymore.
+    """
+
+    def __init__(
+            self,
+            database: DataBase,
+            journal: Journal,
+            *,
+            node: str,
+            batch_size: int = 1000,
+            interval: float = 1.0,
+            retry_interval: float = 5.0,
+            orphans: typing.Iterable[Journal] = (),
+    ):
+        """
+        Setups the replayer.
+
+        :param database: Database the measurements are written to
+        :param journal: Journal of the process
+        :param node: Name of the server, journals are identified by node and slot
+        :param batch_size: Maximum number of measurements written per transaction
+        :param interval: Maximum delay in seconds before replaying new records
+        :param retry_interval: Delay in seconds before retrying after a database error
+        :param orphans: Opened journals of other slots, closed once drained
+        """
+        super().__init__(name="journal-replayer", daemon=True)
+        self.database = database
+        self.journal = journal
+        self.node = node
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.orphans = list(orphans)
+        self._positions: dict[str, JournalPosition] = {}
+        self._stop_event = threading.Event()
+
+    def journal_id(self, journal: Journal) -> str:
+        """Identifier of a journal in s_journal_offsets"""
+        return f"{self.node}/{journal.name}"
+
+    def _position(self, conn: sqlalchemy.engine.Connection, journal: Journal) -> JournalPosition:
+        """Reads the replayed position of a journal, once."""
+        journal_id = self.journal_id(journal)
+        if journal_id not in self._positions:
+            offsets = self.database.journal_offsets
+            row = conn.execute(
+                sqlalchemy.select(offsets.c.segment, offsets.c.offset).where(
+                    offsets.c.journal_id == journal_id,
+                ),
+            ).first()
+            self._positions[journal_id] = JournalPosition(*row) if row else JournalPosition(0, 0)
+        return self._positions[journal_id]
+
+    def _save_position(
+            self,
+            conn: sqlalchemy.engine.Connection,
+            journal: Journal,
+            position: JournalPosition,
+    ):
+        """Stores the replayed position of a journal."""
+        offsets = self.database.journal_offsets
+        values = {
+            "segment": position.segment,
+            "offset": position.offset,
+            "d_updated_date_utc": datetime.datetime.utcnow(),
+        }
+        journal_id = self.journal_id(journal)
+        updated = conn.execute(
+            offsets.update().where(offsets.c.journal_id == journal_id).values(**values),
+        ).rowcount
+        if not updated:
+            conn.execute(offsets.insert().values(journal_id=journal_id, **values))
+
+    def replay(self, journal: Journal) -> int:
+        """
+        Writes the next batch of records of a journal.
+
+        When the batch can not be written for another reason than a database error, its
+        records are written one at a time and the failing ones are quarantined.
+
+        :param journal: Journal to replay
+        :return: Number of records written or quarantined
+        """
+        try:
+            return self._replay(journal, self.batch_size)
+        except sqlalchemy.exc.DBAPIError:
+            raise
+        except Exception:
+            get_logger().exception(f"Invalid records in journal {journal.name}")
+
+        count = 0
+        while count < self.batch_size:
+            try:
+                written = self._replay(journal, 1)
+            except sqlalchemy.exc.DBAPIError:
+                raise
+            except Exception:
+                written = self._quarantine(journal)
+            if not written:
+                break
+            count += written
+        return count
+
+    def _replay(self, journal: Journal, max_records: int) -> int:
+        """Writes up to max_records records of a journal in a transaction."""
+        with self.database.engine.begin() as conn:
+            position = self._position(conn, journal)
+            records, end = journal.read(position, max_records)
+            if records:
+                series_cache = self.database.series_cache
+                self.database.insert_measurements(conn, [
+                    {
+                        "series_id": series_cache.series_id(
+                            conn,
+                            record.sensor_id,
+                            record.measurement_name,
+                            record.location_id,
+                        ),
+                        "measurement_datetime": record.measurement_date,
+                        "measurement_value": record.measurement_value,
+                    }
+                    for record in records
+                ])
+            if end != position:
+                self._save_position(conn, journal, end)
+
+        self._advance(journal, end, records)
+        JOURNAL_RECORDS.inc(len(records), operation="replayed")
+        return len(records)
+
+    def _quarantine(self, journal: Journal) -> int:
+        """
+        Moves the next record of a journal to its quarantine file, in the journal format.
+
+        :return: Number of records quarantined
+        """
+        with self.database.engine.begin() as conn:
+            position = self._position(conn, journal)
+            frame, end = journal.skip(position)
+            if frame is None:
+                return 0
+            with open(os.path.join(journal.directory, QUARANTINE_FILE), "ab") as fp:
+                fp.write(frame)
+                fp.flush()
+                os.fsync(fp.fileno())
+            self._save_position(conn, journal, end)
+
+        get_logger().error(f"Quarantined journal record {journal.name}:{position}")
+        self._advance(journal, end)
+        JOURNAL_RECORDS.inc(operation="quarantined")
+        return 1
+
+    def _advance(
+            self,
+            journal: Journal,
+            position: JournalPosition,
+            records: typing.Sequence[JournalRecord] = (),
+    ):
+        """Records the replayed position of a journal once committed."""
+        self._positions[self.journal_id(journal)] = position
+        journal.release(position)
+        self._update_lag(journal, position, records)
+
+    def _update_lag(
+            self,
+            journal: Journal,
+            position: JournalPosition,
+            records: typing.Sequence[JournalRecord],
+    ):
+        """
+        Publishes the records left to replay, in bytes and age.
+
+        The age is the one of the last replayed record, the next ones were journaled after
+        it, so the journal is not read again.
+        """
+        lag_bytes = journal.lag_bytes(position)
+        JOURNAL_LAG_BYTES.set(lag_bytes, journal=journal.name)
+        if not lag_bytes:
+            JOURNAL_LAG_SECONDS.set(0.0, journal=journal.name)
+        elif records:
+            JOURNAL_LAG_SECONDS.set(
+                max(time.time() - records[-1].journaled_at, 0.0),
+                journal=journal.name,
+            )
+
+    def drain(self, journal: Journal):
+        """Replays a journal until it has no more records."""
+        while self.replay(journal) and not self._stop_event.is_set():
+            pass
+
+    def run(self):
+        """Replays the journals until stopped."""
+        while not self._stop_event.is_set():
+            try:
+                while self.orphans:
+                    self.drain(self.orphans[0])
+                    self.orphans.pop(0).close()
+                if self.replay(self.journal) == self.batch_size:
+                    continue
+            except Exception:
+                get_logger().exception("Journal replay failed")
+                self._stop_event.wait(self.retry_interval)
+                continue
+            self.journal.wait(self.interval)
+
+    def stop(self):
+        """Stops the replayer after the current batch."""
+        self._stop_event.set()
+        self.journal.notify()
+
+
+def open_slots(
+        directory: str,
+        **options,
+) -> tuple[Journal, list[Journal]]:
+    """
+    Opens the first journal slot of a directory not used by another process.
+
+    :param directory: Directory holding a subdirectory per slot
+    :param options: Journal options
+    :return: The journal of the process and the other unused slots holding records
+    """
+    os.makedirs(directory, exist_ok=True)
+    journal = None
+    orphans = []
+    names = {name for name in os.listdir(directory) if name.startswith(SLOT_PREFIX)}
+    index = 0
+    while journal is None or f"{SLOT_PREFIX}{index}" in names:
+        slot = Journal(os.path.join(directory, f"{SLOT_PREFIX}{index}"), **options)
+        index += 1
+        if not slot.open(blocking=False):
+            continue
+        if journal is None:
+            journal = slot
+        elif slot.end.offset or len(slot.segments()) > 1:
+            orphans.append(slot)
+        else:
+            slot.close()
+    return journal, orphans
+
+
+_journal: Journal | None = None
+_replayer: JournalReplayer | None = None
+_journal_lock = threading.Lock()
+
+
+def get_journal() -> Journal | None:
+    """
+    Returns the journal of the process, None when journal_directory is not configured.
+
+    The journal and its replayer are started on first call.
+    """
+    global _journal, _replayer
+
+    cfg = get_server_config()
+    if not cfg.get("journal_directory"):
+        return None
+
+    with _journal_lock:
+        if _journal is None:
+            journal, orphans = open_slots(
+                cfg.get_str("journal_directory"),
+                segment_bytes=cfg.get_int("journal_segment_bytes"),
+                sync_delay=cfg.get_float("journal_sync_delay"),
+            )
+            _replayer = JournalReplayer(
+                get_database(),
+                journal,
+                node=cfg.get("journal_node") or socket.gethostname(),
+                batch_size=cfg.get_int("journal_batch_size"),
+                interval=cfg.get_float("journal_replay_interval"),
+                retry_interval=cfg.get_float("journal_retry_interval"),
+                orphans=orphans,
+            )
+            _replayer.start()
+            _journal = journal
+        return _journal
+
+
+def reset_journal(timeout: float | None = None):
+    """
+    Stops the replayer and closes the journal of the process.
+
+    Records not replayed yet stay in the journal, they are replayed by the next process
+    opening it.
+
+    :param timeout: Maximum time in seconds waiting for the current batch
+    """
+    global _journal, _replayer
+
+    with _journal_lock:
+        if _replayer is not None:
+            _replayer.stop()
+            if _replayer.is_alive():
+                _replayer.join(timeout)
+            for orphan in _replayer.orphans:
+                orphan.close()
+        if _journal is not None:
+            _journal.close()
+        _journal = _replayer = None
@@ -0,0 +1,132 @@
+"""
+Compact measurement encodings of the ingest endpoint.
+
+Line protocol, one measurement per line::
+
+    <measurement_name>,sensor_id=<sensor_id> value=<value>,signature="<signature>" <timestamp>
+
+- timestamp is an integer number of nanoseconds since the epoch, UTC.
+- session_token="<token>" may be added to the fields to authenticate with a session.
+
+MessagePack, an array of maps with the keys sensor_id, measurement_name, timestamp
+(nanoseconds since the epoch, UTC), value, signature and optionally session_token.
+"""
+import dataclasses
+import datetime
+import re
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+LINE = re.compile(
+    r"^(?P<measurement>[^,\s]+),sensor_id=(?P<sensor>[^,\s]+) (?P<fields>\S+) (?P<timestamp>\d+)$",
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class IngestRecord:
+    """Measurement sent to the ingest endpoint"""
+
+    sensor_id: str
+    measurement_name: str
+    measurement_date: datetime.datetime
+    measurement_value: float
+    signature: str
+    session_token: str | None = None
+
+
+def from_timestamp(timestamp: int) -> datetime.datetime:
+    """Converts nanoseconds since the epoch to a naive UTC datetime."""
+    return EPOCH + datetime.timedelta(microseconds=timestamp // 1000)
+
+
+def parse_line(line: str) -> IngestRecord:
+    """
+    Parses a line protocol measurement.
+
+    :raise ValueError: Invalid line
+    """
+    match = LINE.match(line)
+    if match is None:
+        raise ValueError("Invalid line protocol.")
+
+    fields = {}
+    for field in match["fields"].split(","):
+        name, sep, value = field.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid field {field!r}.")
+        fields[name] = value.strip('"')
+
+    try:
+        return IngestRecord(
+            sensor_id=match["sensor"],
+            measurement_name=match["measurement"],
+            measurement_date=from_timestamp(int(match["timestamp"])),
+            measurement_value=float(fields["value"]),
+            signature=fields["signature"],
+            session_token=fields.get("session_token"),
+        )
+    except KeyError as e:
+        raise ValueError(f"Missing field {e.args[0]!r}.") from e
+
+
+def parse_line_protocol(body: str) -> list[IngestRecord | ValueError]:
+    """
+    Parses a line protocol body.
+
+    Empty lines are skipped, invalid lines are returned as errors so the other lines can
+    still be ingested.
+    """
+    records = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            records.append(parse_line(line))
+        except ValueError as e:
+            records.append(e)
+    return records
+
+
+def parse_msgpack(body: bytes) -> list[IngestRecord | ValueError]:
+    """
+    Parses a MessagePack body.
+
+    :raise ValueError: The body is not an array of maps, or msgpack is not installed
+    """
+    if msgpack is None:
+        raise ValueError("MessagePack support requires the msgpack package.")
+
+    try:
+        items = msgpack.unpackb(body)
+    except Exception as e:
+        raise ValueError("Invalid MessagePack body.") from e
+    if isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list):
+        raise ValueError("MessagePack body must be an array of measurements.")
+
+    records = []
+    for item in items:
+        try:
+            records.append(IngestRecord(
+                sensor_id=str(item["sensor_id"]),
+                measurement_name=str(item["measurement_name"]),
+                measurement_date=from_timestamp(int(item["timestamp"])),
+                measurement_value=float(item["value"]),
+                signature=str(item["signature"]),
+                session_token=item.get("session_token"),
+            ))
+        except (KeyError, TypeError, ValueError) as e:
+            records.append(ValueError(f"Invalid measurement: {e}"))
+    return records
+
+
+def pack_msgpack(value) -> bytes:
+    """Encodes a MessagePack response."""
+    return msgpack.packb(value)
@@ -0,0 +1,207 @@
+"""Token bucket rate limiting of measurement ingestion."""
+import collections
+import math
+import threading
+import time
+import typing
+
+import config
+
+from ..configuration import get_server_config
+from ..configuration.server import get_server_config_source
+from ..configuration.snapshot import ConfigSnapshot, changed_keys
+
+
+class TokenBucket:
+    """Bucket refilled at a constant rate, holding at most burst tokens"""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        """
+        Setups a full bucket.
+
+        :param rate: Tokens added per second, 0 to never refill the bucket
+        :param burst: Bucket capacity
+        :param now: Current monotonic time
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def wait(self, now: float) -> float:
+        """
+        Refills the bucket without taking a token.
+
+        :param now: Current monotonic time
+        :return: 0 if a token is available, else the seconds until one is, infinite if the
+        bucket is never refilled
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        if self.rate <= 0:
+            return math.inf
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self, now: float) -> float:
+        """
+        Takes a token.
+
+        :param now: Current monotonic time
+        :return: 0 if a token was taken, else the seconds until one is available
+        """
+        retry_after = self.wait(now)
+        if not retry_after:
+            self.tokens -= 1
+        return retry_after
+
+
+Limit = tuple[float, float]
+
+
+class RateLimiter:
+    """
+    Limits measurements per sensor, per sensor and measurement type, and globally.
+
+    Per sensor limits come from the sensor override or the default sensor limit.
+    Measurement type limits apply to each sensor separately.
+    Buckets of the least recently seen sensors are dropped beyond max_buckets.
+    """
+
+    def __init__(
+            self,
+            *,
+            global_limit: Limit | None = None,
+            sensor_limit: Limit | None = None,
+            sensor_limits: dict[str, Limit] | None = None,
+            measurement_limits: dict[str, Limit] | None = None,
+            max_buckets: int = 100000,
+            clock: typing.Callable[[], float] = time.monotonic,
+    ):
+        """
+        Setups the limiter.
+
+        Limits are (rate per second, burst) pairs, None means unlimited.
+
+        :param global_limit: Limit for all sensors together
+        :param sensor_limit: Default limit of each sensor
+        :param sensor_limits: Limits of specific sensors
+        :param measurement_limits: Limits of each sensor for specific measurement types
+        :param max_buckets: Maximum number of tracked buckets
+        :param clock: Monotonic clock
+        """
+        self.sensor_limit = sensor_limit
+        self.sensor_limits = sensor_limits or {}
+        self.measurement_limits = measurement_limits or {}
+        self.max_buckets = max_buckets
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._global = TokenBucket(*global_limit, clock()) if global_limit else None
+        self._buckets: collections.OrderedDict[tuple[str, ...], TokenBucket] = \
+            collections.OrderedDict()
+
+    def _bucket(self, key: tuple[str, ...], limit: Limit, now: float) -> TokenBucket:
+        """Returns a keyed bucket, created full."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(*limit, now)
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def check(self, sensor_id: str, measurement_name: str) -> float:
+        """
+        Accounts for a measurement.
+
+        A token is taken from every bucket of the measurement, or from none of them when
+        one is empty.
+
+        :param sensor_id: Sensor sending the measurement
+        :param measurement_name: Measurement type
+        :return: 0 if the measurement is allowed, else seconds to wait before retrying,
+        infinite if a limit without rate is reached
+        """
+        now = self.clock()
+        with self._lock:
+            buckets = []
+            limit = self.sensor_limits.get(sensor_id, self.sensor_limit)
+            if limit is not None:
+                buckets.append(self._bucket((sensor_id,), limit, now))
+            limit = self.measurement_limits.get(measurement_name)
+            if limit is not None:
+                buckets.append(self._bucket((sensor_id, measurement_name), limit, now))
+            if self._global is not None:
+                buckets.append(self._global)
+
+            retry_after = max((bucket.wait(now) for bucket in buckets), default=0.0)
+            if not retry_after:
+                for bucket in buckets:
+                    bucket.tokens -= 1
+            return retry_after
+
+
+def _read_limit(cfg: config.ConfigurationSet, prefix: str) -> Limit | None:
+    """Reads a "<prefix>_rate", "<prefix>_burst" limit."""
+    if f"{prefix}_rate" not in cfg:
+        return None
+    rate = cfg.get_float(f"{prefix}_rate")
+    burst = cfg.get_float(f"{prefix}_burst") if f"{prefix}_burst" in cfg else max(rate, 1)
+    return rate, burst
+
+
+def _read_limits(cfg: config.ConfigurationSet, key: str) -> dict[str, Limit]:
+    """Reads a {name: {"rate": r, "burst": b}} mapping."""
+    if key not in cfg:
+        return {}
+
+    values: dict[str, dict[str, float]] = {}
+    for flat_key, value in cfg.get_dict(key).items():
+        # Names may contain dots: the field is after the last one.
+        name, _, field = flat_key.rpartition(".")
+        values.setdefault(name, {})[field] = float(value)
+    return {
+        name: (limit["rate"], limit.get("burst", max(limit["rate"], 1)))
+        for name, limit in values.items()
+    }
+
+
+_limiter: RateLimiter | None = None
+_limiter_lock = threading.Lock()
+_subscribed = False
+
+
+def get_rate_limiter() -> RateLimiter:
+    """
+    Returns the process rate limiter, created from the server configuration.
+
+    The limiter is created again when the limits of the configuration change.
+    """
+    global _limiter, _subscribed
+
+    with _limiter_lock:
+        if not _subscribed:
+            get_server_config_source().subscribe(_reset_rate_limiter)
+            _subscribed = True
+        if _limiter is None:
+            cfg = get_server_config()
+            _limiter = RateLimiter(
+                global_limit=_read_limit(cfg, "rate_limit_global"),
+                sensor_limit=_read_limit(cfg, "rate_limit_sensor"),
+                sensor_limits=_read_limits(cfg, "rate_limit_sensors"),
+                measurement_limits=_read_limits(cfg, "rate_limit_measurements"),
+            )
+        return _limiter
+
+
+def _reset_rate_limiter(previous: ConfigSnapshot, cfg: ConfigSnapshot):
+    """Drops the rate limiter when limits changed, the next check creates it again."""
+    global _limiter
+
+    if any(key.startswith("rate_limit_") for key in changed_keys(previous, cfg)):
+        with _limiter_lock:
+            _limiter = None
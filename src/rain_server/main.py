@@ -1,16 +1,124 @@
 """Application Main"""
+import argparse
+import datetime
+import signal
 import sys
 
+from .version import __version__
+
+
+def _parser() -> argparse.ArgumentParser:
+    """Command line arguments"""
+    parser = argparse.ArgumentParser(
+        prog="rain_server",
+        description="Rain API GraphQL server.",
+        add_help=False,
+    )
+    parser.add_argument("--help", action="store_true", help="Display this help and exit.")
+    parser.add_argument("--usage", action="store_true", help="Display usage and exit.")
+    parser.add_argument("--version", action="store_true", help="Display version and exit.")
+    parser.add_argument(
+        "--retention",
+        action="store_true",
+        help="Run the measurements retention job instead of the server.",
+    )
+    parser.add_argument("--host", help="Address to listen to.")
+    parser.add_argument("--port", type=int, help="Port to listen to.")
+    parser.add_argument("--workers", type=int, help="Number of worker processes.")
+    parser.add_argument("--threads", type=int, help="Concurrent requests per worker.")
+    parser.add_argument("--backlog", type=int, help="Listen queue size.")
+    parser.add_argument(
+        "--keep-alive",
+        type=float,
+        help="Idle seconds before closing keep-alive connections.",
+    )
+    parser.add_argument(
+        "--graceful-timeout",
+        type=float,
+        help="Seconds given to workers to finish requests on shutdown.",
+    )
+    return parser
+
 
 def main(*args):
     """Runs the server"""
-    raise NotImplementedError()
+    arguments = _parser().parse_args(args)
+    if arguments.help:
+        return help()
+    if arguments.usage:
+        return usage()
+    if arguments.version:
+        return version()
+    if arguments.retention:
+        return retention()
+
+    from .authenticate import get_session_store
+    from .configuration import get_database, get_server_config
+    from .server import PreforkServer, create_app
+
+    cfg = get_server_config()
+    # Workers must share the session secret.
+    get_session_store()
+    # Creates or migrates the schema once, workers only find it up to date.
+    get_database()
+
+    def option(name: str, getter):
+        value = getattr(arguments, name)
+        return getter(name) if value is None else value
+
+    PreforkServer(
+        create_app,
+        host=option("host", cfg.get_str),
+        port=option("port", cfg.get_int),
+        workers=option("workers", cfg.get_int),
+        threads=option("threads", cfg.get_int),
+        backlog=option("backlog", cfg.get_int),
+        keep_alive=option("keep_alive", cfg.get_float),
+        graceful_timeout=option("graceful_timeout", cfg.get_float),
+    ).run()
+
+
+def retention():
+    """Runs the retention job until SIGTERM or SIGINT"""
+    from .configuration import get_database
+    from .configuration.db_engine import get_db_config
+    from .maintenance import Retention, RetentionWorker
+
+    cfg = get_db_config()
+    worker = RetentionWorker(
+        Retention(
+            get_database(),
+            datetime.timedelta(minutes=cfg.get_int("retention_chunk_minutes")),
+        ),
+        cfg.get_float("retention_interval"),
+    )
+
+    def stop(signum, frame):
+        worker.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    worker.start()
+    while worker.is_alive():
+        worker.join(1)
+
+
+def version():
+    """Display version"""
+    print(f"rain_server {'.'.join(str(v) for v in __version__)}")
 
 
 def usage():
     """Display usage"""
-    raise NotImplementedError()
+    version()
+    _parser().print_usage()
+
+
+def help():
+    """Display help"""
+    version()
+    _parser().print_help()
 
 
 if __name__ == '__main__':  # pragma: no cover
-    main(*sys.argv)
+    main(*sys.argv[1:])
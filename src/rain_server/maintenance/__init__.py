@@ -0,0 +1,4 @@
+"""Database maintenance jobs"""
+__all__ = ["Retention", "RetentionReport", "RetentionWorker"]
+
+from .retention import Retention, RetentionReport, RetentionWorker
@@ -0,0 +1,395 @@
+"""Deletes or downsamples measurements older than their retention horizon."""
+import contextlib
+import dataclasses
+import datetime
+import threading
+import typing
+
+import sqlalchemy
+
+from ..configuration.db_engine import DataBase
+from ..configuration.logger import get_logger
+from ..monitoring.instruments import RETENTION_BYTES_RECLAIMED, RETENTION_ROWS
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def align_down(value: datetime.datetime, bucket: datetime.timedelta) -> datetime.datetime:
+    """Truncates a datetime to the start of its bucket."""
+    return EPOCH + ((value - EPOCH) // bucket) * bucket
+
+
+@dataclasses.dataclass
+class RetentionReport:
+    """Result of the retention job for a measurement type"""
+
+    measurement_name: str
+    action: str
+    rows_deleted: int = 0
+    rows_inserted: int = 0
+    bytes_reclaimed: int = 0
+
+
+class Retention:
+    """
+    Applies retention rules of o_measurement_types.
+
+    Measurement types with retention_days set have older measurements either deleted
+    (retention_action "delete", the default) or averaged per sensor into buckets of
+    downsample_minutes (retention_action "downsample").
+
+    Measurements are processed in chunks of a small time range, one transaction each, so
+    the job never holds long locks. Each chunk marks its time range as stale for the block
+    caches, and markers older than their time to live are purged. With measurement shards,
+    each shard is processed in turn.
+    """
+
+    def __init__(self, database: DataBase, chunk: datetime.timedelta = datetime.timedelta(hours=1)):
+        """
+        Setups the retention job.
+
+        :param database: Database
+        :param chunk: Time range of measurements processed per transaction
+        """
+        self.database = database
+        self.chunk = chunk
+
+    def run(self, now: datetime.datetime | None = None) -> list[RetentionReport]:
+        """
+        Applies all retention rules.
+
+        :param now: Current UTC time
+        :return: A report per measurement type with a retention rule
+        """
+        now = now or datetime.datetime.utcnow()
+        types = self.database.measurement_types
+        with self.database.engine.connect() as conn:
+            rules = conn.execute(
+                sqlalchemy.select(
+                    types.c.measurement_name,
+                    types.c.retention_days,
+                    types.c.retention_action,
+                    types.c.downsample_minutes,
+                ).where(types.c.retention_days.is_not(None)),
+            ).all()
+
+        with self.database.engine.begin() as conn:
+            markers = self.database.block_invalidations
+            conn.execute(markers.delete().where(
+                markers.c.d_created_date_utc < now - self.database.block_cache.marker_ttl,
+            ))
+
+        reports = []
+        for rule in rules:
+            horizon = now - datetime.timedelta(days=rule.retention_days)
+            if rule.retention_action == "downsample" and rule.downsample_minutes:
+                report = self.downsample(
+                    rule.measurement_name,
+                    horizon,
+                    datetime.timedelta(minutes=rule.downsample_minutes),
+                )
+            else:
+                report = self.delete(rule.measurement_name, horizon)
+
+            RETENTION_ROWS.inc(report.rows_deleted, measurement=report.measurement_name,
+                               operation="deleted")
+            RETENTION_ROWS.inc(report.rows_inserted, measurement=report.measurement_name,
+                               operation="inserted")
+            RETENTION_BYTES_RECLAIMED.inc(report.bytes_reclaimed,
+                                          measurement=report.measurement_name)
+            get_logger().info(
+                f"Retention of {report.measurement_name} ({report.action}): "
+                f"{report.rows_deleted} rows deleted, {report.rows_inserted} rows inserted, "
+                f"~{report.bytes_reclaimed} bytes reclaimed",
+            )
+            reports.append(report)
+
+        return reports
+
+    def _series(self, measurement_name: str):
+        """Selects the ids of the series of a measurement type"""
+        series = self.database.series
+        return sqlalchemy.select(series.c.series_id).where(
+            series.c.measurement_name == measurement_name,
+        )
+
+    def _targets(self, measurement_name: str) -> list[tuple[sqlalchemy.engine.Engine, typing.Any]]:
+        """
+        Engines holding measurements of a measurement type, with the ids of its series.
+
+        Without shards, the ids are a subquery of the database. With shards, they are read
+        once and grouped by shard.
+        """
+        shards = self.database.shards
+        if shards is None:
+            return [(self.database.engine, self._series(measurement_name))]
+
+        series = self.database.series
+        with self.database.engine.connect() as conn:
+            rows = conn.execute(
+                sqlalchemy.select(series.c.series_id, series.c.sensor_id).where(
+                    series.c.measurement_name == measurement_name,
+                ),
+            ).all()
+        groups = shards.partition((row.sensor_id, row.series_id) for row in rows)
+        return [(shards.engines[index], groups[index]) for index in sorted(groups)]
+
+    def _invalidate(self, conn, start: datetime.datetime, end: datetime.datetime):
+        """Marks [start, end) as stale in the block caches of every series."""
+        conn.execute(self.database.block_invalidations.insert().values(
+            series_id=None,
+            block_start=start,
+            block_end=end,
+            d_created_date_utc=datetime.datetime.utcnow(),
+        ))
+
+    @contextlib.contextmanager
+    def _transaction(self, engine: sqlalchemy.engine.Engine):
+        """
+        Runs a transaction on an engine holding measurements.
+
+        Time ranges added to the yielded list are marked as stale in the same transaction
+        on the database, or once the transaction committed on a shard, so block caches never
+        reload rows that are about to be removed.
+
+        :return: The connection and the list of stale time ranges
+        """
+        stale: list[tuple[datetime.datetime, datetime.datetime]] = []
+        with engine.begin() as conn:
+            yield conn, stale
+            if engine is self.database.engine:
+                for start, end in stale:
+                    self._invalidate(conn, start, end)
+        if stale and engine is not self.database.engine:
+            with self.database.engine.begin() as conn:
+                for start, end in stale:
+                    self._invalidate(conn, start, end)
+
+    def _oldest(self, conn, series, start: datetime.datetime | None,
+                end: datetime.datetime) -> datetime.datetime | None:
+        """Date of the oldest measurement of series in [start, end)"""
+        measurements = self.database.measurements
+        query = sqlalchemy.select(
+            sqlalchemy.func.min(measurements.c.measurement_datetime),
+        ).where(
+            measurements.c.series_id.in_(series),
+            measurements.c.measurement_datetime < end,
+        )
+        if start is not None:
+            query = query.where(measurements.c.measurement_datetime >= start)
+        return conn.execute(query).scalar()
+
+    def delete(self, measurement_name: str, horizon: datetime.datetime) -> RetentionReport:
+        """
+        Deletes measurements older than the horizon.
+
+        :param measurement_name: Measurement type
+        :param horizon: Measurements before this date are deleted
+        """
+        measurements = self.database.measurements
+        report = RetentionReport(measurement_name, "delete")
+
+        for engine, series in self._targets(measurement_name):
+            size = _StorageSize(engine)
+            rows_deleted = 0
+            while True:
+                with self._transaction(engine) as (conn, stale):
+                    oldest = self._oldest(conn, series, None, horizon)
+                    if oldest is None:
+                        break
+                    end = min(oldest + self.chunk, horizon)
+                    rows_deleted += conn.execute(
+                        measurements.delete().where(
+                            measurements.c.series_id.in_(series),
+                            measurements.c.measurement_datetime < end,
+                        ),
+                    ).rowcount
+                    stale.append((oldest, end))
+
+            report.rows_deleted += rows_deleted
+            report.bytes_reclaimed += size.reclaimed(rows_deleted)
+        return report
+
+    def _save_watermark(self, conn, measurement_name: str, watermark: datetime.datetime):
+        """Stores the date until which a measurement type is downsampled."""
+        state = self.database.retention_state
+        conn.execute(state.delete().where(state.c.measurement_name == measurement_name))
+        conn.execute(state.insert().values(
+            measurement_name=measurement_name,
+            downsampled_until=watermark,
+            d_updated_date_utc=datetime.datetime.utcnow(),
+        ))
+
+    def downsample(self, measurement_name: str, horizon: datetime.datetime,
+                   bucket: datetime.timedelta) -> RetentionReport:
+        """
+        Replaces measurements older than the horizon by their average per series and bucket.
+
+        Progress is stored in s_retention_state, so buckets are only downsampled once. With
+        shards, progress is stored once every shard is processed; downsampling a bucket
+        again after a failure leaves it unchanged.
+
+        :param measurement_name: Measurement type
+        :param horizon: Measurements before this date are downsampled
+        :param bucket: Bucket size
+        """
+        state = self.database.retention_state
+        report = RetentionReport(measurement_name, "downsample")
+        horizon = align_down(horizon, bucket)
+
+        with self.database.engine.connect() as conn:
+            watermark = conn.execute(
+                sqlalchemy.select(state.c.downsampled_until).where(
+                    state.c.measurement_name == measurement_name,
+                ),
+            ).scalar()
+
+        reached = None
+        for engine, series in self._targets(measurement_name):
+            end = self._downsample_engine(
+                engine, series, measurement_name, watermark, horizon, bucket, report,
+            )
+            reached = max(filter(None, [reached, end]), default=None)
+
+        if reached is not None and self.database.shards is not None:
+            with self.database.engine.begin() as conn:
+                self._save_watermark(conn, measurement_name, reached)
+        return report
+
+    def _downsample_engine(self, engine: sqlalchemy.engine.Engine, series,
+                           measurement_name: str, watermark: datetime.datetime | None,
+                           horizon: datetime.datetime, bucket: datetime.timedelta,
+                           report: RetentionReport) -> datetime.datetime | None:
+        """
+        Downsamples the measurements of series held by an engine.
+
+        :return: End of the last downsampled chunk, None if there was nothing to downsample
+        """
+        measurements = self.database.measurements
+        size = _StorageSize(engine)
+        rows_deleted = rows_inserted = 0
+        # Process whole buckets in each transaction.
+        chunk = max(self.chunk // bucket, 1) * bucket
+        reached = None
+
+        while True:
+            with self._transaction(engine) as (conn, stale):
+                oldest = self._oldest(conn, series, watermark, horizon)
+                if oldest is None:
+                    break
+                start = align_down(oldest, bucket)
+                end = min(start + chunk, horizon)
+                window = sqlalchemy.and_(
+                    measurements.c.series_id.in_(series),
+                    measurements.c.measurement_datetime >= start,
+                    measurements.c.measurement_datetime < end,
+                )
+
+                buckets: dict[tuple, list] = {}
+                rows = conn.execute(
+                    sqlalchemy.select(
+                        measurements.c.series_id,
+                        measurements.c.measurement_datetime,
+                        measurements.c.measurement_value,
+                    ).where(window),
+                )
+                for row in rows:
+                    if row.measurement_value is None:
+                        continue
+                    key = (row.series_id, align_down(row.measurement_datetime, bucket))
+                    values = buckets.setdefault(key, [0.0, 0])
+                    values[0] += row.measurement_value
+                    values[1] += 1
+
+                rows_deleted += conn.execute(measurements.delete().where(window)).rowcount
+                stale.append((start, end))
+                if buckets:
+                    conn.execute(self.database.insert_measurement, [
+                        {
+                            "series_id": series_id,
+                            "measurement_datetime": bucket_start,
+                            "measurement_value": total / count,
+                        }
+                        for (series_id, bucket_start), (total, count) in buckets.items()
+                    ])
+                    rows_inserted += len(buckets)
+
+                if engine is self.database.engine:
+                    self._save_watermark(conn, measurement_name, end)
+                watermark = reached = end
+
+        report.rows_deleted += rows_deleted
+        report.rows_inserted += rows_inserted
+        report.bytes_reclaimed += size.reclaimed(rows_deleted - rows_inserted)
+        return reached
+
+
+class _StorageSize:
+    """Estimates storage reclaimed by deleting measurements"""
+
+    def __init__(self, engine: sqlalchemy.engine.Engine):
+        """Takes a snapshot of the storage of an engine before deleting rows."""
+        self.engine = engine
+        self.dialect = engine.dialect.name
+        self.free_bytes = self._sqlite_free_bytes() if self.dialect == "sqlite" else 0
+
+    def _sqlite_free_bytes(self) -> int:
+        """Size of the free pages of a SQLite database"""
+        with self.engine.connect() as conn:
+            free_pages = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+            page_size = conn.exec_driver_sql("PRAGMA page_size").scalar()
+        return free_pages * page_size
+
+    def _postgresql_row_size(self) -> float:
+        """Average size of a measurement row, indexes included"""
+        with self.engine.connect() as conn:
+            return float(conn.exec_driver_sql(
+                "SELECT pg_total_relation_size(oid) / GREATEST(reltuples, 1) "
+                "FROM pg_class WHERE oid = 'd_measurements'::regclass",
+            ).scalar() or 0)
+
+    def reclaimed(self, rows: int) -> int:
+        """
+        Estimated bytes reclaimed.
+
+        On SQLite, pages moved to the free list. On PostgreSQL, rows removed times the
+        average row size (space is reusable once vacuumed). Unknown for other dialects.
+
+        :param rows: Number of rows removed
+        """
+        if rows <= 0:
+            return 0
+        if self.dialect == "sqlite":
+            return max(self._sqlite_free_bytes() - self.free_bytes, 0)
+        if self.dialect == "postgresql":
+            return int(rows * self._postgresql_row_size())
+        return 0
+
+
+class RetentionWorker(threading.Thread):
+    """Runs the retention job periodically"""
+
+    def __init__(self, retention: Retention, interval: float):
+        """
+        Setups the worker.
+
+        :param retention: Retention job
+        :param interval: Delay in seconds between two runs
+        """
+        super().__init__(name="retention", daemon=True)
+        self.retention = retention
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        """Runs the job until stopped."""
+        while not self._stop_event.is_set():
+            try:
+                self.retention.run()
+            except Exception:
+                get_logger().exception("Retention job failed")
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        """Stops the worker after the current run."""
+        self._stop_event.set()
@@ -0,0 +1,18 @@
+"""
+Server monitoring: metrics and instrumentation hooks.
+
+MetricsExtension lives in .extension so that importing metrics doesn't import strawberry.
+"""
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "MetricsRegistry",
+    "SlowQueryLogger",
+    "get_registry",
+    "instrument_engine",
+]
+
+from .engine import instrument_engine
+from .metrics import Counter, Gauge, Histogram, MetricsRegistry, get_registry
+from .slow_query import SlowQueryLogger
@@ -0,0 +1,63 @@
+"""SQLAlchemy events feeding database metrics."""
+import time
+
+import sqlalchemy.engine
+import sqlalchemy.event
+
+from .instruments import (DB_COMPILED_CACHE, DB_ERRORS, DB_POOL_CHECKED_OUT,
+                          DB_POOL_CONNECTIONS, DB_QUERY_SECONDS)
+
+
+def _statement_type(statement: str) -> str:
+    """Returns the SQL verb of the statement."""
+    parts = statement.lstrip().split(None, 1)
+    return parts[0].lower() if parts else "unknown"
+
+
+def _record_compiled_cache(name: str, context):
+    """Records if the statement was found in the compiled cache."""
+    cache_hit = getattr(context, "cache_hit", None)
+    if cache_hit is not None:
+        DB_COMPILED_CACHE.inc(engine=name, result=cache_hit.name.lower())
+
+
+def instrument_engine(engine: sqlalchemy.engine.Engine, name: str = "primary"):
+    """
+    Records statement latency, compiled cache usage, errors and pool usage of an engine.
+
+    :param engine: SQLAlchemy engine
+    :param name: Engine label used in metrics
+    """
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("rain_query_start", []).append(time.perf_counter())
+
+    @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["rain_query_start"].pop()
+        DB_QUERY_SECONDS.observe(
+            time.perf_counter() - start,
+            engine=name,
+            statement=_statement_type(statement),
+        )
+        _record_compiled_cache(name, context)
+
+    @sqlalchemy.event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None:
+            starts = context.connection.info.get("rain_query_start")
+            if starts:
+                starts.pop()
+        DB_ERRORS.inc(engine=name, error=type(context.original_exception).__name__)
+
+    @sqlalchemy.event.listens_for(engine.pool, "connect")
+    def connect(dbapi_connection, connection_record):
+        DB_POOL_CONNECTIONS.inc(engine=name)
+
+    @sqlalchemy.event.listens_for(engine.pool, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKED_OUT.inc(engine=name)
+
+    @sqlalchemy.event.listens_for(engine.pool, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        DB_POOL_CHECKED_OUT.dec(engine=name)
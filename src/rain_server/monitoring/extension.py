@@ -0,0 +1,116 @@
+"""Strawberry extensions timing and profiling GraphQL operations."""
+import os.path
+import tempfile
+import threading
+
+from strawberry.extensions import SchemaExtension
+
+from ..configuration import get_server_config
+from ..configuration.server import get_server_config_source
+from ..configuration.snapshot import ConfigSnapshot, changed_keys
+from .instruments import REQUEST_ERRORS, REQUEST_PHASE_SECONDS
+from .profiler import PROFILE_HEADER, ProfileStore, RequestProfiler
+
+_profiler: RequestProfiler | None = None
+_profiler_lock = threading.Lock()
+_subscribed = False
+
+
+def get_request_profiler() -> RequestProfiler:
+    """
+    Returns the process request profiler, created from the server configuration.
+
+    The profiler is created again when the profiling settings of the configuration change.
+    """
+    global _profiler, _subscribed
+
+    with _profiler_lock:
+        if not _subscribed:
+            get_server_config_source().subscribe(_reset_request_profiler)
+            _subscribed = True
+        if _profiler is None:
+            cfg = get_server_config()
+            _profiler = RequestProfiler(
+                ProfileStore(
+                    cfg.get("profile_directory")
+                    or os.path.join(tempfile.gettempdir(), "rain_profiles"),  # noqa
+                    cfg.get_int("profile_max_files"),
+                ),
+                sample_rate=cfg.get_float("profile_sample_rate"),
+                token=cfg.get("profile_token"),
+                interval=cfg.get_float("profile_interval"),
+            )
+        return _profiler
+
+
+def _reset_request_profiler(previous: ConfigSnapshot, cfg: ConfigSnapshot):
+    """Drops the request profiler when its settings changed, it is created again on use."""
+    global _profiler
+
+    if any(key.startswith("profile_") for key in changed_keys(previous, cfg)):
+        with _profiler_lock:
+            _profiler = None
+
+
+class MetricsExtension(SchemaExtension):
+    """Records per-phase latency and error counts of GraphQL operations."""
+
+    def on_operation(self):
+        """Times the whole operation and counts returned errors."""
+        with REQUEST_PHASE_SECONDS.time(phase="operation"):
+            yield
+
+        result = self.execution_context.result
+        if result is not None:
+            errors = result.errors or []
+        else:
+            errors = self.execution_context.pre_execution_errors or []
+        for error in errors:
+            original = getattr(error, "original_error", None)
+            REQUEST_ERRORS.inc(error=type(original or error).__name__)
+
+    def on_parse(self):
+        """Times query parsing."""
+        with REQUEST_PHASE_SECONDS.time(phase="parse"):
+            yield
+
+    def on_validate(self):
+        """Times query validation."""
+        with REQUEST_PHASE_SECONDS.time(phase="validate"):
+            yield
+
+    def on_execute(self):
+        """Times resolvers execution."""
+        with REQUEST_PHASE_SECONDS.time(phase="execute"):
+            yield
+
+
+class ProfilingExtension(SchemaExtension):
+    """
+    Profiles sampled GraphQL operations, or operations sent with the profiling header.
+
+    The profile is written by the request profiler store and its file name returned in the
+    X-Rain-Profile-Id response header.
+    """
+
+    def on_operation(self):
+        """Samples the thread executing the operation."""
+        context = self.execution_context.context or {}
+        request = context.get("request") if isinstance(context, dict) else None
+        profiler = get_request_profiler()
+        reason = profiler.reason(getattr(request, "headers", None))
+        if reason is None:
+            yield
+            return
+
+        sampler = profiler.start(reason)
+        try:
+            yield
+        finally:
+            samples = sampler.stop()
+            file_name = profiler.store.write(
+                self.execution_context.operation_name or "anonymous", samples,
+            )
+            response = context.get("response")
+            if response is not None:
+                response.headers[f"{PROFILE_HEADER}-Id"] = file_name
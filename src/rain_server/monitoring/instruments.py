@@ -0,0 +1,83 @@
+"""Metrics recorded by the server."""
+from .metrics import get_registry
+
+REQUEST_PHASE_SECONDS = get_registry().histogram(
+    "rain_request_phase_seconds",
+    "Time spent in each phase of a request.",
+    ["phase"],
+)
+REQUEST_ERRORS = get_registry().counter(
+    "rain_request_errors",
+    "Errors returned to clients by error type.",
+    ["error"],
+)
+SIGNATURE_CHECKS = get_registry().counter(
+    "rain_signature_checks",
+    "Signature verifications by result.",
+    ["result"],
+)
+RATE_LIMITED = get_registry().counter(
+    "rain_rate_limited",
+    "Measurements rejected by the rate limiter.",
+    ["measurement"],
+)
+DB_QUERY_SECONDS = get_registry().histogram(
+    "rain_db_query_seconds",
+    "Database statement execution time by statement type.",
+    ["engine", "statement"],
+)
+DB_COMPILED_CACHE = get_registry().counter(
+    "rain_db_compiled_cache",
+    "Statement executions by compiled cache result.",
+    ["engine", "result"],
+)
+DB_ERRORS = get_registry().counter(
+    "rain_db_errors",
+    "Database errors by exception type.",
+    ["engine", "error"],
+)
+DB_POOL_CHECKED_OUT = get_registry().gauge(
+    "rain_db_pool_checked_out",
+    "Connections currently checked out of the pool.",
+    ["engine"],
+)
+DB_POOL_CONNECTIONS = get_registry().counter(
+    "rain_db_pool_connections",
+    "New DBAPI connections opened by the pool.",
+    ["engine"],
+)
+RETENTION_ROWS = get_registry().counter(
+    "rain_retention_rows",
+    "Measurement rows deleted or inserted by the retention job.",
+    ["measurement", "operation"],
+)
+RETENTION_BYTES_RECLAIMED = get_registry().counter(
+    "rain_retention_bytes_reclaimed",
+    "Estimated storage reclaimed by the retention job.",
+    ["measurement"],
+)
+PROFILED_REQUESTS = get_registry().counter(
+    "rain_profiled_requests",
+    "GraphQL operations profiled, by reason (sampled or header).",
+    ["reason"],
+)
+JOURNAL_RECORDS = get_registry().counter(
+    "rain_journal_records",
+    "Measurements appended to, replayed from or quarantined by the ingest journal.",
+    ["operation"],
+)
+JOURNAL_SYNC_SECONDS = get_registry().histogram(
+    "rain_journal_sync_seconds",
+    "Time spent in fsync of the ingest journal, one per batch of appends.",
+    ["journal"],
+)
+JOURNAL_LAG_BYTES = get_registry().gauge(
+    "rain_journal_lag_bytes",
+    "Size of the journaled measurements not written to the database yet.",
+    ["journal"],
+)
+JOURNAL_LAG_SECONDS = get_registry().gauge(
+    "rain_journal_lag_seconds",
+    "Age of the last journaled measurement written to the database, while others wait.",
+    ["journal"],
+)
@@ -0,0 +1,179 @@
+"""Statistical profiling of individual requests."""
+import collections
+import datetime
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import typing
+import uuid
+
+from .instruments import PROFILED_REQUESTS
+
+PROFILE_HEADER = "X-Rain-Profile"
+PROFILE_SUFFIX = ".folded"
+UNSAFE_NAME = re.compile(r"[^A-Za-z0-9_-]")
+
+
+def fold_stack(frame) -> str:
+    """
+    Formats a stack as a line of the folded format, outermost frame first.
+
+    Frames are identified by function, file and first line, so samples taken at different
+    lines of a function are merged.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """Samples the stack of a thread from a background thread at a fixed interval"""
+
+    def __init__(self, thread_id: int, interval: float):
+        """
+        Setups the profiler.
+
+        :param thread_id: Identifier of the profiled thread
+        :param interval: Delay in seconds between two samples
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: collections.Counter[str] = collections.Counter()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        """Samples until stopped."""
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[fold_stack(frame)] += 1
+
+    def start(self) -> "SamplingProfiler":
+        """Starts sampling."""
+        self._thread.start()
+        return self
+
+    def stop(self) -> collections.Counter[str]:
+        """
+        Stops sampling.
+
+        :return: Number of samples per folded stack
+        """
+        self._stop_event.set()
+        self._thread.join()
+        return self.samples
+
+
+class ProfileStore:
+    """
+    Writes profiles to a directory, keeping only the most recent ones.
+
+    Profiles use the folded stacks format ("frame;frame;frame count" lines) read by
+    flamegraph.pl, speedscope and inferno.
+    """
+
+    def __init__(self, directory: str, max_files: int):
+        """
+        Setups the store.
+
+        :param directory: Directory of the profiles, created if needed
+        :param max_files: Number of profiles kept
+        """
+        self.directory = directory
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    def write(self, name: str, samples: typing.Mapping[str, int]) -> str:
+        """
+        Writes a profile and drops the oldest ones.
+
+        :param name: Profile name, added to the file name
+        :param samples: Number of samples per folded stack
+        :return: File name of the profile
+        """
+        file_name = (
+            f"{datetime.datetime.utcnow():%Y%m%dT%H%M%S%f}-"
+            f"{UNSAFE_NAME.sub('_', name)[:64]}-{uuid.uuid4().hex[:8]}{PROFILE_SUFFIX}"
+        )
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, file_name), "w") as fp:
+            fp.writelines(f"{stack} {count}\n" for stack, count in sorted(samples.items()))
+
+        with self._lock:
+            self._purge()
+        return file_name
+
+    def _purge(self):
+        """Deletes the oldest profiles above max_files."""
+        names = sorted(
+            name for name in os.listdir(self.directory) if name.endswith(PROFILE_SUFFIX)
+        )
+        for name in names[:max(len(names) - self.max_files, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # Already deleted by another worker.
+                pass
+
+
+class RequestProfiler:
+    """
+    Chooses the requests to profile.
+
+    A fraction sample_rate of requests is profiled. Requests with the X-Rain-Profile header
+    set to the token are always profiled, no request is if the token is None.
+    """
+
+    def __init__(
+            self,
+            store: ProfileStore,
+            *,
+            sample_rate: float = 0.0,
+            token: str | None = None,
+            interval: float = 0.005,
+            draw: typing.Callable[[], float] = random.random,
+    ):
+        """
+        Setups the request profiler.
+
+        :param store: Store of the profiles
+        :param sample_rate: Fraction of requests profiled, between 0 and 1
+        :param token: Secret enabling profiling through the request header
+        :param interval: Delay in seconds between two samples of a request
+        :param draw: Random number generator in [0, 1)
+        """
+        self.store = store
+        self.sample_rate = sample_rate
+        self.token = token
+        self.interval = interval
+        self.draw = draw
+
+    def reason(self, headers: typing.Mapping[str, str] | None) -> str | None:
+        """
+        Tells whether a request must be profiled.
+
+        :param headers: Request headers
+        :return: "header" or "sampled" when the request is profiled, else None
+        """
+        value = (headers or {}).get(PROFILE_HEADER)
+        if self.token and value and hmac.compare_digest(value.encode(), self.token.encode()):
+            return "header"
+        if self.sample_rate > 0 and self.draw() < self.sample_rate:
+            return "sampled"
+        return None
+
+    def start(self, reason: str) -> SamplingProfiler:
+        """
+        Starts profiling the current thread.
+
+        :param reason: Reason returned by reason()
+        """
+        PROFILED_REQUESTS.inc(reason=reason)
+        return SamplingProfiler(threading.get_ident(), self.interval).start()
@@ -0,0 +1,173 @@
+"""Logs slow statements with their execution plan."""
+import collections
+import logging
+import threading
+import time
+
+import sqlalchemy.engine
+import sqlalchemy.event
+
+EXPLAIN_PREFIXES = {
+    "sqlite": ("EXPLAIN QUERY PLAN ", "EXPLAIN QUERY PLAN "),
+    "postgresql": ("EXPLAIN ", "EXPLAIN (ANALYZE, BUFFERS) "),
+    "mysql": ("EXPLAIN ", "EXPLAIN ANALYZE "),
+}
+EXPLAINABLE_STATEMENTS = {"select", "with", "insert", "update", "delete"}
+MAX_PARAMETERS_LENGTH = 1000
+
+
+class SlowQueryLogger:
+    """
+    Logs statements slower than a threshold.
+
+    Each statement is logged at most once per interval, and at most max_per_interval
+    statements are logged per interval, so a bad query can't flood the logs.
+    """
+
+    def __init__(
+            self,
+            logger: logging.Logger,
+            threshold: float,
+            *,
+            explain: bool = True,
+            analyze: bool = False,
+            interval: float = 60.0,
+            max_per_interval: int = 10,
+            max_statements: int = 1024,
+    ):
+        """
+        Setups the slow query logger.
+
+        :param logger: Logger receiving slow queries
+        :param threshold: Duration in seconds above which a statement is logged
+        :param explain: Capture the execution plan of slow statements
+        :param analyze: Use EXPLAIN ANALYZE for SELECT statements (runs the query again)
+        :param interval: Minimum delay in seconds between two logs of the same statement
+        :param max_per_interval: Maximum number of slow queries logged per interval
+        :param max_statements: Number of statements tracked for rate limiting
+        """
+        self.logger = logger
+        self.threshold = threshold
+        self.explain = explain
+        self.analyze = analyze
+        self.interval = interval
+        self.max_per_interval = max_per_interval
+        self.max_statements = max_statements
+
+        self._lock = threading.Lock()
+        self._last_logged: collections.OrderedDict[str, float] = collections.OrderedDict()
+        self._suppressed: dict[str, int] = {}
+        self._window_start = 0.0
+        self._window_count = 0
+
+    def install(self, engine: sqlalchemy.engine.Engine):
+        """Listens to the engine statements."""
+        sqlalchemy.event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        sqlalchemy.event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        sqlalchemy.event.listen(engine, "handle_error", self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """Starts the statement timer."""
+        conn.info.setdefault("rain_slow_query_start", []).append(time.perf_counter())
+
+    def _handle_error(self, context):
+        """Drops the timer of a failed statement."""
+        if context.connection is not None:
+            starts = context.connection.info.get("rain_slow_query_start")
+            if starts:
+                starts.pop()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        """Logs the statement if it was slow."""
+        duration = time.perf_counter() - conn.info["rain_slow_query_start"].pop()
+        if duration < self.threshold:
+            return
+
+        suppressed = self._acquire(statement)
+        if suppressed is None:
+            return
+
+        plan = None
+        if self.explain and not executemany:
+            plan = self._explain(conn, statement, parameters)
+
+        parameters_str = repr(parameters)
+        if len(parameters_str) > MAX_PARAMETERS_LENGTH:
+            parameters_str = parameters_str[:MAX_PARAMETERS_LENGTH] + "..."
+
+        self.logger.warning(
+            "Slow query (%.3fs, %d similar suppressed): %s\nParameters: %s\nPlan:\n%s",
+            duration,
+            suppressed,
+            statement,
+            parameters_str,
+            plan or "not available",
+        )
+
+    def _acquire(self, statement: str) -> int | None:
+        """
+        Checks the rate limits for a statement.
+
+        :return: Number of suppressed logs for the statement, None if it must not be logged
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._window_start >= self.interval:
+                self._window_start = now
+                self._window_count = 0
+
+            last = self._last_logged.get(statement)
+            if (last is not None and now - last < self.interval) \
+                    or self._window_count >= self.max_per_interval:
+                self._suppressed[statement] = self._suppressed.get(statement, 0) + 1
+                return None
+
+            self._window_count += 1
+            self._last_logged[statement] = now
+            self._last_logged.move_to_end(statement)
+            while len(self._last_logged) > self.max_statements:
+                old_statement, _ = self._last_logged.popitem(last=False)
+                self._suppressed.pop(old_statement, None)
+            return self._suppressed.pop(statement, 0)
+
+    def _explain(self, conn: sqlalchemy.engine.Connection, statement: str,
+                 parameters) -> str | None:
+        """
+        Captures the execution plan of a statement.
+
+        The plan is captured on the connection of the slow statement, inside its transaction,
+        so it sees the same data and takes no other connection from the pool. On PostgreSQL,
+        where a failed statement aborts the transaction, it runs in a savepoint.
+        """
+        dialect = conn.dialect.name
+        prefixes = EXPLAIN_PREFIXES.get(dialect)
+        parts = statement.lstrip().split(None, 1)
+        statement_type = parts[0].lower() if parts else ""
+        if not prefixes or statement_type not in EXPLAINABLE_STATEMENTS:
+            return None
+
+        # ANALYZE runs the statement again: only do it for read only statements.
+        prefix = prefixes[1] if self.analyze and statement_type == "select" else prefixes[0]
+        savepoint = dialect == "postgresql"
+
+        try:
+            cursor = conn.connection.cursor()
+            try:
+                if savepoint:
+                    cursor.execute("SAVEPOINT rain_explain")
+                try:
+                    cursor.execute(prefix + statement, parameters)
+                    rows = cursor.fetchall()
+                except Exception:
+                    if savepoint:
+                        cursor.execute("ROLLBACK TO SAVEPOINT rain_explain")
+                    raise
+                finally:
+                    if savepoint:
+                        cursor.execute("RELEASE SAVEPOINT rain_explain")
+            finally:
+                cursor.close()
+        except Exception as err:
+            return f"EXPLAIN failed: {err}"
+
+        return "\n".join(" | ".join(str(col) for col in row) for row in rows)
@@ -3,6 +3,8 @@ import strawberry
 import strawberry.extensions
 import strawberry.schema.config
 
+from ..configuration import get_server_config
+from ..monitoring.extension import MetricsExtension, ProfilingExtension
 from .data_schemas import Location, Measurement, MeasurementType, Sensor
 from .mutation import Mutation
 from .query import Query
@@ -10,9 +12,16 @@ from .query import Query
 schema = strawberry.Schema(
     query=Query,
     mutation=Mutation,
-    # extensions=[
-    #     strawberry.extensions.AddValidationRules(
-    #         [graphql.validation.NoSchemaIntrospectionCustomRule]
-    #     ),
-    # ],
+    extensions=[
+        MetricsExtension,
+        ProfilingExtension,
+        # strawberry.extensions.AddValidationRules(
+        #     [graphql.validation.NoSchemaIntrospectionCustomRule]
+        # ),
+    ],
+    config=strawberry.schema.config.StrawberryConfig(
+        batching_config={
+            "max_operations": get_server_config().get_int("batch_max_operations"),
+        },
+    ),
 )
@@ -39,3 +39,41 @@ class Measurement:
     measurement: MeasurementType
     date: datetime.datetime
     value: float
+
+
+@strawberry.type
+class MeasurementBucket:
+    """Average of a sensor measurement over a time bucket, null for an empty bucket"""
+
+    sensor: Sensor
+    measurement: MeasurementType
+    date: datetime.datetime
+    value: float | None
+
+
+@strawberry.type
+class Percentile:
+    """Estimated percentile"""
+
+    percentile: float
+    value: float | None
+
+
+@strawberry.type
+class MeasurementPercentiles:
+    """Percentiles of a measurement type over sensors and a time range"""
+
+    measurement: MeasurementType
+    count: int
+    min: float | None
+    max: float | None
+    percentiles: list[Percentile]
+
+
+@strawberry.type
+class SensorSession:
+    """Sensor session: readings are signed with HMAC-SHA256 using the base64 key"""
+
+    token: str
+    key: str
+    expires: datetime.datetime
@@ -3,6 +3,7 @@ Defines schema related errors
 
 Error created there will be sent to the client
 """
+import math
 
 
 class InvalidSensorError(Exception):
@@ -21,3 +22,21 @@ class AuthenticationError(Exception):
     """Authentication issues."""
 
     pass
+
+
+class RateLimitError(Exception):
+    """Too many measurements, the client should retry later."""
+
+    def __init__(self, retry_after: float):
+        """
+        Setups the error and its GraphQL extensions.
+
+        :param retry_after: Seconds to wait before retrying, infinite if retrying is useless
+        """
+        self.retry_after = retry_after
+        if math.isinf(retry_after):
+            self.extensions = {"code": "RATE_LIMITED", "retryAfter": None}
+            super().__init__("Rate limit exceeded, no more measurements are accepted.")
+            return
+        self.extensions = {"code": "RATE_LIMITED", "retryAfter": round(retry_after, 3)}
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.3f} seconds.")
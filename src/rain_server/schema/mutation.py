@@ -1,12 +1,233 @@
 """Defines the mutations"""
+import base64
 import datetime
+import time
 
+import sqlalchemy
 import strawberry
 
-from ..authenticate import check_signature
-from ..configuration import get_database, get_logger
-from .data_schemas import Location, Measurement, MeasurementType, Sensor
-from .errors import AuthenticationError, InvalidSensorError
+from ..authenticate import check_hmac, check_signature, get_session_store
+from ..authenticate.session import Session
+from ..configuration import get_database, get_logger, get_server_config
+from ..ingest import JournalRecord, get_journal, get_rate_limiter
+from ..monitoring.instruments import RATE_LIMITED, REQUEST_PHASE_SECONDS
+from .data_schemas import (Location, Measurement, MeasurementType, Sensor,
+                           SensorSession)
+from .errors import AuthenticationError, InvalidSensorError, RateLimitError
+
+
+def to_utc(date: datetime.datetime) -> datetime.datetime:
+    """Converts a date to naive UTC, as stored in the database. Naive dates are UTC already."""
+    if date.tzinfo is not None:
+        return date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def check_replay_window(date: datetime.datetime):
+    """
+    Rejects dates too far from the server time.
+
+    Only the freshness of the date is checked: a captured reading, with its signature, can
+    be sent again until it leaves the window.
+
+    :param date: Date signed by the sensor
+    """
+    date = to_utc(date)
+    window = datetime.timedelta(seconds=get_server_config().get_int("session_replay_window"))
+    if abs(datetime.datetime.utcnow() - date) > window:
+        raise AuthenticationError("Date is outside of the replay window.")
+
+
+def check_rate_limit(sensor_id: str, measurement_name: str):
+    """
+    Rejects a measurement of a sensor exceeding its rate limits.
+
+    :param sensor_id: Sensor sending the measurement
+    :param measurement_name: Measurement type
+    """
+    retry_after = get_rate_limiter().check(sensor_id, measurement_name)
+    if retry_after:
+        RATE_LIMITED.inc(measurement=measurement_name)
+        raise RateLimitError(retry_after)
+
+
+def get_session(session_token: str, sensor_id: str) -> Session:
+    """
+    Validates a session token for a sensor.
+
+    :param session_token: Token returned by open_session
+    :param sensor_id: Sensor sending the request
+    """
+    session = get_session_store().get(session_token)
+    if session is None or session.sensor_id != sensor_id:
+        raise AuthenticationError("Invalid or expired session.")
+    return session
+
+
+def open_session(
+    sensor_id: str,
+    session_date: datetime.datetime,
+    signature: str,
+) -> SensorSession:
+    """
+    Opens a session for a sensor.
+
+    - The sensor signs "{session_date}{sensor_id}" with its key, as for add_measurement.
+    - session_date must be close to the server time.
+    - Readings sent with the session token are signed with HMAC-SHA256 using the session key
+    instead of the sensor key.
+    """
+    database = get_database()
+    check_replay_window(session_date)
+
+    with database.engine.connect() as conn:
+        pubkey = conn.execute(
+            sqlalchemy.select(database.sensors.c.pubkey).where(
+                database.sensors.c.sensor_id == sensor_id,
+                database.sensors.c.is_active != "N",
+            ),
+        ).scalar()
+
+    if pubkey is None:
+        error_msg = f"No matching sensor found for {sensor_id=}"
+        get_logger().error(error_msg)
+        raise InvalidSensorError(error_msg)
+
+    with REQUEST_PHASE_SECONDS.time(phase="signature"):
+        is_valid = check_signature(f"{session_date}{sensor_id}", pubkey, signature)
+    if not is_valid:
+        raise AuthenticationError("Signature verification failed.")
+
+    session = get_session_store().open(sensor_id)
+    return SensorSession(
+        token=session.token,
+        key=base64.b64encode(session.key).decode("utf-8"),
+        expires=session.expires,
+    )
+
+
+def measurement_message(
+    sensor_id: str,
+    measurement_date: datetime.datetime,
+    measurement_value: float,
+) -> str:
+    """Message signed by sensors for a measurement"""
+    return f"{measurement_date}{measurement_date}{measurement_value}{sensor_id}"
+
+
+def validate_measurement(
+    conn: sqlalchemy.engine.Connection,
+    sensor_id: str,
+    measurement_name: str,
+    measurement_date: datetime.datetime,
+    measurement_value: float,
+    signature: str,
+    session_token: str | None = None,
+    sensors: dict | None = None,
+):
+    """
+    Checks a measurement can be added by a sensor.
+
+    - Counts the measurement against the rate limits, rejecting it when the sensor
+    exceeds them.
+    - Check for sensor_id, measurement_name to retrieve the related public_key.
+    - Checks the signature with the gathered public key, or with the session key
+    when a session token from open_session is provided.
+
+    :param conn: Database connection
+    :param sensor_id: Sensor sending the measurement
+    :param measurement_name: Measurement type
+    :param measurement_date: Date of the reading
+    :param measurement_value: Value of the reading
+    :param signature: Base64 signature of the measurement message
+    :param session_token: Token returned by open_session
+    :param sensors: Cache of sensor details by sensor and measurement, shared by the
+    measurements of a batch
+    :return: Sensor, measurement type and location details
+    """
+    # Before the costly checks: rejected measurements count against the limits too.
+    check_rate_limit(sensor_id, measurement_name)
+
+    session = None
+    if session_token is not None:
+        session = get_session(session_token, sensor_id)
+        check_replay_window(measurement_date)
+
+    key = (sensor_id, measurement_name)
+    if sensors is not None and key in sensors:
+        d_sensor = sensors[key]
+    else:
+        with REQUEST_PHASE_SECONDS.time(phase="metadata"):
+            d_sensor = conn.execute(
+                get_database().select_sensors_measurement(),
+                {"sensor_id": sensor_id, "measurement_name": measurement_name},
+            ).first()
+        if sensors is not None:
+            sensors[key] = d_sensor
+
+    if not d_sensor:
+        error_msg = (f"No matching sensor or measurement found for {sensor_id=}, "
+                     f"{measurement_name=}")
+        get_logger().error(error_msg)
+        raise InvalidSensorError(error_msg)
+
+    message = measurement_message(sensor_id, measurement_date, measurement_value)
+    with REQUEST_PHASE_SECONDS.time(phase="signature"):
+        if session is not None:
+            is_valid = check_hmac(message, session.key, signature)
+        else:
+            is_valid = check_signature(message, d_sensor.pubkey, signature)
+    if not is_valid:
+        raise AuthenticationError("Signature verification failed.")
+    return d_sensor
+
+
+def measurement_row(
+    conn: sqlalchemy.engine.Connection,
+    d_sensor,
+    measurement_date: datetime.datetime,
+    measurement_value: float,
+) -> dict:
+    """
+    Builds the d_measurements row of a validated measurement.
+
+    :param conn: Connection of the transaction inserting the row
+    :param d_sensor: Details returned by validate_measurement
+    :param measurement_date: Date of the reading, converted to naive UTC
+    :param measurement_value: Value of the reading
+    """
+    return {
+        "series_id": get_database().series_cache.series_id(
+            conn,
+            d_sensor.sensor_id,
+            d_sensor.measurement_name,
+            d_sensor.location_id,
+        ),
+        "measurement_datetime": to_utc(measurement_date),
+        "measurement_value": float(measurement_value),
+    }
+
+
+def journal_record(
+    d_sensor,
+    measurement_date: datetime.datetime,
+    measurement_value: float,
+) -> JournalRecord:
+    """
+    Builds the journal record of a validated measurement.
+
+    :param d_sensor: Details returned by validate_measurement
+    :param measurement_date: Date of the reading, converted to naive UTC
+    :param measurement_value: Value of the reading
+    """
+    return JournalRecord(
+        sensor_id=d_sensor.sensor_id,
+        measurement_name=d_sensor.measurement_name,
+        location_id=d_sensor.location_id,
+        measurement_date=to_utc(measurement_date),
+        measurement_value=float(measurement_value),
+        journaled_at=time.time(),
+    )
 
 
 def add_measurement(
@@ -15,77 +236,60 @@ def add_measurement(
     measurement_date: datetime.datetime,
     measurement_value: float,
     signature: str,
+    session_token: str | None = None,
 ) -> Measurement:
     """
     Add measurement from a MeasurementInput.
 
-    - Check for sensor_id, measurement_name to retrieve the related public_key.
-    - Checks the signature with the gathered public key.
-    - Puts the measurement into the database.
+    - Validates the measurement with validate_measurement.
+    - Puts the measurement into the database, or into the ingest journal when enabled.
     """
-    logger = get_logger()
     database = get_database()
+    journal = get_journal()
 
-    query = database.select_sensors_measurement(sensor_id, measurement_name)
+    # With the journal, the request only reads, from a replica when available.
+    connect = database.engine.begin if journal is None else database.read_connection
+    with connect() as conn:
+        d_sensor = validate_measurement(
+            conn,
+            sensor_id,
+            measurement_name,
+            measurement_date,
+            measurement_value,
+            signature,
+            session_token,
+        )
 
-    message = f"{measurement_date}{measurement_date}{measurement_value}{sensor_id}"
+        if journal is None:
+            with REQUEST_PHASE_SECONDS.time(phase="insert"):
+                database.insert_measurements(
+                    conn,
+                    [measurement_row(conn, d_sensor, measurement_date, measurement_value)],
+                )
 
-    logger.info("Connecting to database...")
-    with database.engine.connect() as conn:
-        d_sensor = conn.execute(query).first()
-
-        if not d_sensor:
-            error_msg = (f"No matching sensor or measurement found for {sensor_id=}, "
-                         f"{measurement_name=}")
-            logger.error(error_msg)
-            raise InvalidSensorError(error_msg)
-
-        logger.info("Checking signature...")
-        if not check_signature(message, d_sensor.public_key, signature):
-            raise AuthenticationError("Signature verification failed.")
-
-        insert = database.measurements.insert().values(
-            location_id=d_sensor.location_id,
-            sensor_id=sensor_id,
-            measurement_name=measurement_name,
-            unit=d_sensor.unit,
-            measurement_datetime=measurement_date,
-            measurement_value=measurement_value,
-            d_created_date_utc=datetime.datetime.utcnow(),
-            d_updated_date_utc=datetime.datetime.utcnow(),
-        ).on_conflict_do_update(
-            database.measurements.primary_key,
-            set={
-                "location_id": d_sensor.location_id,
-                "sensor_id": sensor_id,
-                "measurement_name": measurement_name,
-                "unit": d_sensor.unit,
-                "measurement_datetime": measurement_date,
-                "measurement_value": measurement_value,
-                "d_updated_date_utc": datetime.datetime.utcnow(),
-            },
-        )
-        conn.execute(insert)
+    if journal is not None:
+        with REQUEST_PHASE_SECONDS.time(phase="journal"):
+            journal.append([journal_record(d_sensor, measurement_date, measurement_value)])
 
-        measurement_type = MeasurementType(
-            name=d_sensor.measurement_name,
-            unit=d_sensor.unit,
-            default_format=d_sensor.format,
-        )
-        return Measurement(
-            sensor=Sensor(
-                id=d_sensor.sensor_id,
-                name=d_sensor.sensor_name,
-                location=Location(
-                    id=d_sensor.location_id,
-                    name=d_sensor.locactio_name,
-                ),
-                measurements=[measurement_type],
+    measurement_type = MeasurementType(
+        name=d_sensor.measurement_name,
+        unit=d_sensor.unit,
+        default_format=d_sensor.string_format,
+    )
+    return Measurement(
+        sensor=Sensor(
+            id=d_sensor.sensor_id,
+            name=d_sensor.sensor_name,
+            location=Location(
+                id=d_sensor.location_id,
+                name=d_sensor.location_name,
             ),
-            measurement=measurement_type,
-            date=measurement_date,
-            value=measurement_value,
-        )
+            measurements=[measurement_type],
+        ),
+        measurement=measurement_type,
+        date=measurement_date,
+        value=measurement_value,
+    )
 
 
 @strawberry.type
@@ -93,3 +297,4 @@ class Mutation:
     """GraphQL mutations"""
 
     add_measurement = strawberry.field(resolver=add_measurement)
+    open_session = strawberry.field(resolver=open_session)
@@ -1,24 +1,97 @@
 """Defines queries"""
+import contextlib
+import datetime
+import heapq
+import itertools
+import re
+import typing
+
+import sqlalchemy.engine
 import strawberry
 
-from .data_schemas import Location, Measurement, Sensor
+from ..configuration import get_database, get_server_config
+from ..configuration.block_cache import MeasurementRow
+from ..configuration.buckets import align
+from .data_schemas import (Location, Measurement, MeasurementBucket,
+                           MeasurementPercentiles, MeasurementType, Percentile,
+                           Sensor)
+from .time_window import PERIODS, TimeWindow, resolve_window
+
+BUCKET = re.compile(r"^(\d+)([mhdw])$")
+# Maximum number of buckets of a series returned by a measurements query.
+MAX_BUCKETS = 10000
+
+
+def parse_bucket(value: str) -> datetime.timedelta:
+    """
+    Converts a bucket size.
+
+    Sizes are "nP" where "n" is the number of periods and "P" a period of relative dates,
+    for instance "15m" or "1h".
+    """
+    match = BUCKET.match(value)
+    if not match or not int(match.group(1)):
+        raise ValueError(f"Invalid bucket: {value!r}")
+    return int(match.group(1)) * PERIODS[match.group(2)]
 
 
 def get_locations() -> list[Location]:
     """Returns a list of location"""
-    raise NotImplementedError()
+    database = get_database()
+    with database.read_connection() as conn:
+        rows = conn.execute(database.select_locations()).all()
+
+    return [Location(id=row.location_id, name=row.location_name) for row in rows]
 
 
-def get_sensors(*, location_name: str | None = None, location_id: str = None) -> list[Sensor]:
+def get_sensors(
+        *,
+        location_name: str | None = None,
+        location_id: str | None = None,
+) -> list[Sensor]:
     """
     Returns a list of sensors for specified location
 
     Only one of the parameters can be specified.
+    The location is resolved to sensor ids with the metadata index.
 
     :param location_name: Name of the location to list related sensors
     :param location_id: Id of the location to list related sensors
     """
-    raise NotImplementedError()
+    if (location_name is None) == (location_id is None):
+        raise ValueError("Exactly one of location_name or location_id must be provided.")
+
+    database = get_database()
+    index = database.metadata_index
+    location_ids = [location_id] if location_id is not None else index.location_ids([location_name])
+    sensor_ids = index.sensor_ids(location_ids)
+    if not sensor_ids:
+        return []
+
+    with database.read_connection() as conn:
+        rows = conn.execute(database.select_sensors(sensor_ids=sensor_ids)).all()
+
+    sensors: dict[str, Sensor] = {}
+    for row in rows:
+        sensor = sensors.get(row.sensor_id)
+        if sensor is None:
+            sensor = Sensor(
+                id=row.sensor_id,
+                name=row.sensor_name,
+                location=Location(id=row.location_id, name=row.location_name),
+                measurements=[],
+            )
+            sensors[row.sensor_id] = sensor
+        if row.measurement_name is not None:
+            sensor.measurements.append(
+                MeasurementType(
+                    name=row.measurement_name,
+                    unit=row.unit,
+                    default_format=row.string_format,
+                ),
+            )
+
+    return list(sensors.values())
 
 
 def get_measurements(
@@ -33,7 +106,8 @@ def get_measurements(
     """
     Read measurements
 
-    Location must be provided only by name or ids
+    Location must be provided only by name or ids, names are resolved to ids with the
+    metadata index.
 
     Date are provided:
     - as ISO8601 formatted strings for absolute value.
@@ -49,14 +123,388 @@ def get_measurements(
 
     When both start_time and end_time are set to "NOW", returns the last measurements
 
+    The current time is aligned on the query_time_granularity setting, see resolve_window.
+
+    :param measurements: list of measurement names
+    :param sensor_ids: list of sensor ids
+    :param location_names: list of location names
+    :param location_ids: list of location ids
+    :param start_time: start time
+    :param end_time: end time
+    """
+    if location_names is not None and location_ids is not None:
+        raise ValueError("Location must be provided only by name or ids.")
+
+    now = datetime.datetime.utcnow()
+    start, end, last_only = _query_window(start_time, end_time, now)
+    if not measurements:
+        return []
+
+    database = get_database()
+    if location_names is not None:
+        location_ids = database.metadata_index.location_ids(location_names)
+        if not location_ids:
+            return []
+
+    with database.read_connection() as conn:
+        series_ids = conn.execute(database.select_series_ids(
+            measurements,
+            sensor_ids=sensor_ids,
+            location_ids=location_ids,
+        )).scalars().all()
+        if last_only:
+            rows = list(itertools.chain(*database.scatter_measurements(
+                conn,
+                series_ids,
+                lambda shard_conn, shard_series_ids: shard_conn.execute(
+                    database.select_measurements(shard_series_ids, last_only=True),
+                ).all(),
+            )))
+        else:
+            rows = database.block_cache.measurements(conn, series_ids, start, end, now)
+        series = database.series_cache.keys(conn, {row.series_id for row in rows})
+
+    return _rows_to_measurements(database, _sort_rows(rows, series), series)
+
+
+def get_measurement_buckets(
+        *,
+        measurements: list[str],
+        bucket: str,
+        sensor_ids: list[str] | None = None,
+        location_names: list[str] | None = None,
+        location_ids: list[str] | None = None,
+        start_time: str = "TODAY",
+        end_time: str = "TODAY",
+) -> list[MeasurementBucket]:
+    """
+    Read the average of measurements per time bucket
+
+    Buckets are "nP" sizes, see parse_bucket. Each bucket is dated at its start, buckets are
+    aligned on 1970-01-01 UTC and computed by the database. Series with measurements in the
+    window get a null value for their empty buckets.
+
+    Filters and dates are the same as for measurements, except that the last measurements
+    can not be read.
+
     :param measurements: list of measurement names
+    :param bucket: bucket size
     :param sensor_ids: list of sensor ids
     :param location_names: list of location names
     :param location_ids: list of location ids
     :param start_time: start time
     :param end_time: end time
     """
-    raise NotImplementedError()
+    if location_names is not None and location_ids is not None:
+        raise ValueError("Location must be provided only by name or ids.")
+
+    start, end, last_only = _query_window(start_time, end_time, datetime.datetime.utcnow())
+    bucket_size = _check_bucket(bucket, start, end, last_only)
+    if not measurements:
+        return []
+
+    database = get_database()
+    if location_names is not None:
+        location_ids = database.metadata_index.location_ids(location_names)
+        if not location_ids:
+            return []
+
+    with database.read_connection() as conn:
+        series_ids = conn.execute(database.select_series_ids(
+            measurements,
+            sensor_ids=sensor_ids,
+            location_ids=location_ids,
+        )).scalars().all()
+        rows = _read_buckets(database, conn, series_ids, bucket_size, start, end)
+        series = database.series_cache.keys(conn, {row.series_id for row in rows})
+
+    return _rows_to_measurements(database, _sort_rows(rows, series), series, MeasurementBucket)
+
+
+def _check_bucket(bucket: str, start: datetime.datetime, end: datetime.datetime,
+                  last_only: bool) -> datetime.timedelta:
+    """Converts the bucket size of a query, checking the number of buckets."""
+    if last_only:
+        raise ValueError("bucket can not be used to read the last measurements.")
+
+    bucket_size = parse_bucket(bucket)
+    if (align(end, bucket_size) - align(start, bucket_size)) // bucket_size >= MAX_BUCKETS:
+        raise ValueError(f"More than {MAX_BUCKETS} buckets of {bucket!r}, use larger buckets.")
+    return bucket_size
+
+
+def _read_buckets(database, conn, series_ids, bucket: datetime.timedelta,
+                  start: datetime.datetime, end: datetime.datetime) -> list:
+    """
+    Reads the average of series per bucket, the database returns a row per bucket.
+
+    Empty buckets of series with measurements in [start, end] are filled with null values.
+    """
+    rows = list(itertools.chain(*database.scatter_measurements(
+        conn,
+        series_ids,
+        lambda shard_conn, shard_series_ids: shard_conn.execute(
+            database.select_buckets(
+                shard_series_ids,
+                bucket,
+                shard_conn.dialect.name,
+                start_time=start,
+                end_time=end,
+            ),
+        ).all(),
+    )))
+
+    present = {(row.series_id, row.measurement_datetime) for row in rows}
+    for series_id in {row.series_id for row in rows}:
+        date = align(start, bucket)
+        while date <= end:
+            if (series_id, date) not in present:
+                rows.append(MeasurementRow(series_id, date, None))
+            date += bucket
+    return rows
+
+
+def _query_window(start_time: str, end_time: str, now: datetime.datetime) -> TimeWindow:
+    """Converts query start and end dates with the configured precision of the current time."""
+    return resolve_window(
+        start_time,
+        end_time,
+        now,
+        granularity=datetime.timedelta(
+            seconds=get_server_config().get_float("query_time_granularity"),
+        ),
+    )
+
+
+def _sort_key(series: dict):
+    """Sort key of measurement rows, by date and sensor."""
+    def key(row) -> tuple:
+        return (
+            row.measurement_datetime,
+            series[row.series_id].sensor_id if row.series_id in series else "",
+        )
+    return key
+
+
+def _sort_rows(rows: list, series: dict) -> list:
+    """Sorts measurement rows by date and sensor."""
+    rows.sort(key=_sort_key(series))
+    return rows
+
+
+def _series_details(database, series: dict) -> dict[int, tuple[Sensor, MeasurementType]]:
+    """
+    Builds the sensor and measurement type of series from the cached dimensions.
+
+    Series of unknown sensors, locations or measurement types are left out.
+    """
+    dimensions = database.metadata_index.dimensions(
+        (key.sensor_id for key in series.values()),
+        (key.location_id for key in series.values()),
+        (key.measurement_name for key in series.values()),
+    )
+
+    sensors: dict[int, tuple[Sensor, MeasurementType]] = {}
+    for series_id, key in series.items():
+        details = dimensions.measurement_types.get(key.measurement_name)
+        if (details is None or key.sensor_id not in dimensions.sensor_names
+                or key.location_id not in dimensions.location_names):  # noqa
+            continue
+        measurement_type = MeasurementType(
+            name=key.measurement_name,
+            unit=details.unit,
+            default_format=details.string_format,
+        )
+        sensors[series_id] = (
+            Sensor(
+                id=key.sensor_id,
+                name=dimensions.sensor_names[key.sensor_id],
+                location=Location(
+                    id=key.location_id,
+                    name=dimensions.location_names[key.location_id],
+                ),
+                measurements=[measurement_type],
+            ),
+            measurement_type,
+        )
+
+    return sensors
+
+
+def _rows_to_measurements(database, rows, series: dict, measurement_class=Measurement) -> list:
+    """
+    Converts measurement rows to Measurements using the cached series and dimensions.
+
+    Measurements of unknown sensors, locations or measurement types are left out.
+
+    :param measurement_class: Measurement or MeasurementBucket
+    """
+    sensors = _series_details(database, series)
+    return [
+        measurement_class(
+            sensor=sensors[row.series_id][0],
+            measurement=sensors[row.series_id][1],
+            date=row.measurement_datetime,
+            value=row.measurement_value,
+        )
+        for row in rows
+        if row.series_id in sensors
+    ]
+
+
+def stream_measurements(
+        *,
+        measurements: list[str],
+        sensor_ids: list[str] | None = None,
+        location_names: list[str] | None = None,
+        location_ids: list[str] | None = None,
+        start_time: str = "TODAY",
+        end_time: str = "TODAY",
+        chunk_size: int = 1000,
+) -> typing.Iterator[list[tuple[sqlalchemy.engine.Row, Sensor, MeasurementType]]]:
+    """
+    Reads measurements in chunks, as get_measurements does.
+
+    Parameters are checked before returning. Rows are read with a server-side cursor and
+    converted one chunk at a time, so memory is bounded by the chunk size. Ranges are
+    read from the database without the block cache.
+
+    :param chunk_size: Number of measurements per chunk
+    :return: Chunks of measurements with their sensor and measurement type
+    """
+    if location_names is not None and location_ids is not None:
+        raise ValueError("Location must be provided only by name or ids.")
+
+    start, end, last_only = _query_window(start_time, end_time, datetime.datetime.utcnow())
+    if not measurements:
+        return iter(())
+
+    database = get_database()
+    if location_names is not None:
+        location_ids = database.metadata_index.location_ids(location_names)
+        if not location_ids:
+            return iter(())
+
+    series_query = database.select_series_ids(
+        measurements,
+        sensor_ids=sensor_ids,
+        location_ids=location_ids,
+    )
+    return _stream_chunks(
+        database,
+        series_query,
+        None if last_only else start,
+        None if last_only else end,
+        last_only,
+        chunk_size,
+    )
+
+
+def _stream_chunks(database, series_query, start, end, last_only: bool, chunk_size: int):
+    """
+    Streams the measurements of series with their series details.
+
+    Each shard holding some of the series streams its rows sorted by date, the rows are
+    merged by date then sorted by sensor within a date.
+    """
+    with database.read_connection() as conn, contextlib.ExitStack() as stack:
+        series_ids = conn.execute(series_query).scalars().all()
+        series = database.series_cache.keys(conn, series_ids)
+        details = _series_details(database, series)
+        results = [
+            shard_conn.execution_options(stream_results=True).execute(
+                database.select_measurements(
+                    shard_series_ids,
+                    start_time=start,
+                    end_time=end,
+                    last_only=last_only,
+                ),
+            )
+            for shard_conn, shard_series_ids in database.measurement_connections(
+                conn, series_ids, stack,
+            )
+        ]
+
+        by_date = heapq.merge(*results, key=lambda row: row.measurement_datetime)
+        rows = itertools.chain.from_iterable(
+            sorted(same_date, key=_sort_key(series))
+            for _, same_date in itertools.groupby(by_date, lambda row: row.measurement_datetime)
+        )
+        while chunk := list(itertools.islice(rows, chunk_size)):
+            yield [
+                (row, *details[row.series_id])
+                for row in chunk
+                if row.series_id in details
+            ]
+
+
+def get_percentiles(
+        *,
+        measurements: list[str],
+        percentiles: list[float],
+        sensor_ids: list[str] | None = None,
+        location_names: list[str] | None = None,
+        location_ids: list[str] | None = None,
+        start_time: str = "TODAY",
+        end_time: str = "TODAY",
+) -> list[MeasurementPercentiles]:
+    """
+    Estimates percentiles of measurements over all matching sensors.
+
+    Whole buckets of the time range are read from the quantile sketches, only measurements of
+    the partial buckets at both ends are read. Percentiles are within the relative accuracy
+    of the sketches (sketch_relative_accuracy) of an actual measurement.
+
+    Filters and dates are the same as for measurements.
+
+    :param measurements: list of measurement names
+    :param percentiles: list of percentiles, between 0 and 100
+    :param sensor_ids: list of sensor ids
+    :param location_names: list of location names
+    :param location_ids: list of location ids
+    :param start_time: start time
+    :param end_time: end time
+    """
+    if location_names is not None and location_ids is not None:
+        raise ValueError("Location must be provided only by name or ids.")
+    for percentile in percentiles:
+        if not 0 <= percentile <= 100:
+            raise ValueError(f"Invalid percentile: {percentile!r}")
+
+    start, end, _ = _query_window(start_time, end_time, datetime.datetime.utcnow())
+    database = get_database()
+    if location_names is not None:
+        location_ids = database.metadata_index.location_ids(location_names)
+
+    types = database.metadata_index.dimensions((), (), measurements).measurement_types
+    results = []
+    with database.read_connection() as conn:
+        for name in measurements:
+            if name not in types:
+                continue
+            series_ids = conn.execute(database.select_series_ids(
+                [name],
+                sensor_ids=sensor_ids,
+                location_ids=location_ids,
+            )).scalars().all()
+            sketch = database.sketches.merged(conn, series_ids, start, end)
+            values = sketch.quantiles(percentile / 100 for percentile in percentiles)
+            results.append(MeasurementPercentiles(
+                measurement=MeasurementType(
+                    name=name,
+                    unit=types[name].unit,
+                    default_format=types[name].string_format,
+                ),
+                count=sketch.count,
+                min=sketch.min if sketch.count else None,
+                max=sketch.max if sketch.count else None,
+                percentiles=[
+                    Percentile(percentile=percentile, value=value)
+                    for percentile, value in zip(percentiles, values)
+                ],
+            ))
+
+    return results
 
 
 @strawberry.type
@@ -66,3 +514,7 @@ class Query:
     locations: list[Location] = strawberry.field(resolver=get_locations)
     sensors: list[Sensor] = strawberry.field(resolver=get_sensors)
     measurements: list[Measurement] = strawberry.field(resolver=get_measurements)
+    measurement_buckets: list[MeasurementBucket] = strawberry.field(
+        resolver=get_measurement_buckets,
+    )
+    percentiles: list[MeasurementPercentiles] = strawberry.field(resolver=get_percentiles)
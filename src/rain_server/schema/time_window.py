@@ -0,0 +1,132 @@
+"""Query time windows"""
+import datetime
+import functools
+import re
+import typing
+
+from ..configuration.buckets import align
+
+RELATIVE_TIME = re.compile(r"^-(\d+)([mhdw])$")
+PERIODS = {
+    "m": datetime.timedelta(minutes=1),
+    "h": datetime.timedelta(hours=1),
+    "d": datetime.timedelta(days=1),
+    "w": datetime.timedelta(weeks=1),
+}
+
+
+class TimeExpression(typing.NamedTuple):
+    """
+    Parsed query date.
+
+    kind is "absolute" with the naive UTC date as value, "relative" with the offset before
+    the current time as value, or "now" and "today" without value.
+    """
+
+    kind: str
+    value: datetime.datetime | datetime.timedelta | None = None
+
+    def resolve(self, now: datetime.datetime, *, is_end: bool = False) -> datetime.datetime:
+        """
+        Converts the expression to an UTC datetime.
+
+        :param now: Current UTC time
+        :param is_end: The date is an end date ("TODAY" means "NOW")
+        :return: Naive UTC datetime
+        """
+        if self.kind == "absolute":
+            return self.value
+        if self.kind == "relative":
+            return now - self.value
+        if self.kind == "today" and not is_end:
+            return now.replace(hour=0, minute=0, second=0, microsecond=0)
+        return now
+
+
+class TimeWindow(typing.NamedTuple):
+    """
+    Resolved query window, hashable to be used as a cache key.
+
+    last_only is set when both dates are "NOW", the last measurements are read instead.
+    """
+
+    start: datetime.datetime
+    end: datetime.datetime
+    last_only: bool = False
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_expression(value: str) -> TimeExpression:
+    """
+    Parses a query date, expressions are cached so each one is only parsed once.
+
+    :param value: ISO8601 date, "-nP" offset, "TODAY" or "NOW"
+    """
+    if value == "NOW":
+        return TimeExpression("now")
+    if value == "TODAY":
+        return TimeExpression("today")
+
+    if value.startswith("-"):
+        relative = RELATIVE_TIME.match(value)
+        if relative:
+            return TimeExpression(
+                "relative",
+                int(relative.group(1)) * PERIODS[relative.group(2)],
+            )
+
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid date: {value!r}") from None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return TimeExpression("absolute", parsed)
+
+
+def parse_time(value: str, now: datetime.datetime, *, is_end: bool = False) -> datetime.datetime:
+    """
+    Converts a query date to an UTC datetime.
+
+    :param value: ISO8601 date, "-nP" offset, "TODAY" or "NOW"
+    :param now: Current UTC time
+    :param is_end: The date is an end date ("TODAY" means "NOW")
+    :return: Naive UTC datetime
+    """
+    return parse_expression(value).resolve(now, is_end=is_end)
+
+
+def resolve_window(
+        start_time: str,
+        end_time: str,
+        now: datetime.datetime,
+        *,
+        granularity: datetime.timedelta | None = None,
+) -> TimeWindow:
+    """
+    Converts query start and end dates to a window, checking their order.
+
+    With a granularity, the current time is aligned on it (from 1970-01-01 UTC) before
+    resolving "NOW", "TODAY" and "-nP". Queries relative to the current time then get the
+    same window until the next multiple of the granularity, at the cost of leaving out the
+    measurements received since. Absolute dates are kept as is.
+
+    :param start_time: Start date expression
+    :param end_time: End date expression
+    :param now: Current UTC time
+    :param granularity: Precision of the current time, exact if None
+    """
+    start_expression = parse_expression(start_time)
+    end_expression = parse_expression(end_time)
+    if granularity:
+        now = align(now, granularity)
+
+    start = start_expression.resolve(now)
+    end = end_expression.resolve(now, is_end=True)
+    if start > end:
+        raise ValueError(f"start_time {start_time!r} is after end_time {end_time!r}.")
+    return TimeWindow(
+        start,
+        end,
+        start_expression.kind == "now" and end_expression.kind == "now",
+    )
@@ -0,0 +1,5 @@
+"""HTTP server"""
+__all__ = ["PreforkServer", "create_app"]
+
+from .app import create_app
+from .prefork import PreforkServer
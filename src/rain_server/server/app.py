@@ -0,0 +1,32 @@
+"""HTTP application serving the GraphQL schema."""
+import flask
+
+from ..configuration import get_database
+from ..monitoring import get_registry
+from ..schema import schema
+from .batching import BatchGraphQLView
+from .ingest import ingest
+from .streaming import measurements
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metrics() -> flask.Response:
+    """Exposes the process metrics in the Prometheus text format."""
+    return flask.Response(get_registry().render(), content_type=METRICS_CONTENT_TYPE)
+
+
+def create_app() -> flask.Flask:
+    """Creates the Flask application and builds the metadata index of the worker."""
+    get_database().metadata_index.rebuild()
+
+    app = flask.Flask("rain_server")
+    app.add_url_rule(
+        "/graphql",
+        view_func=BatchGraphQLView.as_view("graphql_view", schema=schema),
+    )
+    app.add_url_rule("/ingest", view_func=ingest, methods=["POST"])
+    app.add_url_rule("/measurements", view_func=measurements, methods=["GET"])
+    app.add_url_rule("/metrics", view_func=metrics, methods=["GET"])
+
+    return app
@@ -0,0 +1,85 @@
+"""Concurrent execution of batched GraphQL operations."""
+import concurrent.futures
+import json
+import threading
+
+import flask
+from cross_web import HTTPException
+from strawberry.flask.views import GraphQLView
+
+from ..configuration import get_server_config
+
+_executor: concurrent.futures.ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def get_batch_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Returns the thread pool shared by all batch requests of the process."""
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=get_server_config().get_int("batch_threads"),
+                thread_name_prefix="graphql-batch",
+            )
+        return _executor
+
+
+class BatchGraphQLView(GraphQLView):
+    """
+    GraphQL view executing the operations of a batch request concurrently.
+
+    A POST whose body is a JSON array of operations returns an array of results in the same
+    order. The batch size is limited by the schema batching configuration and concurrency
+    by the shared batch thread pool.
+
+    Each operation of a batch gets its own context from get_context and its own
+    sub-response, headers and status code they set are copied to the response once all
+    operations ended.
+    """
+
+    def execute_operation(self, request, context, root_value, sub_response):
+        """Executes a single operation, or all the operations of a batch concurrently."""
+        request_adapter = self.request_adapter_class(request)
+        try:
+            request_data = self.parse_http_body(request_adapter)
+        except json.JSONDecodeError as e:
+            raise HTTPException(400, "Unable to parse request body as JSON") from e
+        except KeyError as e:
+            # Multipart request referencing a missing file.
+            raise HTTPException(400, "File(s) missing in form data") from e
+
+        if not isinstance(request_data, list):
+            return self.execute_single(
+                request, request_adapter, sub_response, context, root_value, request_data,
+            )
+
+        executor = get_batch_executor()
+        responses = [self.get_sub_response(request) for _ in request_data]
+        futures = [
+            executor.submit(
+                # Each operation gets its own copy of the request context.
+                flask.copy_current_request_context(self.execute_single),
+                request,
+                request_adapter,
+                response,
+                self.get_context(request, response),
+                root_value,
+                data,
+            )
+            for data, response in zip(request_data, responses)
+        ]
+        results = [future.result() for future in futures]
+        for response in responses:
+            merge_response(sub_response, response)
+        return results
+
+
+def merge_response(target: flask.Response, source: flask.Response):
+    """Copies the status code and the headers an operation set on its sub-response."""
+    if source.status_code != 200:
+        target.status_code = source.status_code
+    for key, value in source.headers.items():
+        if key.lower() not in {"content-type", "content-length"}:
+            target.headers[key] = value
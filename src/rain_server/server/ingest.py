@@ -0,0 +1,137 @@
+"""Compact measurement ingest endpoint."""
+import math
+
+import flask
+
+from ..configuration import get_database
+from ..ingest import (IngestRecord, get_journal, parse_line_protocol,
+                      parse_msgpack, protocols)
+from ..monitoring.instruments import REQUEST_ERRORS, REQUEST_PHASE_SECONDS
+from ..schema.errors import (AuthenticationError, InvalidSensorError,
+                             RateLimitError)
+from ..schema.mutation import (journal_record, measurement_row,
+                               validate_measurement)
+
+LINE_PROTOCOL_TYPES = {"text/plain"}
+MSGPACK_TYPES = {"application/msgpack", "application/x-msgpack"}
+
+ERROR_CODES = {
+    ValueError: "INVALID_FORMAT",
+    InvalidSensorError: "INVALID_SENSOR",
+    AuthenticationError: "AUTHENTICATION_FAILED",
+    RateLimitError: "RATE_LIMITED",
+}
+
+
+def write_records(records: list[IngestRecord | ValueError]) -> list[tuple[int, Exception]]:
+    """
+    Validates measurements as add_measurement does and stores the valid ones.
+
+    :param records: Parsed measurements or parsing errors
+    :return: Index and error of the rejected measurements
+    """
+    database = get_database()
+    journal = get_journal()
+    rejected = []
+    rows = []
+    sensors: dict = {}
+
+    connect = database.engine.begin if journal is None else database.read_connection
+    with connect() as conn:
+        for index, record in enumerate(records):
+            if isinstance(record, ValueError):
+                rejected.append((index, record))
+                continue
+            try:
+                d_sensor = validate_measurement(
+                    conn,
+                    record.sensor_id,
+                    record.measurement_name,
+                    record.measurement_date,
+                    record.measurement_value,
+                    record.signature,
+                    record.session_token,
+                    sensors,
+                )
+            except (InvalidSensorError, AuthenticationError, RateLimitError) as e:
+                rejected.append((index, e))
+                continue
+            if journal is not None:
+                rows.append(journal_record(
+                    d_sensor, record.measurement_date, record.measurement_value,
+                ))
+            else:
+                rows.append(measurement_row(
+                    conn, d_sensor, record.measurement_date, record.measurement_value,
+                ))
+
+        if rows and journal is None:
+            with REQUEST_PHASE_SECONDS.time(phase="insert"):
+                database.insert_measurements(conn, rows)
+
+    if rows and journal is not None:
+        with REQUEST_PHASE_SECONDS.time(phase="journal"):
+            journal.append(rows)
+
+    for _, error in rejected:
+        REQUEST_ERRORS.inc(error=type(error).__name__)
+    return rejected
+
+
+def acknowledge(rejected: list[tuple[int, Exception]], msgpack: bool) -> flask.Response:
+    """
+    Builds the response of the ingest endpoint.
+
+    - 204 without body when every measurement was accepted.
+    - 429 with a Retry-After header when a measurement was rate limited, else 400, listing
+    the rejected measurements. Accepted measurements are stored either way. Retry-After is
+    left out when the limits reached are never refilled.
+    """
+    if not rejected:
+        return flask.Response(status=204)
+
+    errors = [
+        {"index": index, "code": ERROR_CODES[type(error)], "message": str(error)}
+        for index, error in rejected
+    ]
+    if msgpack:
+        response = flask.Response(
+            protocols.pack_msgpack(errors),
+            content_type="application/msgpack",
+        )
+    else:
+        response = flask.Response(
+            "".join(f"{e['index']} {e['code']} {e['message']}\n" for e in errors),
+            content_type="text/plain; charset=utf-8",
+        )
+
+    retry_after = [e.retry_after for _, e in rejected if isinstance(e, RateLimitError)]
+    if retry_after:
+        response.status_code = 429
+        finite = [value for value in retry_after if math.isfinite(value)]
+        if finite:
+            response.headers["Retry-After"] = str(math.ceil(max(finite)))
+    else:
+        response.status_code = 400
+    return response
+
+
+def ingest() -> flask.Response:
+    """
+    Adds measurements encoded in line protocol or MessagePack.
+
+    See rain_server.ingest.protocols for the encodings.
+    """
+    content_type = flask.request.mimetype
+    if content_type in LINE_PROTOCOL_TYPES:
+        records = parse_line_protocol(flask.request.get_data(as_text=True))
+        return acknowledge(write_records(records), msgpack=False)
+
+    if content_type in MSGPACK_TYPES and protocols.msgpack is not None:
+        try:
+            records = parse_msgpack(flask.request.get_data())
+        except ValueError as e:
+            return flask.Response(str(e), status=400)
+        return acknowledge(write_records(records), msgpack=True)
+
+    return flask.Response("Unsupported content type", status=415)
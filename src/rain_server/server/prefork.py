@@ -0,0 +1,225 @@
+"""Pre-forking HTTP server running the application on several processes."""
+import os
+import signal
+import socket
+import threading
+import time
+import typing
+
+import werkzeug.serving
+
+from ..configuration import get_logger, reset_database
+from ..ingest import reset_journal
+
+
+class WorkerServer(werkzeug.serving.ThreadedWSGIServer):
+    """
+    Threaded WSGI server with a bounded number of concurrent requests.
+
+    Request threads are joined on close so in-flight requests are drained.
+    """
+
+    daemon_threads = False
+
+    def __init__(self, *args, threads: int, **kwargs):
+        """
+        Setups the server.
+
+        :param threads: Maximum number of concurrent requests
+        """
+        self._slots = threading.BoundedSemaphore(threads)
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        """Waits for a free slot before handling a request."""
+        self._slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        """Handles the request then frees its slot."""
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
+
+
+class PreforkServer:
+    """
+    Binds a listening socket then forks workers sharing it.
+
+    Each worker creates its own database engine after fork and serves requests on a
+    thread pool. On SIGTERM/SIGINT, workers stop accepting connections and finish
+    in-flight requests; workers still running after graceful_timeout are killed.
+
+    Workers exiting unexpectedly are replaced after a delay doubling from restart_delay
+    up to max_restart_delay on each exit. The delay is reset once a worker ran longer than
+    max_restart_delay.
+    """
+
+    def __init__(
+            self,
+            app_factory: typing.Callable[[], typing.Any],
+            *,
+            host: str,
+            port: int,
+            workers: int = 1,
+            threads: int = 16,
+            backlog: int = 2048,
+            keep_alive: float = 5,
+            graceful_timeout: float = 30,
+            restart_delay: float = 0.1,
+            max_restart_delay: float = 30,
+    ):
+        """
+        Setups the server.
+
+        :param app_factory: Creates the WSGI application, called in each worker
+        :param host: Address to listen to
+        :param port: Port to listen to
+        :param workers: Number of worker processes
+        :param threads: Maximum concurrent requests per worker
+        :param backlog: Listen queue size
+        :param keep_alive: Idle time in seconds before closing keep-alive connections
+        :param graceful_timeout: Time given to workers to finish on shutdown
+        :param restart_delay: Time in seconds before replacing the first worker that exited
+        :param max_restart_delay: Maximum time in seconds before replacing a worker
+        """
+        if workers < 1:
+            raise ValueError("At least one worker is required.")
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.backlog = backlog
+        self.keep_alive = keep_alive
+        self.graceful_timeout = graceful_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        self._socket: socket.socket | None = None
+        # Start time of each worker, by pid.
+        self._children: dict[int, float] = {}
+        self._stopping = False
+        self._restarts = 0
+        self._spawn_after = 0.0
+
+    def run(self):
+        """Serves until SIGTERM or SIGINT is received."""
+        logger = get_logger()
+        self._socket = socket.create_server((self.host, self.port), backlog=self.backlog)
+        self._socket.set_inheritable(True)
+        logger.info(f"Listening on {self.host}:{self.port} with {self.workers} workers")
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        try:
+            while not self._stopping:
+                while self._can_spawn():
+                    self._spawn()
+                self._reap()
+                time.sleep(0.1)
+        finally:
+            self._shutdown()
+            self._socket.close()
+
+    def _handle_stop(self, signum, frame):
+        """Requests the server to stop."""
+        self._stopping = True
+
+    def _can_spawn(self) -> bool:
+        """Tells whether a worker is missing and may be started now."""
+        if self._stopping or len(self._children) >= self.workers:
+            return False
+        return time.monotonic() >= self._spawn_after
+
+    def _spawn(self):
+        """Forks a new worker."""
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            exit_code = 1
+            try:
+                self._serve()
+                exit_code = 0
+            except BaseException:
+                get_logger().exception("Worker failed")
+            finally:
+                os._exit(exit_code)
+
+        self._children[pid] = time.monotonic()
+
+    def _reap(self):
+        """Forgets workers that exited, delaying their replacement."""
+        for pid in list(self._children):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                started = self._children.pop(pid)
+                if not self._stopping:
+                    get_logger().error(
+                        f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}",
+                    )
+                    self._delay_restart(started)
+
+    def _delay_restart(self, started: float):
+        """
+        Postpones the next spawn after a worker exited.
+
+        :param started: Monotonic time the worker was started at
+        """
+        now = time.monotonic()
+        if now - started > self.max_restart_delay:
+            self._restarts = 0
+        delay = min(self.restart_delay * 2 ** self._restarts, self.max_restart_delay)
+        self._restarts += 1
+        self._spawn_after = now + delay
+
+    def _shutdown(self):
+        """Stops all workers, killing those that don't drain in time."""
+        logger = get_logger()
+        for pid in self._children:
+            os.kill(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.graceful_timeout
+        while self._children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+
+        for pid in self._children:
+            logger.warning(f"Worker {pid} did not stop in time, killing it")
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self._children.clear()
+
+    def _serve(self):  # pragma: no cover
+        """Worker main loop."""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        reset_database()
+
+        handler = type(
+            "KeepAliveRequestHandler",
+            (werkzeug.serving.WSGIRequestHandler,),
+            {"timeout": self.keep_alive},
+        )
+        server = WorkerServer(
+            self.host,
+            self.port,
+            self.app_factory(),
+            handler=handler,
+            fd=self._socket.fileno(),
+            threads=self.threads,
+        )
+
+        def stop(signum, frame):
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            reset_journal(self.graceful_timeout)
+            reset_database()
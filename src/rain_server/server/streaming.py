@@ -0,0 +1,104 @@
+"""Streamed JSON endpoint for large measurement results."""
+import json
+import math
+import typing
+
+import flask
+
+from ..configuration import get_server_config
+from ..schema.data_schemas import MeasurementType, Sensor
+from ..schema.query import stream_measurements
+
+JSON_TYPE = "application/json"
+PREFIX = '{"data":{"measurements":['
+SUFFIX = "]}}"
+
+
+def encode_series(sensor: Sensor, measurement_type: MeasurementType) -> str:
+    """
+    Encodes the fields shared by all measurements of a series.
+
+    :return: Start of a measurement JSON object, followed by its date and value
+    """
+    measurement = {
+        "name": measurement_type.name,
+        "unit": measurement_type.unit,
+        "defaultFormat": measurement_type.default_format,
+    }
+    encoded = json.dumps({
+        "sensor": {
+            "id": sensor.id,
+            "name": sensor.name,
+            "location": {"id": sensor.location.id, "name": sensor.location.name},
+            "measurements": [measurement],
+        },
+        "measurement": measurement,
+    }, separators=(",", ":"))
+    return encoded[:-1] + ',"date":"'
+
+
+def encode_value(value: float | None) -> str:
+    """Encodes a value, JSON has no NaN nor infinity."""
+    if value is None or not math.isfinite(value):
+        return "null"
+    return repr(float(value))
+
+
+def encode_chunks(chunks: typing.Iterable[list]) -> typing.Iterator[str]:
+    """
+    Encodes chunks of measurements as the data of a measurements GraphQL query.
+
+    The fields of each series are encoded once, each measurement only adds its date
+    and value.
+
+    :param chunks: Chunks returned by stream_measurements
+    """
+    prefixes: dict[int, str] = {}
+    separator = ""
+    yield PREFIX
+    for chunk in chunks:
+        parts = []
+        for row, sensor, measurement_type in chunk:
+            prefix = prefixes.get(row.series_id)
+            if prefix is None:
+                prefix = prefixes[row.series_id] = encode_series(sensor, measurement_type)
+            parts.append(
+                f'{separator}{prefix}{row.measurement_datetime.isoformat()}",'
+                f'"value":{encode_value(row.measurement_value)}}}',
+            )
+            separator = ","
+        if parts:
+            yield "".join(parts)
+    yield SUFFIX
+
+
+def measurements() -> flask.Response:
+    """
+    Streams measurements as JSON, shaped as the result of a measurements GraphQL query.
+
+    Query string parameters are the arguments of the query: measurement (repeated),
+    sensor_id (repeated), location_name (repeated), location_id (repeated), start_time and
+    end_time. Every field of the measurements is returned.
+
+    Invalid parameters are answered with a 400 GraphQL-like error. Once streaming started,
+    a database error ends the response with an invalid JSON document.
+    """
+    args = flask.request.args
+    try:
+        chunks = stream_measurements(
+            measurements=args.getlist("measurement"),
+            sensor_ids=args.getlist("sensor_id") or None,
+            location_names=args.getlist("location_name") or None,
+            location_ids=args.getlist("location_id") or None,
+            start_time=args.get("start_time", "TODAY"),
+            end_time=args.get("end_time", "TODAY"),
+            chunk_size=get_server_config().get_int("stream_chunk_size"),
+        )
+    except ValueError as e:
+        return flask.Response(
+            json.dumps({"errors": [{"message": str(e)}]}),
+            status=400,
+            content_type=JSON_TYPE,
+        )
+
+    return flask.Response(encode_chunks(chunks), content_type=JSON_TYPE)
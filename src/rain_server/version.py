@@ -1,3 +1,3 @@
 """Holds version information"""
 __version__ = (0, 2, 0)
-__schema_version__ = (0, 2, 0)
+__schema_version__ = (0, 7, 0)
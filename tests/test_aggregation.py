@@ -0,0 +1,106 @@
+import random
+import unittest
+
+from src.rain_server.aggregation import QuantileSketch
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Draws values around 0, including negative values and zeros
+        """
+        generator = random.Random(42)
+        self.values = [generator.gauss(10, 20) for _ in range(10000)] + [0.0] * 100
+        self.values.sort()
+
+    def assertAccurate(self, sketch: QuantileSketch, accuracy: float):
+        for quantile in [0, 0.01, 0.25, 0.5, 0.75, 0.95, 0.99, 1]:
+            expected = self.values[round(quantile * (len(self.values) - 1))]
+            value = sketch.quantile(quantile)
+            neighbours = self.values[
+                max(round(quantile * (len(self.values) - 1)) - 1, 0):
+                round(quantile * (len(self.values) - 1)) + 2
+            ]
+            self.assertTrue(
+                any(abs(value - v) <= accuracy * abs(v) + 1e-9 for v in neighbours),
+                f"q{quantile}: {value} != {expected}",
+            )
+
+    def test_quantiles(self):
+        """
+        Test quantiles of a sketch
+
+        Expect:
+        - quantiles within the relative accuracy of the exact ones
+        - exact min and max
+        """
+        sketch = QuantileSketch(0.01)
+        for value in self.values:
+            sketch.add(value)
+
+        self.assertEqual(sketch.count, len(self.values))
+        self.assertEqual(sketch.quantile(0), self.values[0])
+        self.assertEqual(sketch.quantile(1), self.values[-1])
+        self.assertAccurate(sketch, 0.01)
+
+    def test_merge(self):
+        """
+        Test merging sketches of parts of the values
+
+        Expect:
+        - the same sketch as one built from all values
+        """
+        whole = QuantileSketch(0.01)
+        parts = [QuantileSketch(0.01) for _ in range(7)]
+        for i, value in enumerate(self.values):
+            whole.add(value)
+            parts[i % 7].add(value)
+
+        merged = QuantileSketch(0.01)
+        for part in parts:
+            merged.merge(part)
+        self.assertEqual(merged.to_json(), whole.to_json())
+
+    def test_merge_other_accuracy(self):
+        """
+        Test merging a sketch with a different accuracy
+
+        Expect:
+        - quantiles within both accuracies
+        """
+        sketch, other = QuantileSketch(0.01), QuantileSketch(0.02)
+        for value in self.values:
+            (sketch if value < 10 else other).add(value)
+
+        self.assertAccurate(sketch.merge(other), 0.03)
+
+    def test_serialization(self):
+        """
+        Test sketch serialization
+
+        Expect:
+        - same quantiles after a round trip
+        - empty sketches have no quantiles
+        """
+        sketch = QuantileSketch(0.01)
+        for value in self.values:
+            sketch.add(value)
+        copy = QuantileSketch.from_json(sketch.to_json())
+
+        self.assertEqual(copy.count, sketch.count)
+        self.assertEqual(copy.quantiles([0, 0.5, 0.99]), sketch.quantiles([0, 0.5, 0.99]))
+        self.assertEqual(QuantileSketch.from_json(QuantileSketch().to_json()).quantile(0.5), None)
+
+    def test_invalid(self):
+        """
+        Test invalid parameters
+
+        Expect:
+        - ValueError
+        """
+        self.assertRaises(ValueError, QuantileSketch, 0)
+        self.assertRaises(ValueError, QuantileSketch().quantile, 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,180 @@
+import base64
+import datetime
+import hashlib
+import hmac
 import unittest
 
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, padding, rsa
+
+from src.rain_server.authenticate import (SessionStore, check_hmac,
+                                          check_signature, get_key_type)
+
 
 class MyTestCase(unittest.TestCase):
     def test_something(self):
         self.assertEqual(True, False)  # add assertion here
 
 
+class TestCheckSignature(unittest.TestCase):
+    message = "2022-01-01 00:00:002022-01-01 00:00:001sensor"
+
+    def setUp(self) -> None:
+        """
+        Creates RSA, Ed25519, ECDSA P-256 and ECDSA P-384 keys with a signature of the message
+        """
+        message = self.message.encode("utf-8")
+        rsa_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        ed_key = ed25519.Ed25519PrivateKey.generate()
+        p256_key = ec.generate_private_key(ec.SECP256R1())
+        p384_key = ec.generate_private_key(ec.SECP384R1())
+
+        self.keys = {
+            "rsa": (rsa_key, rsa_key.sign(
+                message,
+                padding.PSS(
+                    mgf=padding.MGF1(hashes.SHA256()),
+                    salt_length=padding.PSS.MAX_LENGTH,
+                ),
+                hashes.SHA256(),
+            )),
+            "ed25519": (ed_key, ed_key.sign(message)),
+            "ecdsa-secp256r1": (p256_key, p256_key.sign(message, ec.ECDSA(hashes.SHA256()))),
+            "ecdsa-secp384r1": (p384_key, p384_key.sign(message, ec.ECDSA(hashes.SHA256()))),
+        }
+
+    @staticmethod
+    def encode_public_key(private_key) -> str:
+        """Base64 DER public key"""
+        return base64.b64encode(
+            private_key.public_key().public_bytes(
+                encoding=serialization.Encoding.DER,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo,
+            ),
+        ).decode("utf-8")
+
+    def test_key_type(self):
+        """
+        Test key type detection
+
+        Expect:
+        - key type matching the generated key
+        """
+        for key_type, (key, _) in self.keys.items():
+            self.assertEqual(get_key_type(self.encode_public_key(key)), key_type)
+
+    def test_valid_signature(self):
+        """
+        Test valid signatures of supported keys
+
+        Expect:
+        - signature accepted
+        """
+        for key_type in ["rsa", "ed25519", "ecdsa-secp256r1"]:
+            key, signature = self.keys[key_type]
+            self.assertTrue(
+                check_signature(
+                    self.message,
+                    self.encode_public_key(key),
+                    base64.b64encode(signature).decode("utf-8"),
+                ),
+                key_type,
+            )
+
+    def test_invalid_signature(self):
+        """
+        Test signature of another message, invalid encoding and unsupported curve
+
+        Expect:
+        - signature rejected
+        """
+        for key_type in ["rsa", "ed25519", "ecdsa-secp256r1"]:
+            key, signature = self.keys[key_type]
+            pubkey = self.encode_public_key(key)
+            encoded = base64.b64encode(signature).decode("utf-8")
+            self.assertFalse(check_signature(self.message + "0", pubkey, encoded), key_type)
+            self.assertFalse(check_signature(self.message, pubkey, "not a base64"), key_type)
+
+        key, signature = self.keys["ecdsa-secp384r1"]
+        self.assertFalse(
+            check_signature(
+                self.message,
+                self.encode_public_key(key),
+                base64.b64encode(signature).decode("utf-8"),
+            ),
+        )
+
+
+class TestSessions(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates a session store holding 2 sessions
+        """
+        self.now = datetime.datetime(2022, 5, 1)
+        self.store = SessionStore(b"secret", ttl=datetime.timedelta(hours=1), max_size=2)
+
+    def test_open_and_get(self):
+        """
+        Test opening a session
+
+        Expect:
+        - session retrieved from its token until it expires
+        """
+        session = self.store.open("sensor.1", self.now)
+
+        self.assertEqual(session.expires, self.now + datetime.timedelta(hours=1))
+        self.assertEqual(self.store.get(session.token, self.now), session)
+        self.assertIsNone(self.store.get(session.token, session.expires))
+
+    def test_get_evicted(self):
+        """
+        Test session evicted from the cache, or opened by another store with the same secret
+
+        Expect:
+        - session rebuilt from its token
+        """
+        session = self.store.open("sensor.1", self.now)
+        self.store.open("sensor2", self.now)
+        self.store.open("sensor3", self.now)
+
+        other_store = SessionStore(b"secret")
+        self.assertEqual(self.store.get(session.token, self.now), session)
+        self.assertEqual(other_store.get(session.token, self.now), session)
+
+    def test_get_forged(self):
+        """
+        Test tampered tokens and tokens from another secret
+
+        Expect:
+        - no session
+        """
+        token = self.store.open("sensor1", self.now).token
+        sensor_id, expires, rest = token.split(".", 2)
+        forged = f"sensor2.{expires}.{rest}"
+
+        self.assertIsNone(self.store.get(forged, self.now))
+        self.assertIsNone(self.store.get("not a token", self.now))
+        self.assertIsNone(self.store.get(f"{token[:-1]}\u00e9", self.now))
+        self.assertIsNone(SessionStore(b"other").get(token, self.now))
+
+    def test_check_hmac(self):
+        """
+        Test HMAC signatures
+
+        Expect:
+        - valid signature accepted
+        - signature of another message or with another key rejected
+        """
+        session = self.store.open("sensor1", self.now)
+        signature = base64.b64encode(
+            hmac.new(session.key, b"message", hashlib.sha256).digest(),
+        ).decode("utf-8")
+
+        self.assertTrue(check_hmac("message", session.key, signature))
+        self.assertFalse(check_hmac("message2", session.key, signature))
+        self.assertFalse(check_hmac("message", b"other", signature))
+        self.assertFalse(check_hmac("message", session.key, "not a base64"))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,1068 @@
+import datetime
+import json
+import os.path
+import tempfile
 import unittest
 
+import config
+import sqlalchemy
+
+from src.rain_server.configuration.buckets import align, bucket_start
+from src.rain_server.configuration.db_engine import (DB_DEFAULTS, DataBase,
+                                                     create_engine,
+                                                     get_db_config, get_db_url)
+from src.rain_server.configuration.metadata_index import MetadataIndex
+from src.rain_server.configuration.replicas import ReplicaSet
+from src.rain_server.configuration.shards import HashRing, ShardSet
+from src.rain_server.configuration.snapshot import ConfigSnapshot, ConfigSource
+from src.rain_server.maintenance import Retention
+from src.rain_server.version import __schema_version__
+
 
 class MyTestCase(unittest.TestCase):
     def test_something(self):
         self.assertEqual(True, False)  # add assertion here
 
 
+def create_wide_measurements(conn: sqlalchemy.engine.Connection):
+    """Creates d_measurements in the layout used before 0.4.0, with three measurements."""
+    conn.exec_driver_sql(
+        "CREATE TABLE d_measurements (location_id VARCHAR, sensor_id VARCHAR, "
+        "measurement_name VARCHAR, unit VARCHAR, measurement_datetime DATETIME, "
+        "measurement_value NUMERIC, d_created_date_utc DATETIME, "
+        "d_updated_date_utc DATETIME)",
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO d_measurements VALUES "
+        "('loc1', 'sen1', 'temperature', 'C', '2022-05-01 00:00:00.000000', 21.5, "
+        "NULL, NULL), "
+        "('loc1', 'sen1', 'temperature', 'C', '2022-05-01 00:01:00.000000', 22, "
+        "NULL, NULL), "
+        "('loc1', 'sen1', 'humidity', '%', '2022-05-01 00:00:00.000000', 40, "
+        "NULL, NULL)",
+    )
+
+
+class TestSchemaVersion(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates an in-memory SQLite engine tracking executed statements
+        """
+        self.engine = sqlalchemy.create_engine("sqlite://", future=True)
+        self.statements = []
+        sqlalchemy.event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: self.statements.append(statement),
+        )
+
+    def tearDown(self) -> None:
+        """
+        Disposes the engine
+        """
+        self.engine.dispose()
+
+    def test_first_setup(self):
+        """
+        Test setup on an empty database
+
+        Expect:
+        - tables created
+        - current schema version stored
+        """
+        database = DataBase(self.engine)
+
+        self.assertEqual(database.get_schema_version(), __schema_version__)
+        self.assertIn("d_measurements", sqlalchemy.inspect(self.engine).get_table_names())
+
+    def test_setup_up_to_date(self):
+        """
+        Test setup on an up-to-date database
+
+        Expect:
+        - a single statement reading the schema version
+        """
+        DataBase(self.engine)
+        self.statements.clear()
+
+        DataBase(self.engine)
+
+        self.assertEqual(len(self.statements), 1, self.statements)
+        self.assertIn("s_schema_version", self.statements[0])
+
+    def test_setup_outdated(self):
+        """
+        Test setup on a database with an older schema version
+
+        Expect:
+        - schema version updated
+        """
+        database = DataBase(self.engine)
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("UPDATE s_schema_version SET schema_version = '0.0.1'"))
+
+        database.setup()
+
+        self.assertEqual(database.get_schema_version(), __schema_version__)
+
+    def test_migrate_measurements(self):
+        """
+        Test setup on a database storing measurements in the layout used before 0.4.0
+
+        Expect:
+        - one series per sensor, measurement type and location
+        - measurements moved to their series with a float value
+        - sketches built from the moved measurements
+        """
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "CREATE TABLE s_schema_version (schema_version VARCHAR PRIMARY KEY, "
+                "d_updated_date_utc DATETIME)",
+            )
+            conn.exec_driver_sql("INSERT INTO s_schema_version VALUES ('0.3.0', NULL)")
+            create_wide_measurements(conn)
+
+        self.assertMigrated(DataBase(self.engine))
+
+    def test_migrate_first_release(self):
+        """
+        Test setup on a database created by the first release, without schema version
+
+        Expect:
+        - measurements moved to series as from 0.3.0
+        """
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "CREATE TABLE o_sensors (sensor_id VARCHAR PRIMARY KEY, sensor_name VARCHAR, "
+                "location_id VARCHAR, pubkey VARCHAR, is_active CHAR, "
+                "d_created_date_utc DATETIME, d_updated_date_utc DATETIME)",
+            )
+            create_wide_measurements(conn)
+
+        self.assertMigrated(DataBase(self.engine))
+
+    def test_migrate_retention_columns(self):
+        """
+        Test setup on a database created by the first release, with measurement types
+
+        Expect:
+        - retention columns added to the existing measurement types
+        - retention job running on the upgraded database
+        """
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "CREATE TABLE o_measurement_types (measurement_name VARCHAR PRIMARY KEY, "
+                "unit VARCHAR, string_format VARCHAR, d_created_date_utc DATETIME, "
+                "d_updated_date_utc DATETIME)",
+            )
+            conn.exec_driver_sql(
+                "INSERT INTO o_measurement_types VALUES ('temperature', 'C', '{}', NULL, NULL)",
+            )
+            create_wide_measurements(conn)
+
+        database = DataBase(self.engine)
+        self.assertMigrated(database)
+        with self.engine.connect() as conn:
+            row = conn.execute(sqlalchemy.select(database.measurement_types)).one()
+        self.assertEqual((row.measurement_name, row.retention_days), ("temperature", None))
+        self.assertEqual(Retention(database).run(datetime.datetime(2022, 6, 1)), [])
+
+    def assertMigrated(self, database: DataBase):
+        """Checks the measurements of create_wide_measurements were moved to series."""
+        self.assertEqual(database.get_schema_version(), __schema_version__)
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                sqlalchemy.select(
+                    database.series.c.measurement_name,
+                    database.measurements.c.measurement_value,
+                ).select_from(
+                    database.measurements.join(
+                        database.series,
+                        database.measurements.c.series_id == database.series.c.series_id,
+                    ),
+                ).order_by(database.measurements.c.measurement_datetime,
+                           database.series.c.measurement_name),
+            ).all()
+        self.assertEqual(
+            [tuple(row) for row in rows],
+            [("humidity", 40.0), ("temperature", 21.5), ("temperature", 22.0)],
+        )
+        self.assertFalse(sqlalchemy.inspect(self.engine).has_table("d_measurements_legacy"))
+        with self.engine.connect() as conn:
+            sketch = database.sketches.merged(
+                conn,
+                conn.execute(database.select_series_ids(["temperature"])).scalars().all(),
+                datetime.datetime(2022, 4, 30),
+                datetime.datetime(2022, 5, 2),
+            )
+        self.assertEqual((sketch.count, sketch.min, sketch.max), (2, 21.5, 22.0))
+
+
+class TestSeriesCache(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates an in-memory database
+        """
+        self.engine = sqlalchemy.create_engine("sqlite://", future=True)
+        self.database = DataBase(self.engine)
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+
+    def test_series_id(self):
+        """
+        Test series creation
+
+        Expect:
+        - one id per sensor, measurement type and location
+        - ids cached once committed
+        """
+        cache = self.database.series_cache
+        with self.engine.begin() as conn:
+            first = cache.series_id(conn, "sen1", "temperature", "loc1")
+            self.assertEqual(cache.series_id(conn, "sen1", "temperature", "loc1"), first)
+            second = cache.series_id(conn, "sen1", "temperature", "loc2")
+            self.assertNotEqual(first, second)
+            self.assertEqual(cache._ids, {})
+
+        self.assertEqual(len(cache._ids), 2)
+        with self.engine.connect() as conn:
+            self.assertEqual(
+                cache.keys(conn, [first, second, 99]),
+                {first: ("sen1", "temperature", "loc1"), second: ("sen1", "temperature", "loc2")},
+            )
+
+    def test_rollback(self):
+        """
+        Test series created by a rolled back transaction
+
+        Expect:
+        - the series is not cached and is created again
+        """
+        cache = self.database.series_cache
+        with self.engine.connect() as conn:
+            cache.series_id(conn, "sen1", "temperature", "loc1")
+            conn.rollback()
+        self.assertEqual(cache._ids, {})
+
+        with self.engine.begin() as conn:
+            series_id = cache.series_id(conn, "sen1", "temperature", "loc1")
+        with self.engine.connect() as conn:
+            self.assertEqual(
+                conn.execute(sqlalchemy.select(self.database.series.c.series_id)).scalars().all(),
+                [series_id],
+            )
+
+
+class TestBlockCache(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates an in-memory database with a series measured every 10 minutes
+        """
+        self.engine = sqlalchemy.create_engine("sqlite://", future=True)
+        self.database = DataBase(self.engine, block_cache_max_rows=100)
+        self.cache = self.database.block_cache
+        self.now = datetime.datetime(2022, 1, 2, 12, 30)
+        with self.engine.begin() as conn:
+            self.series_id = self.database.series_cache.series_id(
+                conn, "sen1", "temperature", "loc1",
+            )
+            self.database.insert_measurements(conn, [
+                self.row(datetime.datetime(2022, 1, 2, 9) + i * datetime.timedelta(minutes=10), i)
+                for i in range(22)
+            ], now=datetime.datetime(2022, 1, 2, 9))
+
+        self.reads = []
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", self.count_reads)
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+
+    def row(self, date, value):
+        return {"series_id": self.series_id, "measurement_datetime": date,
+                "measurement_value": float(value)}
+
+    def count_reads(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("SELECT") and "FROM d_measurements" in statement:
+            self.reads.append(parameters)
+
+    def read(self, start, end, now=None):
+        with self.engine.connect() as conn:
+            return [
+                row.measurement_value
+                for row in self.cache.measurements(conn, [self.series_id], start, end,
+                                                   now or self.now)
+            ]
+
+    def test_closed_blocks(self):
+        """
+        Test reading closed blocks twice
+
+        Expect:
+        - the same measurements
+        - closed blocks are read from the database once, the open block every time
+        """
+        start = datetime.datetime(2022, 1, 2, 9, 15)
+        end = datetime.datetime(2022, 1, 2, 12, 30)
+        first = self.read(start, end)
+        self.assertEqual(first, [float(i) for i in range(2, 22)])
+        self.assertEqual(len(self.reads), 2)
+        self.assertEqual(len(self.cache), 18)
+
+        self.assertEqual(self.read(start, end), first)
+        self.assertEqual(len(self.reads), 3)
+
+        self.assertEqual(self.read(start, datetime.datetime(2022, 1, 2, 10, 30)), first[:8])
+        self.assertEqual(len(self.reads), 3)
+
+    def test_late_write(self):
+        """
+        Test a measurement written to a closed block
+
+        Expect:
+        - only the block of the measurement is read again
+        """
+        start, end = datetime.datetime(2022, 1, 2, 9), datetime.datetime(2022, 1, 2, 11, 59)
+        self.read(start, end)
+        with self.engine.begin() as conn:
+            self.database.insert_measurements(
+                conn, [self.row(datetime.datetime(2022, 1, 2, 10, 5), 100)], now=self.now,
+            )
+
+        self.reads.clear()
+        values = self.read(start, end)
+        self.assertIn(100.0, values)
+        self.assertEqual(len(values), 19)
+        self.assertEqual(self.reads[-1][-2:], (
+            "2022-01-02 10:00:00.000000", "2022-01-02 11:00:00.000000",
+        ))
+
+    def test_poll_primary(self):
+        """
+        Test polling markers with a connection to a replica
+
+        Expect:
+        - markers read on the primary, the late written block dropped
+        """
+        replica = sqlalchemy.create_engine("sqlite://", future=True)
+        DataBase(replica)
+        self.read(datetime.datetime(2022, 1, 2, 9), datetime.datetime(2022, 1, 2, 11, 59))
+        with self.engine.begin() as conn:
+            self.database.insert_measurements(
+                conn, [self.row(datetime.datetime(2022, 1, 2, 10, 5), 100)], now=self.now,
+            )
+
+        with replica.connect() as conn:
+            self.cache.poll(conn, self.now)
+        self.assertEqual(len(self.cache), 12)
+        replica.dispose()
+
+    def test_fetch_primary(self):
+        """
+        Test reading closed blocks with a connection to a lagging replica
+
+        Expect:
+        - closed blocks read on the primary before being cached
+        """
+        replica = sqlalchemy.create_engine("sqlite://", future=True)
+        DataBase(replica)
+        with replica.connect() as conn:
+            rows = self.cache.measurements(
+                conn, [self.series_id], datetime.datetime(2022, 1, 2, 9),
+                datetime.datetime(2022, 1, 2, 11, 59), self.now,
+            )
+        self.assertEqual([row.measurement_value for row in rows], [float(i) for i in range(18)])
+        self.assertEqual(len(self.cache), 18)
+        replica.dispose()
+
+    def test_eviction(self):
+        """
+        Test the cache size limit
+
+        Expect:
+        - least recently used blocks are evicted
+        """
+        self.cache.max_rows = 12
+        self.read(datetime.datetime(2022, 1, 2, 9), datetime.datetime(2022, 1, 2, 10, 59))
+        self.read(datetime.datetime(2022, 1, 2, 11), datetime.datetime(2022, 1, 2, 11, 59))
+        self.assertEqual(len(self.cache), 12)
+        self.assertEqual(
+            [key[1].hour for key in self.cache._blocks],
+            [10, 11],
+        )
+
+    def test_marker_ttl(self):
+        """
+        Test reading after markers may have been purged
+
+        Expect:
+        - the whole cache is dropped
+        """
+        self.read(datetime.datetime(2022, 1, 2, 9), datetime.datetime(2022, 1, 2, 11, 59))
+        self.assertEqual(len(self.cache), 18)
+        with self.engine.connect() as conn:
+            self.cache.poll(conn, self.now + datetime.timedelta(hours=2))
+        self.assertEqual(len(self.cache), 0)
+
+
+class TestSketchStore(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates an in-memory database with two series measured every minute for 3 hours
+        """
+        self.engine = sqlalchemy.create_engine("sqlite://", future=True)
+        self.database = DataBase(self.engine)
+        self.start = datetime.datetime(2022, 1, 2)
+        with self.engine.begin() as conn:
+            self.series_ids = [
+                self.database.series_cache.series_id(conn, sensor_id, "temperature", "loc1")
+                for sensor_id in ["sen1", "sen2"]
+            ]
+            for offset, series_id in enumerate(self.series_ids):
+                self.database.insert_measurements(conn, [
+                    {"series_id": series_id,
+                     "measurement_datetime": self.start + datetime.timedelta(minutes=i),
+                     "measurement_value": float(i + offset * 1000)}
+                    for i in range(180)
+                ])
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+
+    def test_update(self):
+        """
+        Test sketches written on insert
+
+        Expect:
+        - one sketch per series and hour
+        - later inserts merged into the existing sketch
+        """
+        sketches = self.database.measurement_sketches
+        with self.engine.begin() as conn:
+            self.database.insert_measurements(conn, [
+                {"series_id": self.series_ids[0],
+                 "measurement_datetime": self.start + datetime.timedelta(seconds=30),
+                 "measurement_value": -5.0},
+            ])
+        with self.engine.connect() as conn:
+            self.assertEqual(
+                conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(sketches))
+                .scalar(),
+                6,
+            )
+            sketch = self.database.sketches.merged(
+                conn, self.series_ids[:1], self.start, self.start + datetime.timedelta(hours=1),
+            )
+        self.assertEqual((sketch.count, sketch.min), (62, -5.0))
+
+    def test_merged(self):
+        """
+        Test percentiles over a range starting and ending inside buckets
+
+        Expect:
+        - measurements of partial buckets included exactly
+        - only whole buckets read from sketches
+        """
+        statements = []
+        sqlalchemy.event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, parameters, *args: statements.append(parameters),
+        )
+        with self.engine.connect() as conn:
+            sketch = self.database.sketches.merged(
+                conn,
+                self.series_ids,
+                self.start + datetime.timedelta(minutes=30),
+                self.start + datetime.timedelta(minutes=150),
+            )
+
+        self.assertEqual(sketch.count, 242)
+        self.assertEqual((sketch.min, sketch.max), (30.0, 1150.0))
+        self.assertAlmostEqual(sketch.quantile(0.25), 90, delta=1)
+        self.assertEqual(len(statements), 3)
+
+
+class TestPreparedStatements(unittest.TestCase):
+    def test_prebuilt_statements(self):
+        """
+        Test hot statements are built once
+
+        Expect:
+        - the same statement objects are returned on each call
+        - the sensor lookup is compiled once for different parameters
+        """
+        engine = sqlalchemy.create_engine("sqlite://", future=True)
+        database = DataBase(engine)
+        self.assertIs(database.select_sensors_measurement(), database.select_sensors_measurement())
+        self.assertIs(database.insert_measurement, database.insert_measurement)
+
+        with engine.connect() as conn:
+            for sensor_id in ("sen1", "sen2"):
+                result = conn.execute(
+                    database.select_sensors_measurement(),
+                    {"sensor_id": sensor_id, "measurement_name": "temperature"},
+                )
+                self.assertIsNone(result.first())
+                self.assertEqual(
+                    result.context.cache_hit.name,
+                    "CACHE_MISS" if sensor_id == "sen1" else "CACHE_HIT",
+                )
+        engine.dispose()
+
+
+class TestMetadataIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates an in-memory database with:
+        - locations loc1 (home) and loc2 (garden)
+        - sensors sen1 and sen2 in loc1, sen3 in loc2
+        - sen1 measuring temperature
+        """
+        self.now = 0.0
+        self.engine = sqlalchemy.create_engine("sqlite://", future=True)
+        self.database = DataBase(self.engine)
+        self.index = MetadataIndex(
+            self.database,
+            refresh_interval=5,
+            rebuild_interval=60,
+            miss_interval=1,
+            clock=lambda: self.now,
+        )
+        self.date = datetime.datetime(2022, 5, 1)
+        with self.engine.begin() as conn:
+            conn.execute(self.database.locations.insert(), [
+                self.audit(location_id="loc1", location_name="home"),
+                self.audit(location_id="loc2", location_name="garden"),
+            ])
+            conn.execute(self.database.sensors.insert(), [
+                self.audit(sensor_id="sen1", location_id="loc1", is_active="Y"),
+                self.audit(sensor_id="sen2", location_id="loc1", is_active="Y"),
+                self.audit(sensor_id="sen3", location_id="loc2", is_active="Y"),
+            ])
+            conn.execute(self.database.sensor_measurements.insert(), [
+                self.audit(sensor_id="sen1", measurement_name="temperature"),
+            ])
+
+    def tearDown(self) -> None:
+        self.engine.dispose()
+
+    def audit(self, **values) -> dict:
+        return {"d_created_date_utc": self.date, "d_updated_date_utc": self.date, **values}
+
+    def test_build(self):
+        self.assertEqual(self.index.location_ids(["home", "unknown"]), ["loc1"])
+        self.assertEqual(self.index.sensor_ids(["loc1", "loc2"]), ["sen1", "sen2", "sen3"])
+        self.assertEqual(self.index.measurement_names("sen1"), {"temperature"})
+        self.assertEqual(self.index.measurement_names("sen2"), set())
+
+    def test_incremental_refresh(self):
+        """
+        Test changes are applied after refresh_interval
+
+        Expect:
+        - renamed location, moved and deactivated sensors, new measurement types applied
+        """
+        self.assertEqual(self.index.location_ids(["home"]), ["loc1"])
+        self.date = datetime.datetime(2022, 5, 2)
+        locations = self.database.locations
+        sensors = self.database.sensors
+        with self.engine.begin() as conn:
+            conn.execute(locations.update().where(locations.c.location_id == "loc2").values(
+                location_name="yard", d_updated_date_utc=self.date,
+            ))
+            conn.execute(sensors.update().where(sensors.c.sensor_id == "sen1").values(
+                location_id="loc2", d_updated_date_utc=self.date,
+            ))
+            conn.execute(sensors.update().where(sensors.c.sensor_id == "sen2").values(
+                is_active="N", d_updated_date_utc=self.date,
+            ))
+            conn.execute(self.database.sensor_measurements.insert(), [
+                self.audit(sensor_id="sen1", measurement_name="humidity"),
+            ])
+
+        self.assertEqual(self.index.sensor_ids(["loc1"]), ["sen1", "sen2"])
+        self.now = 5
+        self.assertEqual(self.index.sensor_ids(["loc1"]), [])
+        self.assertEqual(self.index.sensor_ids(["loc2"]), ["sen1", "sen3"])
+        self.assertEqual(self.index.location_ids(["garden", "yard"]), ["loc2"])
+        self.assertEqual(self.index.measurement_names("sen1"), {"humidity", "temperature"})
+
+    def test_miss_refresh(self):
+        """
+        Test unknown location names
+
+        Expect:
+        - a new location is found before refresh_interval
+        """
+        self.assertEqual(self.index.location_ids(["shed"]), [])
+        with self.engine.begin() as conn:
+            conn.execute(self.database.locations.insert(), [
+                self.audit(location_id="loc3", location_name="shed"),
+            ])
+        self.assertEqual(self.index.location_ids(["shed"]), [])
+        self.now = 1
+        self.assertEqual(self.index.location_ids(["shed"]), ["loc3"])
+
+    def test_created_only_refresh(self):
+        """
+        Test rows inserted without d_updated_date_utc
+
+        Expect:
+        - found by the incremental refresh using d_created_date_utc
+        """
+        self.assertEqual(self.index.sensor_ids(["loc2"]), ["sen3"])
+        with self.engine.begin() as conn:
+            conn.execute(self.database.sensors.insert(), [
+                {"sensor_id": "sen4", "location_id": "loc2", "is_active": "Y",
+                 "d_created_date_utc": datetime.datetime(2022, 5, 2)},
+            ])
+        self.now = 5
+        self.assertEqual(self.index.sensor_ids(["loc2"]), ["sen3", "sen4"])
+
+    def test_rebuild(self):
+        """
+        Test deleted rows
+
+        Expect:
+        - deleted sensors are dropped by the full rebuild
+        """
+        self.assertEqual(self.index.sensor_ids(["loc2"]), ["sen3"])
+        with self.engine.begin() as conn:
+            conn.execute(self.database.sensors.delete().where(
+                self.database.sensors.c.sensor_id == "sen3",
+            ))
+        self.now = 5
+        self.assertEqual(self.index.sensor_ids(["loc2"]), ["sen3"])
+        self.now = 60
+        self.assertEqual(self.index.sensor_ids(["loc2"]), [])
+
+
+class TestReplicaSet(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates a primary and two replicas SQLite files, each storing its name
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.engines = {}
+        for name in ["primary", "replica1", "replica2"]:
+            engine = sqlalchemy.create_engine(
+                f"sqlite:///{os.path.join(self.directory.name, name)}.db",
+                future=True,
+            )
+            with engine.begin() as conn:
+                conn.execute(sqlalchemy.text("CREATE TABLE name (name VARCHAR)"))
+                conn.execute(sqlalchemy.text("INSERT INTO name VALUES (:name)"), {"name": name})
+            self.engines[name] = engine
+
+    def tearDown(self) -> None:
+        """
+        Removes databases
+        """
+        for engine in self.engines.values():
+            engine.dispose()
+        self.directory.cleanup()
+
+    def read_name(self, replicas: ReplicaSet) -> str:
+        """Reads the name of the database used for reads"""
+        with replicas.connect() as conn:
+            return conn.execute(sqlalchemy.text("SELECT name FROM name")).scalar()
+
+    def test_no_replica(self):
+        """
+        Test reads without replicas
+
+        Expect:
+        - reads on the primary
+        """
+        replicas = ReplicaSet(self.engines["primary"])
+
+        self.assertEqual(self.read_name(replicas), "primary")
+
+    def test_round_robin(self):
+        """
+        Test reads with 2 replicas
+
+        Expect:
+        - reads alternate between replicas
+        """
+        replicas = ReplicaSet(
+            self.engines["primary"],
+            [self.engines["replica1"], self.engines["replica2"]],
+        )
+
+        self.assertListEqual(
+            [self.read_name(replicas) for _ in range(4)],
+            ["replica1", "replica2", "replica1", "replica2"],
+        )
+
+    def test_fallback(self):
+        """
+        Test reads with unavailable replicas
+
+        Expect:
+        - failing replica skipped
+        - reads on the primary once all replicas are unavailable
+        """
+        broken = sqlalchemy.create_engine(
+            f"sqlite:///{os.path.join(self.directory.name, 'missing', 'broken.db')}",
+            future=True,
+        )
+        replicas = ReplicaSet(self.engines["primary"], [broken, self.engines["replica1"]])
+
+        self.assertEqual(self.read_name(replicas), "replica1")
+        replicas.mark_unavailable(1)
+        self.assertEqual(self.read_name(replicas), "primary")
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates a database and two measurement shards in SQLite files, with three sensors
+        measured every 10 minutes
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.engines = [
+            sqlalchemy.create_engine(
+                f"sqlite:///{os.path.join(self.directory.name, name)}.db",
+                future=True,
+                connect_args={"check_same_thread": False},
+            )
+            for name in ["primary", "shard0", "shard1"]
+        ]
+        self.shards = ShardSet(self.engines[1:], names=["a", "b"])
+        self.database = DataBase(self.engines[0], shards=self.shards)
+        self.start = datetime.datetime(2022, 1, 1)
+        with self.engines[0].begin() as conn:
+            self.series_ids = {
+                sensor_id: self.database.series_cache.series_id(
+                    conn, sensor_id, "temperature", "loc1",
+                )
+                for sensor_id in ["sen1", "sen2", "sen3"]
+            }
+            self.database.insert_measurements(conn, [
+                {"series_id": series_id,
+                 "measurement_datetime": self.start + i * datetime.timedelta(minutes=10),
+                 "measurement_value": float(i)}
+                for i in range(12)
+                for series_id in self.series_ids.values()
+            ])
+
+    def tearDown(self) -> None:
+        self.shards.dispose()
+        for engine in self.engines:
+            engine.dispose()
+        self.directory.cleanup()
+
+    def count(self, engine) -> int:
+        with engine.connect() as conn:
+            return conn.execute(
+                sqlalchemy.select(sqlalchemy.func.count()).select_from(
+                    self.database.measurements,
+                ),
+            ).scalar()
+
+    def test_hash_ring(self):
+        """
+        Test consistent hashing
+
+        Expect:
+        - keys spread across shards
+        - adding a shard only moves keys to the new shard
+        """
+        keys = [f"sensor{i}" for i in range(3000)]
+        ring = HashRing(["a", "b", "c"])
+        owners = [ring.owner(key) for key in keys]
+        for index in range(3):
+            self.assertGreater(owners.count(index), 600)
+
+        larger = HashRing(["a", "b", "c", "d"])
+        for key, owner in zip(keys, owners):
+            self.assertIn(larger.owner(key), {owner, 3})
+        self.assertRaises(ValueError, HashRing, [])
+
+    def test_write(self):
+        """
+        Test writes to a sharded database
+
+        Expect:
+        - measurements stored in the shard of their sensor only
+        - sketches stored in the database
+        """
+        self.assertEqual(self.count(self.engines[0]), 0)
+        self.assertEqual(self.count(self.engines[1]) + self.count(self.engines[2]), 36)
+        for sensor_id in self.series_ids:
+            self.assertEqual(self.count(self.engines[1 + self.shards.shard(sensor_id)]) % 12, 0)
+        self.assertEqual(
+            {self.shards.shard(sensor_id) for sensor_id in self.series_ids}, {0, 1},
+        )
+
+        with self.engines[0].connect() as conn:
+            sketch = self.database.sketches.merged(
+                conn, list(self.series_ids.values()), self.start,
+                self.start + datetime.timedelta(hours=3),
+            )
+        self.assertEqual(sketch.count, 36)
+
+    def test_setup_up_to_date(self):
+        """
+        Test setup of an up-to-date sharded database
+
+        Expect:
+        - shards left untouched
+        """
+        shard = sqlalchemy.create_engine(
+            f"sqlite:///{os.path.join(self.directory.name, 'shard2')}.db", future=True,
+        )
+        shards = ShardSet([shard], names=["c"])
+        try:
+            DataBase(self.engines[0], shards=shards)
+            self.assertFalse(sqlalchemy.inspect(shard).has_table("d_measurements"))
+        finally:
+            shards.dispose()
+            shard.dispose()
+
+    def test_read(self):
+        """
+        Test reads of a sharded database
+
+        Expect:
+        - measurements of every shard, merged
+        - last measurement of each series
+        """
+        now = datetime.datetime(2022, 1, 2)
+        with self.engines[0].connect() as conn:
+            rows = self.database.block_cache.measurements(
+                conn, list(self.series_ids.values()), self.start,
+                self.start + datetime.timedelta(minutes=30), now,
+            )
+            self.assertEqual(len(rows), 12)
+            self.assertEqual(rows, sorted(rows, key=lambda row: row.measurement_datetime))
+
+            last = self.database.scatter_measurements(
+                conn,
+                self.series_ids.values(),
+                lambda shard_conn, series_ids: shard_conn.execute(
+                    self.database.select_measurements(series_ids, last_only=True),
+                ).all(),
+            )
+        self.assertEqual(len(last), 2)
+        self.assertEqual(sorted(row.measurement_value for rows in last for row in rows), [11] * 3)
+
+    def test_retention(self):
+        """
+        Test retention of a sharded database
+
+        Expect:
+        - old measurements deleted in every shard
+        - deleted ranges marked as stale in the database
+        """
+        report = Retention(self.database).delete(
+            "temperature", self.start + datetime.timedelta(hours=1),
+        )
+        self.assertEqual(report.rows_deleted, 18)
+        self.assertEqual(self.count(self.engines[1]) + self.count(self.engines[2]), 18)
+        with self.engines[0].connect() as conn:
+            markers = conn.execute(
+                sqlalchemy.select(sqlalchemy.func.count()).where(
+                    self.database.block_invalidations.c.series_id.is_(None),
+                ),
+            ).scalar()
+        self.assertEqual(markers, 2)
+
+
+class TestBuckets(unittest.TestCase):
+    def test_bucket_start(self):
+        """
+        Test time bucket expressions
+
+        Expect:
+        - date_trunc on PostgreSQL for a whole hour, date_bin for other buckets
+        - SQLite buckets aligned as align() does, dates before the epoch included
+        - ValueError for an unsupported dialect
+        """
+        column = sqlalchemy.column("measurement_datetime", sqlalchemy.DateTime)
+        dialect = sqlalchemy.dialects.postgresql.dialect()
+        self.assertIn("date_trunc", str(bucket_start(
+            column, datetime.timedelta(hours=1), "postgresql",
+        ).compile(dialect=dialect)))
+        self.assertIn("date_bin", str(bucket_start(
+            column, datetime.timedelta(minutes=15), "postgresql",
+        ).compile(dialect=dialect)))
+
+        engine = sqlalchemy.create_engine("sqlite://", future=True)
+        bucket = datetime.timedelta(minutes=15)
+        for value in [datetime.datetime(2022, 4, 29, 10, 44, 59),
+                      datetime.datetime(1969, 12, 31, 23, 50)]:
+            with engine.connect() as conn:
+                start = conn.execute(sqlalchemy.select(
+                    bucket_start(sqlalchemy.literal(value, sqlalchemy.DateTime), bucket, "sqlite")
+                )).scalar_one()
+            self.assertEqual(start, align(value, bucket))
+
+        self.assertRaises(ValueError, bucket_start, column, bucket, "mysql")
+
+
+class TestSQLite(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates a temporary directory for the database file
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "rain.db")
+
+    def tearDown(self) -> None:
+        """
+        Removes the database file
+        """
+        self.directory.cleanup()
+
+    def get_config(self, **values) -> config.ConfigurationSet:
+        """Database configuration overriding the defaults"""
+        return config.ConfigurationSet(
+            config.config_from_dict({"path": self.path, **values}),
+            get_db_config(),
+        )
+
+    def test_file_database(self):
+        """
+        Test file backed SQLite database
+
+        Expect:
+        - database created in the configured file
+        - configured pragmas applied on pooled connections
+        - pool sized from configuration
+        """
+        cfg = self.get_config(mmap_size=1048576, cache_size=-1024, busy_timeout=1000,
+                              pool_size=3)
+        engine = create_engine(cfg, get_db_url(cfg))
+        try:
+            self.assertIsInstance(engine.pool, sqlalchemy.pool.QueuePool)
+            self.assertEqual(engine.pool.size(), 3)
+            with engine.connect() as conn:
+                pragmas = {
+                    name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+                    for name in ["journal_mode", "synchronous", "mmap_size", "cache_size",
+                                 "busy_timeout"]
+                }
+        finally:
+            engine.dispose()
+
+        self.assertTrue(os.path.exists(self.path))
+        self.assertDictEqual(pragmas, {
+            "journal_mode": "wal",
+            "synchronous": 1,
+            "mmap_size": 1048576,
+            "cache_size": -1024,
+            "busy_timeout": 1000,
+        })
+
+    def test_invalid_pragma(self):
+        """
+        Test invalid journal mode
+
+        Expect:
+        - raise a ValueError
+        """
+        cfg = self.get_config(journal_mode="invalid; DROP TABLE d_measurements")
+        self.assertRaises(ValueError, create_engine, cfg, get_db_url(cfg))
+
+
+class TestConfigSource(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates a configuration file polled every 10 seconds of a fake clock
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "db.json")
+        self.now = 0.0
+        self.source = ConfigSource(self.path, "RAIN_TEST", dict(DB_DEFAULTS),
+                                   poll_interval=10, clock=lambda: self.now)
+        self.write({"pool_size": 2})
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def write(self, values: dict | str, mtime: int = 1):
+        with open(self.path, "w") as fp:
+            fp.write(values if isinstance(values, str) else json.dumps(values))
+        os.utime(self.path, (mtime, mtime))
+
+    def test_snapshot(self):
+        """
+        Test reading the configuration
+
+        Expect:
+        - file values over defaults
+        - the same snapshot until the file changes, checked once per poll interval
+        - subscribers called with both snapshots
+        - invalid files ignored
+        """
+        changes = []
+        self.source.subscribe(lambda previous, cfg: changes.append((previous, cfg)))
+        first = self.source.snapshot()
+        self.assertEqual((first.get_int("pool_size"), first.get("dialect")), (2, "sqlite"))
+
+        self.write({"pool_size": 3}, mtime=2)
+        self.now = 5
+        self.assertIs(self.source.snapshot(), first)
+        self.now = 10
+        second = self.source.snapshot()
+        self.assertEqual(second.get_int("pool_size"), 3)
+        self.assertEqual(changes, [(first, second)])
+
+        self.write("{invalid", mtime=3)
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(self.source.poll())
+        self.assertIs(self.source.snapshot(), second)
+        self.assertEqual(len(changes), 1)
+
+    def test_read_only(self):
+        """
+        Test changing a snapshot
+
+        Expect:
+        - raise a TypeError
+        """
+        snapshot = self.source.snapshot()
+        self.assertIsInstance(snapshot, ConfigSnapshot)
+        self.assertRaises(TypeError, snapshot.update, {"pool_size": 1})
+        self.assertRaises(TypeError, snapshot.__setitem__, "pool_size", 1)
+
+    def test_apply_config(self):
+        """
+        Test a reloaded configuration applied to a file database
+
+        Expect:
+        - live settings updated
+        - pool settings kept until restart, with a warning
+        """
+        cfg = config.ConfigurationSet(
+            config.config_from_dict({"path": os.path.join(self.directory.name, "rain.db")}),
+            self.source.snapshot(),
+        )
+        engine = create_engine(cfg, get_db_url(cfg))
+        try:
+            self.assertEqual(engine.pool.size(), 2)
+            database = DataBase(engine)
+            previous = self.source.snapshot()
+            self.write({"pool_size": 4, "log_queries": True, "block_cache_max_rows": 10}, 2)
+            self.source.poll()
+            with self.assertLogs(level="WARNING") as logs:
+                database.apply_config(previous, self.source.snapshot())
+
+            self.assertEqual(len(logs.output), 1)
+            self.assertIn("Connection pools keep their settings until a restart: ['pool_size']",
+                          logs.output[0])
+            self.assertEqual(engine.pool.size(), 2)
+            self.assertTrue(engine.echo)
+            engine.echo = False
+            self.assertEqual(database.block_cache.max_rows, 10)
+            with engine.connect() as conn:
+                self.assertEqual(conn.exec_driver_sql("PRAGMA journal_mode").scalar(), "wal")
+        finally:
+            engine.dispose()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,603 @@
+import base64
+import datetime
+import math
+import os
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+import msgpack
+import sqlalchemy
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from src.rain_server.configuration import get_database, reset_database
+from src.rain_server.configuration.server import SERVER_DEFAULTS
+from src.rain_server.configuration.snapshot import ConfigSnapshot
+from src.rain_server.ingest import (IngestRecord, Journal, JournalRecord,
+                                    RateLimiter, TokenBucket, journal,
+                                    parse_line_protocol, parse_msgpack,
+                                    rate_limit, reset_journal)
+from src.rain_server.ingest.journal import JournalPosition, JournalReplayer
+from src.rain_server.schema.errors import RateLimitError
+from src.rain_server.server import create_app
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(2, 2, 0)
+        self.assertEqual(bucket.acquire(0), 0)
+        self.assertEqual(bucket.acquire(0), 0)
+        self.assertAlmostEqual(bucket.acquire(0), 0.5)
+        self.assertEqual(bucket.acquire(0.5), 0)
+
+    def test_unlimited(self):
+        limiter = RateLimiter(clock=self.clock)
+        for _ in range(100):
+            self.assertEqual(limiter.check("sensor", "temperature"), 0)
+
+    def test_sensor_limit(self):
+        limiter = RateLimiter(
+            sensor_limit=(1, 2),
+            sensor_limits={"fast": (10, 10)},
+            clock=self.clock,
+        )
+        self.assertEqual(limiter.check("slow", "temperature"), 0)
+        self.assertEqual(limiter.check("slow", "temperature"), 0)
+        self.assertAlmostEqual(limiter.check("slow", "temperature"), 1)
+        self.assertEqual(limiter.check("other", "temperature"), 0)
+        for _ in range(10):
+            self.assertEqual(limiter.check("fast", "temperature"), 0)
+
+        self.clock.now = 1
+        self.assertEqual(limiter.check("slow", "temperature"), 0)
+
+    def test_measurement_limit(self):
+        limiter = RateLimiter(measurement_limits={"humidity": (1, 1)}, clock=self.clock)
+        self.assertEqual(limiter.check("sensor", "humidity"), 0)
+        self.assertGreater(limiter.check("sensor", "humidity"), 0)
+        self.assertEqual(limiter.check("sensor", "temperature"), 0)
+        self.assertEqual(limiter.check("other", "humidity"), 0)
+
+    def test_global_limit(self):
+        limiter = RateLimiter(global_limit=(1, 3), clock=self.clock)
+        for sensor_id in ("a", "b", "c"):
+            self.assertEqual(limiter.check(sensor_id, "temperature"), 0)
+        self.assertAlmostEqual(limiter.check("d", "temperature"), 1)
+
+    def test_burst_only(self):
+        limiter = RateLimiter(sensor_limit=(0, 2), clock=self.clock)
+        self.assertEqual(limiter.check("sensor", "temperature"), 0)
+        self.assertEqual(limiter.check("sensor", "temperature"), 0)
+        self.assertEqual(limiter.check("sensor", "temperature"), math.inf)
+        self.assertIn("no more measurements", str(RateLimitError(math.inf)))
+
+    def test_all_or_nothing(self):
+        limiter = RateLimiter(
+            sensor_limit=(1, 5),
+            measurement_limits={"humidity": (1, 1)},
+            clock=self.clock,
+        )
+        self.assertEqual(limiter.check("sensor", "humidity"), 0)
+        self.assertGreater(limiter.check("sensor", "humidity"), 0)
+        self.assertEqual(limiter._buckets[("sensor",)].tokens, 4)
+
+    def test_max_buckets(self):
+        limiter = RateLimiter(sensor_limit=(1, 1), max_buckets=2, clock=self.clock)
+        for sensor_id in ("a", "b", "c"):
+            limiter.check(sensor_id, "temperature")
+        self.assertEqual(len(limiter._buckets), 2)
+        # The bucket of "a" was evicted, it starts full again.
+        self.assertEqual(limiter.check("a", "temperature"), 0)
+
+    def test_rejection_error(self):
+        from src.rain_server.schema import schema
+
+        limiter = RateLimiter(sensor_limit=(0.5, 1), clock=self.clock)
+        limiter.check("sensor", "temperature")
+        query = """
+            mutation {
+                addMeasurement(
+                    sensorId: "sensor",
+                    measurementName: "temperature",
+                    measurementDate: "2022-01-01T00:00:00",
+                    measurementValue: 1,
+                    signature: "",
+                ) { value }
+            }
+        """
+        with mock.patch.object(rate_limit, "_limiter", limiter):
+            result = schema.execute_sync(query)
+
+        self.assertEqual(len(result.errors), 1)
+        self.assertEqual(result.errors[0].extensions["code"], "RATE_LIMITED")
+        self.assertAlmostEqual(result.errors[0].extensions["retryAfter"], 2)
+
+
+class TestProtocols(unittest.TestCase):
+    def test_line_protocol(self):
+        records = parse_line_protocol(
+            'temperature,sensor_id=sen1 value=21.5,signature="c2ln" 1651363200000000000\n'
+            '\n'
+            'humidity,sensor_id=sen1 value=40,signature=c2ln,session_token="a.b" 1651363200500000000\n'
+        )
+        self.assertEqual(records, [
+            IngestRecord("sen1", "temperature", datetime.datetime(2022, 5, 1), 21.5, "c2ln"),
+            IngestRecord(
+                "sen1", "humidity", datetime.datetime(2022, 5, 1, 0, 0, 0, 500000), 40, "c2ln",
+                "a.b",
+            ),
+        ])
+
+    def test_line_protocol_errors(self):
+        records = parse_line_protocol(
+            "temperature value=1,signature=c2ln 1651363200000000000\n"
+            "temperature,sensor_id=sen1 signature=c2ln 1651363200000000000\n"
+            "temperature,sensor_id=sen1 value=abc,signature=c2ln 1651363200000000000\n"
+            "temperature,sensor_id=sen1 value=1,signature=c2ln\n"
+        )
+        self.assertEqual(len(records), 4)
+        self.assertTrue(all(isinstance(record, ValueError) for record in records))
+
+    def test_msgpack(self):
+        body = msgpack.packb([
+            {"sensor_id": "sen1", "measurement_name": "temperature",
+             "timestamp": 1651363200000000000, "value": 21.5, "signature": "c2ln"},
+            {"sensor_id": "sen1", "measurement_name": "temperature"},
+        ])
+        records = parse_msgpack(body)
+        self.assertEqual(
+            records[0],
+            IngestRecord("sen1", "temperature", datetime.datetime(2022, 5, 1), 21.5, "c2ln"),
+        )
+        self.assertIsInstance(records[1], ValueError)
+
+        with self.assertRaises(ValueError):
+            parse_msgpack(msgpack.packb(1))
+        with self.assertRaises(ValueError):
+            parse_msgpack(b"\xc1")
+
+
+def journal_records(count: int) -> list[JournalRecord]:
+    return [
+        JournalRecord("sen1", "temperature", "loc1",
+                      datetime.datetime(2022, 5, 1, 0, i), float(i), 1651363200.0)
+        for i in range(count)
+    ]
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "slot-0")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_append_read(self):
+        """
+        Test appending to and reading a journal
+
+        Expect:
+        - records read back in order, in batches
+        - a new segment once segment_bytes is reached
+        - replayed segments deleted by release
+        """
+        records = journal_records(10)
+        segment_bytes = len(journal.encode_record(records[0])) * 4
+        log = Journal(self.path, segment_bytes=segment_bytes)
+        self.assertTrue(log.open())
+        for i in range(0, 10, 2):
+            log.append(records[i:i + 2])
+        self.assertEqual(log.segments(), [1, 2, 3])
+
+        read = []
+        position = JournalPosition(0, 0)
+        while True:
+            batch, position = log.read(position, 3)
+            if not batch:
+                break
+            read.extend(batch)
+        self.assertEqual(read, records)
+        self.assertEqual(position, log.end)
+
+        log.release(position)
+        self.assertEqual(log.segments(), [3])
+        self.assertEqual(log.read(position, 3), ([], position))
+        log.close()
+
+    def test_bounded_reads(self):
+        """
+        Test reading a segment larger than READ_BYTES
+
+        Expect:
+        - records read back in order
+        - each read reads about READ_BYTES, not the rest of the segment
+        """
+        records = journal_records(30)
+        frame_size = len(journal.encode_record(records[0]))
+        log = Journal(self.path)
+        log.open()
+        log.append(records)
+
+        read = []
+        position = JournalPosition(0, 0)
+        with mock.patch.object(journal, "READ_BYTES", frame_size * 3 + 1), \
+                mock.patch.object(log, "_read_at", wraps=log._read_at) as read_at:
+            while True:
+                batch, position = log.read(position, 2)
+                if not batch:
+                    break
+                read.extend(batch)
+                self.assertLessEqual(sum(call.args[1] for call in read_at.call_args_list),
+                                     frame_size * 3 + 1)
+                read_at.reset_mock()
+        self.assertEqual(read, records)
+        log.close()
+
+    def test_locked(self):
+        """
+        Test opening a journal used by another process
+
+        Expect:
+        - open fails without blocking until the journal is closed
+        """
+        log = Journal(self.path)
+        log.open()
+        self.assertFalse(Journal(self.path).open(blocking=False))
+        log.close()
+        other = Journal(self.path)
+        self.assertTrue(other.open(blocking=False))
+        other.close()
+
+    def test_torn_record(self):
+        """
+        Test opening a journal after a crash during a write
+
+        Expect:
+        - the torn record is dropped
+        - new records are appended after the valid ones
+        """
+        records = journal_records(3)
+        log = Journal(self.path)
+        log.open()
+        log.append(records[:2])
+        log.close()
+        with open(os.path.join(self.path, "000000000001.seg"), "ab") as fp:
+            fp.write(journal.encode_record(records[2])[:-3])
+
+        log = Journal(self.path)
+        log.open()
+        log.append(records[2:])
+        self.assertEqual(log.read(JournalPosition(0, 0), 10)[0], records)
+        log.close()
+
+
+class TestIngestEndpoint(unittest.TestCase):
+    def setUp(self) -> None:
+        """Creates an in-memory database with sensor sen1 measuring temperature"""
+        self.key = ed25519.Ed25519PrivateKey.generate()
+        pubkey = base64.b64encode(
+            self.key.public_key().public_bytes(
+                encoding=serialization.Encoding.DER,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo,
+            ),
+        ).decode("utf-8")
+
+        reset_database()
+        self.database = get_database()
+        now = datetime.datetime(2022, 5, 1)
+        audit = {"d_created_date_utc": now, "d_updated_date_utc": now}
+        with self.database.engine.begin() as conn:
+            conn.execute(self.database.locations.insert(), [
+                {"location_id": "loc1", "location_name": "test_location", **audit},
+            ])
+            conn.execute(self.database.sensors.insert(), [
+                {"sensor_id": "sen1", "sensor_name": "test_sensor", "location_id": "loc1",
+                 "pubkey": pubkey, "is_active": "Y", **audit},
+            ])
+            conn.execute(self.database.measurement_types.insert(), [
+                {"measurement_name": "temperature", "unit": "C", "string_format": "{}",
+                 **audit},
+            ])
+            conn.execute(self.database.sensor_measurements.insert(), [
+                {"sensor_id": "sen1", "measurement_name": "temperature", "is_date": "N",
+                 **audit},
+            ])
+
+        self.client = create_app().test_client()
+
+    def tearDown(self) -> None:
+        reset_database()
+
+    def sign(self, date: datetime.datetime, value: float) -> str:
+        """Signs a measurement of sen1"""
+        message = f"{date}{date}{value}sen1"
+        return base64.b64encode(self.key.sign(message.encode("utf-8"))).decode("utf-8")
+
+    def stored_values(self) -> list[float]:
+        with self.database.engine.connect() as conn:
+            return [
+                float(value) for value in conn.execute(
+                    sqlalchemy.select(self.database.measurements.c.measurement_value)
+                    .order_by(self.database.measurements.c.measurement_datetime),
+                ).scalars()
+            ]
+
+    def test_line_protocol(self):
+        date = datetime.datetime(2022, 5, 1)
+        body = (
+            f'temperature,sensor_id=sen1 value=21.5,signature="{self.sign(date, 21.5)}" '
+            f"1651363200000000000\n"
+            f'temperature,sensor_id=sen1 value=22.0,signature="{self.sign(date, 1.0)}" '
+            f"1651363260000000000\n"
+            f'temperature,sensor_id=sen2 value=1.0,signature="{self.sign(date, 1.0)}" '
+            f"1651363200000000000\n"
+        )
+        response = self.client.post("/ingest", data=body, content_type="text/plain")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            [line.split(" ")[:2] for line in response.get_data(as_text=True).splitlines()],
+            [["1", "AUTHENTICATION_FAILED"], ["2", "INVALID_SENSOR"]],
+        )
+        self.assertEqual(self.stored_values(), [21.5])
+
+    def test_msgpack(self):
+        date = datetime.datetime(2022, 5, 1, 0, 1)
+        body = msgpack.packb([
+            {"sensor_id": "sen1", "measurement_name": "temperature",
+             "timestamp": 1651363260000000000, "value": 22.5, "signature": self.sign(date, 22.5)},
+        ])
+        response = self.client.post("/ingest", data=body, content_type="application/msgpack")
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(self.stored_values(), [22.5])
+
+    def test_rate_limited(self):
+        date = datetime.datetime(2022, 5, 1)
+        line = (f'temperature,sensor_id=sen1 value=21.5,signature="{self.sign(date, 21.5)}" '
+                f"1651363200000000000\n")
+        limiter = RateLimiter(sensor_limit=(0.5, 1))
+        with mock.patch.object(rate_limit, "_limiter", limiter):
+            response = self.client.post("/ingest", data=line * 2, content_type="text/plain")
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers["Retry-After"], "2")
+        self.assertEqual(self.stored_values(), [21.5])
+
+    def test_rate_limited_rejected(self):
+        """Measurements rejected for another reason count against the rate limits"""
+        date = datetime.datetime(2022, 5, 1)
+        body = (
+            f'temperature,sensor_id=sen1 value=21.5,signature="{self.sign(date, 1.0)}" '
+            f"1651363200000000000\n"
+            f'temperature,sensor_id=sen1 value=21.5,signature="{self.sign(date, 21.5)}" '
+            f"1651363200000000000\n"
+        )
+        limiter = RateLimiter(sensor_limit=(0.5, 1))
+        with mock.patch.object(rate_limit, "_limiter", limiter):
+            response = self.client.post("/ingest", data=body, content_type="text/plain")
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.stored_values(), [])
+
+    def test_add_measurement(self):
+        """add_measurement applies the same rules and writes the same rows"""
+        from src.rain_server.schema import schema
+
+        date = datetime.datetime(2022, 5, 1)
+        query = """
+            mutation($signature: String!) {
+                addMeasurement(
+                    sensorId: "sen1",
+                    measurementName: "temperature",
+                    measurementDate: "2022-05-01T00:00:00",
+                    measurementValue: 21.5,
+                    signature: $signature,
+                ) { value sensor { location { name } } measurement { unit } }
+            }
+        """
+        result = schema.execute_sync(query, {"signature": self.sign(date, 21.5)})
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data["addMeasurement"], {
+            "value": 21.5,
+            "sensor": {"location": {"name": "test_location"}},
+            "measurement": {"unit": "C"},
+        })
+
+        result = schema.execute_sync(query, {"signature": self.sign(date, 1.0)})
+        self.assertEqual(result.errors[0].message, "Signature verification failed.")
+        self.assertEqual(self.stored_values(), [21.5])
+
+    def test_add_measurement_offset(self):
+        """
+        Test add_measurement with a date with a time zone offset
+
+        Expect:
+        - signature checked on the date as sent
+        - measurement stored in naive UTC, directly and through the journal
+        """
+        from src.rain_server.schema import schema
+
+        offset = datetime.timezone(datetime.timedelta(hours=2))
+        date = datetime.datetime(2022, 5, 1, 2, tzinfo=offset)
+        query = """
+            mutation($signature: String!) {
+                addMeasurement(
+                    sensorId: "sen1",
+                    measurementName: "temperature",
+                    measurementDate: "2022-05-01T02:00:00+02:00",
+                    measurementValue: 21.5,
+                    signature: $signature,
+                ) { value }
+            }
+        """
+        result = schema.execute_sync(query, {"signature": self.sign(date, 21.5)})
+        self.assertIsNone(result.errors)
+
+        with tempfile.TemporaryDirectory() as directory:
+            cfg = ConfigSnapshot({**SERVER_DEFAULTS, "journal_directory": directory})
+            with mock.patch.object(journal, "get_server_config", return_value=cfg), \
+                    mock.patch.object(JournalReplayer, "start"):
+                try:
+                    result = schema.execute_sync(query, {"signature": self.sign(date, 21.5)})
+                    self.assertIsNone(result.errors)
+                    log = journal.get_journal()
+                    replayer = JournalReplayer(self.database, log, node="test")
+                    self.assertEqual(replayer.replay(log), 1)
+                finally:
+                    reset_journal()
+
+        with self.database.engine.connect() as conn:
+            dates = conn.execute(
+                sqlalchemy.select(self.database.measurements.c.measurement_datetime),
+            ).scalars().all()
+        self.assertEqual(dates, [datetime.datetime(2022, 5, 1)] * 2)
+
+    def test_replay(self):
+        """
+        Test replaying a journal into the database
+
+        Expect:
+        - records inserted once, even by a new replayer
+        - replayed position stored in s_journal_offsets
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            log = Journal(os.path.join(directory, "slot-0"))
+            log.open()
+            log.append(journal_records(5))
+
+            replayer = JournalReplayer(self.database, log, node="test", batch_size=3)
+            self.assertEqual(replayer.replay(log), 3)
+            self.assertEqual(replayer.replay(log), 2)
+            self.assertEqual(replayer.replay(log), 0)
+            self.assertEqual(
+                JournalReplayer(self.database, log, node="test").replay(log), 0,
+            )
+            log.close()
+
+        self.assertEqual(self.stored_values(), [0.0, 1.0, 2.0, 3.0, 4.0])
+        with self.database.engine.connect() as conn:
+            offset = conn.execute(
+                sqlalchemy.select(self.database.journal_offsets.c.offset),
+            ).scalar()
+        self.assertEqual(offset, log.end.offset)
+
+    def test_replay_invalid_records(self):
+        """
+        Test replaying a journal holding records that can not be written
+
+        Expect:
+        - valid records written
+        - a record that can not be decoded and a record that can not be inserted
+        quarantined, in the journal format
+        """
+        payload = b"[1]"
+        invalid = journal.FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        offset = datetime.timezone(datetime.timedelta(hours=2))
+        records = journal_records(2)
+        aware = records[0]._replace(measurement_date=datetime.datetime(2022, 5, 1, tzinfo=offset))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "slot-0")
+            os.makedirs(path)
+            with open(os.path.join(path, f"{1:012d}.seg"), "wb") as fp:
+                fp.write(journal.encode_record(records[0]) + invalid
+                         + journal.encode_record(aware) + journal.encode_record(records[1]))
+            log = Journal(path)
+            log.open()
+
+            replayer = JournalReplayer(self.database, log, node="test", batch_size=10)
+            self.assertEqual(replayer.replay(log), 4)
+            self.assertEqual(replayer.replay(log), 0)
+            log.close()
+
+            with open(os.path.join(path, journal.QUARANTINE_FILE), "rb") as fp:
+                quarantined = fp.read()
+        self.assertEqual(quarantined, invalid + journal.encode_record(aware))
+        self.assertEqual(self.stored_values(), [0.0, 1.0])
+
+    def test_replay_corrupted_frames(self):
+        """
+        Test replaying a journal whose durable records were corrupted
+
+        Expect:
+        - a frame failing its CRC quarantined, the next records of its segment written
+        - a frame with a corrupted length stops the replay, keeping its segment
+        """
+        records = journal_records(10)
+        frame_size = len(journal.encode_record(records[0]))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "slot-0")
+            log = Journal(path, segment_bytes=frame_size * 4)
+            log.open()
+            log.append(records[:4])
+            log.append(records[4:8])
+            log.append(records[8:])
+            with open(os.path.join(path, f"{1:012d}.seg"), "r+b") as fp:
+                fp.seek(frame_size * 2 - 1)
+                fp.write(b"#")
+            with open(os.path.join(path, f"{3:012d}.seg"), "r+b") as fp:
+                fp.seek(frame_size)
+                fp.write(journal.FRAME_HEADER.pack(frame_size * 10, 0))
+
+            replayer = JournalReplayer(self.database, log, node="test", batch_size=3)
+            with self.assertRaises(ValueError), self.assertLogs(level="ERROR"):
+                while replayer.replay(log):
+                    pass
+            self.assertEqual(log.segments(), [3])
+            log.close()
+
+            with open(os.path.join(path, journal.QUARANTINE_FILE), "rb") as fp:
+                self.assertEqual(len(fp.read()), frame_size)
+        self.assertEqual(self.stored_values(), [0.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0])
+
+    def test_journal(self):
+        """
+        Test ingestion with the journal enabled
+
+        Expect:
+        - measurements acknowledged before being written
+        - measurements written by the replayer
+        """
+        date = datetime.datetime(2022, 5, 1)
+        line = (f'temperature,sensor_id=sen1 value=21.5,signature="{self.sign(date, 21.5)}" '
+                f"1651363200000000000\n")
+        with tempfile.TemporaryDirectory() as directory:
+            cfg = ConfigSnapshot({**SERVER_DEFAULTS, "journal_directory": directory})
+            # The in-memory database is per thread, the test replays in its thread.
+            with mock.patch.object(journal, "get_server_config", return_value=cfg), \
+                    mock.patch.object(JournalReplayer, "start"):
+                try:
+                    response = self.client.post("/ingest", data=line, content_type="text/plain")
+                    self.assertEqual(response.status_code, 204)
+                    self.assertEqual(self.stored_values(), [])
+
+                    log = journal.get_journal()
+                    self.assertEqual(log.name, "slot-0")
+                    JournalReplayer(self.database, log, node="test").replay(log)
+                finally:
+                    reset_journal()
+
+        self.assertEqual(self.stored_values(), [21.5])
+
+    def test_unsupported_content_type(self):
+        response = self.client.post("/ingest", json={})
+        self.assertEqual(response.status_code, 415)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+"""Test database maintenance jobs"""
+import datetime
+import unittest
+
+import sqlalchemy
+
+from src.rain_server.configuration.db_engine import DataBase
+from src.rain_server.maintenance import Retention
+
+
+class TestRetention(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates an in-memory database with:
+        - "deleted" measurements kept 1 day
+        - "downsampled" measurements kept 1 day then averaged per hour
+        - "kept" measurements without retention
+        - a measurement every 20 minutes for 2 days for each type
+        """
+        self.now = datetime.datetime(2022, 5, 3)
+        self.engine = sqlalchemy.create_engine("sqlite://", future=True)
+        self.database = DataBase(self.engine)
+        with self.engine.begin() as conn:
+            conn.execute(self.database.measurement_types.insert(), [
+                {"measurement_name": "deleted", "retention_days": 1,
+                 "retention_action": "delete", "downsample_minutes": None},
+                {"measurement_name": "downsampled", "retention_days": 1,
+                 "retention_action": "downsample", "downsample_minutes": 60},
+                {"measurement_name": "kept", "retention_days": None,
+                 "retention_action": None, "downsample_minutes": None},
+            ])
+            conn.execute(self.database.series.insert(), [
+                {"series_id": series_id, "sensor_id": "sen1", "measurement_name": name,
+                 "location_id": "loc1"}
+                for series_id, name in enumerate(["deleted", "downsampled", "kept"])
+            ])
+            conn.execute(self.database.measurements.insert(), [
+                {
+                    "series_id": series_id,
+                    "measurement_datetime": self.now - datetime.timedelta(minutes=20 * i),
+                    "measurement_value": i % 3,
+                }
+                for series_id in range(3)
+                for i in range(1, 145)
+            ])
+
+    def tearDown(self) -> None:
+        """
+        Disposes the engine
+        """
+        self.engine.dispose()
+
+    def count(self, measurement_name: str, before: datetime.datetime | None = None) -> int:
+        """Counts measurements"""
+        measurements = self.database.measurements
+        series = self.database.series
+        query = sqlalchemy.select(sqlalchemy.func.count()).select_from(
+            measurements.join(series, measurements.c.series_id == series.c.series_id),
+        ).where(
+            series.c.measurement_name == measurement_name,
+        )
+        if before is not None:
+            query = query.where(measurements.c.measurement_datetime < before)
+        with self.engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+    def test_run(self):
+        """
+        Test retention run
+
+        Expect:
+        - measurements older than 1 day deleted for "deleted"
+        - measurements older than 1 day averaged per hour for "downsampled"
+        - "kept" untouched
+        """
+        horizon = self.now - datetime.timedelta(days=1)
+        reports = {
+            r.measurement_name: r
+            for r in Retention(self.database, datetime.timedelta(hours=5)).run(self.now)
+        }
+
+        self.assertSetEqual(set(reports), {"deleted", "downsampled"})
+        self.assertEqual(reports["deleted"].rows_deleted, 72)
+        self.assertEqual(self.count("deleted", horizon), 0)
+        self.assertEqual(self.count("deleted"), 72)
+
+        self.assertEqual(reports["downsampled"].rows_deleted, 72)
+        self.assertEqual(reports["downsampled"].rows_inserted, 24)
+        self.assertEqual(self.count("downsampled", horizon), 24)
+        self.assertEqual(self.count("downsampled"), 96)
+        with self.engine.connect() as conn:
+            values = conn.execute(
+                sqlalchemy.select(self.database.measurements.c.measurement_value).where(
+                    self.database.measurements.c.series_id == 1,
+                    self.database.measurements.c.measurement_datetime < horizon,
+                ),
+            ).scalars().all()
+        self.assertListEqual([float(v) for v in values], [1.0] * 24)
+
+        self.assertEqual(self.count("kept"), 144)
+
+    def test_downsample_null(self):
+        """
+        Test downsampling measurements without value
+
+        Expect:
+        - null values left out of the averages
+        """
+        measurements = self.database.measurements
+        with self.engine.begin() as conn:
+            conn.execute(
+                measurements.update().where(
+                    measurements.c.series_id == 1,
+                    measurements.c.measurement_datetime.in_([
+                        self.now - datetime.timedelta(minutes=20 * i) for i in [74, 75]
+                    ]),
+                ).values(measurement_value=None),
+            )
+
+        report, = [
+            r for r in Retention(self.database).run(self.now)
+            if r.measurement_name == "downsampled"
+        ]
+
+        self.assertEqual(report.rows_inserted, 24)
+        with self.engine.connect() as conn:
+            values = conn.execute(
+                sqlalchemy.select(measurements.c.measurement_value).where(
+                    measurements.c.series_id == 1,
+                    measurements.c.measurement_datetime < self.now - datetime.timedelta(days=1),
+                ),
+            ).scalars().all()
+        self.assertListEqual([float(v) for v in values], [1.0] * 24)
+
+    def test_run_twice(self):
+        """
+        Test retention run twice
+
+        Expect:
+        - nothing to do on the second run
+        """
+        retention = Retention(self.database)
+        retention.run(self.now)
+        reports = retention.run(self.now)
+
+        for report in reports:
+            self.assertEqual(report.rows_deleted, 0, report)
+            self.assertEqual(report.rows_inserted, 0, report)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,335 @@
+"""Test metrics and instrumentation"""
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import sqlalchemy
+
+from src.rain_server.monitoring import (SlowQueryLogger, extension,
+                                        instrument_engine)
+from src.rain_server.monitoring.instruments import (DB_COMPILED_CACHE,
+                                                    DB_ERRORS,
+                                                    DB_POOL_CHECKED_OUT,
+                                                    DB_QUERY_SECONDS)
+from src.rain_server.monitoring.metrics import Metric, MetricsRegistry
+from src.rain_server.monitoring.profiler import (ProfileStore, RequestProfiler,
+                                                 SamplingProfiler)
+from src.rain_server.server import create_app
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates an empty registry
+        """
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        """
+        Test counter increments and rendering
+
+        Expect:
+        - values are tracked per label set
+        - rendered with a _total suffix
+        """
+        counter = self.registry.counter("test_events", "Test events.", ["kind"])
+        counter.inc(kind="a")
+        counter.inc(2, kind="a")
+        counter.inc(kind="b")
+
+        self.assertEqual(counter.value(kind="a"), 3)
+        self.assertEqual(counter.value(kind="b"), 1)
+        self.assertIn('test_events_total{kind="a"} 3.0', self.registry.render())
+        self.assertRaises(ValueError, counter.inc, -1, kind="a")
+
+    def test_invalid_labels(self):
+        """
+        Test metric with missing labels
+
+        Expect:
+        - raise a ValueError
+        """
+        counter = self.registry.counter("test_events", "Test events.", ["kind"])
+        self.assertRaises(ValueError, counter.inc)
+
+    def test_abstract_metric(self):
+        """
+        Test creating a metric without samples
+
+        Expect:
+        - raise a TypeError
+        """
+        self.assertRaises(TypeError, Metric, "test_events", "Test events.")
+
+    def test_register_twice(self):
+        """
+        Test registering a metric name twice
+
+        Expect:
+        - same metric returned for the same type
+        - raise a ValueError for another type
+        """
+        counter = self.registry.counter("test_events", "Test events.")
+        self.assertIs(counter, self.registry.counter("test_events", "Test events."))
+        self.assertRaises(ValueError, self.registry.gauge, "test_events", "Test events.")
+
+    def test_histogram(self):
+        """
+        Test histogram buckets
+
+        Expect:
+        - cumulative bucket counts, sum and count rendered
+        """
+        histogram = self.registry.histogram("test_seconds", "Test.", buckets=[0.1, 1])
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        rendered = self.registry.render()
+        self.assertIn('test_seconds_bucket{le="0.1"} 1.0', rendered)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2.0', rendered)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3.0', rendered)
+        self.assertIn("test_seconds_sum 5.55", rendered)
+        self.assertIn("test_seconds_count 3.0", rendered)
+
+
+class TestEngineInstrumentation(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates an instrumented in-memory SQLite engine
+        """
+        self.engine = sqlalchemy.create_engine("sqlite://", future=True)
+        instrument_engine(self.engine, name="test")
+
+    def tearDown(self) -> None:
+        """
+        Disposes the engine
+        """
+        self.engine.dispose()
+
+    def test_query_timing(self):
+        """
+        Test statement latency and pool usage
+
+        Expect:
+        - one select observation
+        - no connection checked out once the connection is closed
+        """
+        count = DB_QUERY_SECONDS.count(engine="test", statement="select")
+        with self.engine.connect() as conn:
+            self.assertEqual(DB_POOL_CHECKED_OUT.value(engine="test"), 1)
+            conn.execute(sqlalchemy.text("SELECT 1"))
+
+        self.assertEqual(DB_QUERY_SECONDS.count(engine="test", statement="select"), count + 1)
+        self.assertEqual(DB_POOL_CHECKED_OUT.value(engine="test"), 0)
+
+    def test_query_error(self):
+        """
+        Test failing statement
+
+        Expect:
+        - error counted by exception type
+        """
+        errors = DB_ERRORS.value(engine="test", error="OperationalError")
+        with self.engine.connect() as conn:
+            self.assertRaises(
+                sqlalchemy.exc.OperationalError,
+                conn.execute,
+                sqlalchemy.text("SELECT * FROM missing_table"),
+            )
+
+        self.assertEqual(DB_ERRORS.value(engine="test", error="OperationalError"), errors + 1)
+
+    def test_compiled_cache(self):
+        """
+        Test compiled cache monitoring
+
+        Expect:
+        - first execution of a statement is a miss, the next ones are hits
+        """
+        misses = DB_COMPILED_CACHE.value(engine="test", result="cache_miss")
+        hits = DB_COMPILED_CACHE.value(engine="test", result="cache_hit")
+        statement = sqlalchemy.select(sqlalchemy.bindparam("value", type_=sqlalchemy.Integer))
+        with self.engine.connect() as conn:
+            for value in range(3):
+                conn.execute(statement, {"value": value})
+
+        self.assertEqual(DB_COMPILED_CACHE.value(engine="test", result="cache_miss"), misses + 1)
+        self.assertEqual(DB_COMPILED_CACHE.value(engine="test", result="cache_hit"), hits + 2)
+
+
+class TestSlowQueryLogger(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates an in-memory SQLite engine logging every statement as slow
+        """
+        self.logger = logging.getLogger("test_slow_query")
+        self.engine = sqlalchemy.create_engine("sqlite://", future=True)
+        SlowQueryLogger(self.logger, 0, interval=60, max_per_interval=2).install(self.engine)
+
+    def tearDown(self) -> None:
+        """
+        Disposes the engine
+        """
+        self.engine.dispose()
+
+    def test_slow_query_logged_with_plan(self):
+        """
+        Test slow select
+
+        Expect:
+        - statement, parameters and plan logged
+        """
+        with self.engine.connect() as conn, self.assertLogs(self.logger, "WARNING") as logs:
+            conn.execute(sqlalchemy.text("SELECT :value"), {"value": 42})
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("SELECT ?", logs.output[0])
+        self.assertIn("(42,)", logs.output[0])
+        self.assertIn("SCAN CONSTANT ROW", logs.output[0])
+
+    def test_explain_in_transaction(self):
+        """
+        Test slow statements of a transaction
+
+        Expect:
+        - plans captured without ending the transaction, all rows committed
+        """
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("CREATE TABLE t (value INTEGER)"))
+        with self.engine.begin() as conn, self.assertLogs(self.logger, "WARNING") as logs:
+            conn.execute(sqlalchemy.text("INSERT INTO t VALUES (1)"))
+            conn.execute(sqlalchemy.text("INSERT INTO t VALUES (2)"))
+        self.assertIn("Plan:", logs.output[0])
+
+        with self.engine.connect() as conn:
+            self.assertEqual(
+                conn.execute(sqlalchemy.text("SELECT count(*) FROM t")).scalar(), 2,
+            )
+
+    def test_rate_limit(self):
+        """
+        Test repeated slow statements
+
+        Expect:
+        - same statement logged once per interval
+        - no more than max_per_interval statements logged
+        """
+        with self.engine.connect() as conn, self.assertLogs(self.logger, "WARNING") as logs:
+            for _ in range(3):
+                conn.execute(sqlalchemy.text("SELECT 1"))
+            conn.execute(sqlalchemy.text("SELECT 2"))
+            conn.execute(sqlalchemy.text("SELECT 3"))
+
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("SELECT 1", logs.output[0])
+        self.assertIn("SELECT 2", logs.output[1])
+
+
+def busy_loop(duration: float):
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        pass
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates a temporary profile directory
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = ProfileStore(self.directory.name, max_files=2)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_sampling(self):
+        """
+        Test sampling a busy thread
+
+        Expect:
+        - folded stacks ending in the busy function
+        """
+        sampler = SamplingProfiler(threading.get_ident(), 0.001).start()
+        busy_loop(0.05)
+        samples = sampler.stop()
+
+        self.assertGreater(sum(samples.values()), 0)
+        self.assertTrue(any(stack.split(";")[-1].startswith("busy_loop") for stack in samples))
+
+    def test_store_retention(self):
+        """
+        Test writing more profiles than kept
+
+        Expect:
+        - only the most recent profiles kept, in folded format
+        """
+        names = [self.store.write(f"op{i}", {"a;b": i + 1}) for i in range(3)]
+
+        self.assertEqual(sorted(os.listdir(self.directory.name)), names[1:])
+        with open(os.path.join(self.directory.name, names[2])) as fp:
+            self.assertEqual(fp.read(), "a;b 3\n")
+
+    def test_reason(self):
+        """
+        Test choosing requests to profile
+
+        Expect:
+        - requests with the right header token always profiled
+        - other requests sampled
+        """
+        profiler = RequestProfiler(self.store, sample_rate=0.5, token="secret",
+                                   draw=lambda: 0.7)
+        self.assertEqual(profiler.reason({"X-Rain-Profile": "secret"}), "header")
+        self.assertIsNone(profiler.reason({"X-Rain-Profile": "wrong"}))
+        self.assertIsNone(profiler.reason(None))
+        profiler.draw = lambda: 0.2
+        self.assertEqual(profiler.reason({}), "sampled")
+        self.assertIsNone(RequestProfiler(self.store).reason({"X-Rain-Profile": ""}))
+
+    def test_profiler_subscription(self):
+        """
+        Test getting the request profiler
+
+        Expect:
+        - configuration changes subscribed once, on first use
+        """
+        profiler = RequestProfiler(self.store)
+        with mock.patch.object(extension, "_profiler", profiler), \
+                mock.patch.object(extension, "_subscribed", False), \
+                mock.patch.object(extension, "get_server_config_source") as source:
+            self.assertIs(extension.get_request_profiler(), profiler)
+            self.assertIs(extension.get_request_profiler(), profiler)
+        source.return_value.subscribe.assert_called_once_with(extension._reset_request_profiler)
+
+    def test_extension(self):
+        """
+        Test a GraphQL request with the profiling header
+
+        Expect:
+        - profile written and its name returned in the response
+        - requests without the header not profiled
+        """
+        profiler = RequestProfiler(self.store, token="secret", interval=0.001)
+        with mock.patch.object(extension, "_profiler", profiler):
+            client = create_app().test_client()
+            response = client.post(
+                "/graphql",
+                json={"query": "query Probe { __typename }"},
+                headers={"X-Rain-Profile": "secret"},
+            )
+            other = client.post("/graphql", json={"query": "{ __typename }"})
+
+        self.assertEqual(response.status_code, 200)
+        name = response.headers["X-Rain-Profile-Id"]
+        self.assertIn("-Probe-", name)
+        self.assertEqual(os.listdir(self.directory.name), [name])
+        self.assertNotIn("X-Rain-Profile-Id", other.headers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,10 +4,15 @@ import importlib
 import unittest
 
 import src.rain_server.schema.query
+from src.rain_server.configuration import get_database, reset_database
 from src.rain_server.schema.data_schemas import (Location, Measurement,
-                                                 MeasurementType)
-from src.rain_server.schema.query import (get_locations, get_measurements,
+                                                 MeasurementType, Percentile)
+from src.rain_server.schema.query import (get_locations,
+                                          get_measurement_buckets,
+                                          get_measurements, get_percentiles,
                                           get_sensors)
+from src.rain_server.schema.time_window import (TimeWindow, parse_expression,
+                                                resolve_window)
 
 
 class TestQueries(unittest.TestCase):
@@ -318,5 +323,298 @@ class TestQueries(unittest.TestCase):
             )
 
 
+class TestTimeWindow(unittest.TestCase):
+    def test_parse_expression(self):
+        """
+        Test parsing of query dates
+
+        Expect:
+        - each expression parsed once
+        - offsets, start of day and UTC conversion of absolute dates
+        - ValueError for an invalid date
+        """
+        now = datetime.datetime(2022, 4, 30, 10, 30)
+        self.assertIs(parse_expression("-2h"), parse_expression("-2h"))
+        self.assertEqual(parse_expression("-2h").resolve(now),
+                         datetime.datetime(2022, 4, 30, 8, 30))
+        self.assertEqual(parse_expression("TODAY").resolve(now), datetime.datetime(2022, 4, 30))
+        self.assertEqual(parse_expression("TODAY").resolve(now, is_end=True), now)
+        self.assertEqual(
+            parse_expression("2022-04-30T12:00:00+02:00").resolve(now),
+            datetime.datetime(2022, 4, 30, 10),
+        )
+        self.assertRaises(ValueError, parse_expression, "-2y")
+
+    def test_resolve_window(self):
+        """
+        Test query windows with a granularity
+
+        Expect:
+        - same window for relative dates within a granularity, absolute dates kept
+        - last_only only when both dates are NOW
+        - ValueError when start is after end
+        """
+        minute = datetime.timedelta(minutes=1)
+        first = resolve_window("-1h", "NOW", datetime.datetime(2022, 4, 30, 10, 30, 5),
+                               granularity=minute)
+        second = resolve_window("-1h", "NOW", datetime.datetime(2022, 4, 30, 10, 30, 55),
+                                granularity=minute)
+        self.assertEqual(first, second)
+        self.assertEqual(first, TimeWindow(datetime.datetime(2022, 4, 30, 9, 30),
+                                           datetime.datetime(2022, 4, 30, 10, 30)))
+        self.assertEqual(
+            resolve_window("2022-04-30T10:00:01", "NOW",
+                           datetime.datetime(2022, 4, 30, 10, 30, 5), granularity=minute).start,
+            datetime.datetime(2022, 4, 30, 10, 0, 1),
+        )
+
+        now = datetime.datetime(2022, 4, 30, 10, 30, 5)
+        self.assertTrue(resolve_window("NOW", "NOW", now).last_only)
+        self.assertFalse(resolve_window("TODAY", "NOW", now).last_only)
+        self.assertRaises(ValueError, resolve_window, "NOW", "-1d", now)
+
+
+class TestQueriesDatabase(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates a new in-memory database with:
+        - locations loc1 (test_location) and loc2 (test_location2)
+        - sensors sen1 in loc1 and sen2 in loc2 measuring test_measurement
+        - 2 measurements for each sensor
+        """
+        reset_database()
+        database = get_database()
+        now = datetime.datetime(2022, 5, 1)
+        audit = {"d_created_date_utc": now, "d_updated_date_utc": now}
+        with database.engine.begin() as conn:
+            conn.execute(database.locations.insert(), [
+                {"location_id": "loc1", "location_name": "test_location", **audit},
+                {"location_id": "loc2", "location_name": "test_location2", **audit},
+            ])
+            conn.execute(database.sensors.insert(), [
+                {"sensor_id": "sen1", "sensor_name": "test_sensor", "location_id": "loc1",
+                 "pubkey": "", "is_active": "Y", **audit},
+                {"sensor_id": "sen2", "sensor_name": "test_sensor2", "location_id": "loc2",
+                 "pubkey": "", "is_active": "Y", **audit},
+            ])
+            conn.execute(database.measurement_types.insert(), [
+                {"measurement_name": "test_measurement", "unit": "count",
+                 "string_format": "{}", **audit},
+            ])
+            conn.execute(database.sensor_measurements.insert(), [
+                {"sensor_id": "sen1", "measurement_name": "test_measurement", "is_date": "N",
+                 **audit},
+                {"sensor_id": "sen2", "measurement_name": "test_measurement", "is_date": "N",
+                 **audit},
+            ])
+            conn.execute(database.series.insert(), [
+                {"series_id": 1, "sensor_id": "sen1", "measurement_name": "test_measurement",
+                 "location_id": "loc1"},
+                {"series_id": 2, "sensor_id": "sen2", "measurement_name": "test_measurement",
+                 "location_id": "loc2"},
+            ])
+            conn.execute(database.measurements.insert(), [
+                {"series_id": 1, "measurement_datetime": datetime.datetime(2022, 4, 29),
+                 "measurement_value": 100},
+                {"series_id": 1, "measurement_datetime": datetime.datetime(2022, 4, 30),
+                 "measurement_value": 123},
+                {"series_id": 2, "measurement_datetime": datetime.datetime(2022, 4, 29),
+                 "measurement_value": 400},
+                {"series_id": 2, "measurement_datetime": datetime.datetime(2022, 4, 30, 1, 1, 1),
+                 "measurement_value": 456},
+            ])
+
+    def tearDown(self) -> None:
+        """
+        Drops the database
+        """
+        reset_database()
+
+    def test_get_locations(self):
+        """
+        Test locations query
+
+        Expect:
+        - both locations
+        """
+        self.assertListEqual(
+            get_locations(),
+            [
+                Location(id="loc1", name="test_location"),
+                Location(id="loc2", name="test_location2"),
+            ],
+        )
+
+    def test_get_sensors(self):
+        """
+        Test sensors query by location id and name
+
+        Expect:
+        - sensor of the location with its measurement types
+        """
+        for params in [{"location_id": "loc1"}, {"location_name": "test_location"}]:
+            sensors = get_sensors(**params)
+
+            self.assertEqual(len(sensors), 1)
+            self.assertEqual(sensors[0].id, "sen1")
+            self.assertEqual(sensors[0].location, Location(id="loc1", name="test_location"))
+            self.assertListEqual(
+                sensors[0].measurements,
+                [MeasurementType(name="test_measurement", unit="count", default_format="{}")],
+            )
+
+    def test_get_measurements_window(self):
+        """
+        Test measurements query on an absolute window
+
+        Expect:
+        - measurements of the window ordered by date
+        """
+        measurements = get_measurements(
+            measurements=["test_measurement"],
+            start_time="2022-04-30T00:00:00",
+            end_time="2022-04-30T23:59:59",
+        )
+
+        self.assertEqual(
+            [(m.sensor.id, m.date, m.value) for m in measurements],
+            [
+                ("sen1", datetime.datetime(2022, 4, 30), 123),
+                ("sen2", datetime.datetime(2022, 4, 30, 1, 1, 1), 456),
+            ],
+        )
+
+    def test_get_measurements_filters(self):
+        """
+        Test measurements query filtered by sensor, location id and location name
+
+        Expect:
+        - only measurements of sen1
+        """
+        params = [
+            {"sensor_ids": ["sen1"]},
+            {"location_ids": ["loc1"]},
+            {"location_names": ["test_location"]},
+        ]
+        for p in params:
+            measurements = get_measurements(
+                measurements=["test_measurement"],
+                start_time="2022-01-01T00:00:00",
+                end_time="NOW",
+                **p,
+            )
+            self.assertEqual([m.value for m in measurements], [100, 123], p)
+
+    def test_get_measurements_last(self):
+        """
+        Test measurements query with start_time and end_time set to NOW
+
+        Expect:
+        - last measurement of each sensor
+        """
+        measurements = get_measurements(
+            measurements=["test_measurement"],
+            start_time="NOW",
+            end_time="NOW",
+        )
+
+        self.assertEqual([(m.sensor.id, m.value) for m in measurements],
+                         [("sen1", 123), ("sen2", 456)])
+
+    def test_get_measurement_buckets(self):
+        """
+        Test measurement buckets query
+
+        Expect:
+        - average of each sensor per bucket, buckets aligned on the epoch
+        - empty buckets with a null value
+        - ValueError for an invalid bucket and for the last measurements
+        """
+        measurements = get_measurement_buckets(
+            measurements=["test_measurement"],
+            start_time="2022-04-29T00:00:00",
+            end_time="2022-04-30T23:59:59",
+            bucket="12h",
+        )
+        self.assertEqual(
+            [(m.sensor.id, m.date, m.value) for m in measurements],
+            [
+                ("sen1", datetime.datetime(2022, 4, 29), 100),
+                ("sen2", datetime.datetime(2022, 4, 29), 400),
+                ("sen1", datetime.datetime(2022, 4, 29, 12), None),
+                ("sen2", datetime.datetime(2022, 4, 29, 12), None),
+                ("sen1", datetime.datetime(2022, 4, 30), 123),
+                ("sen2", datetime.datetime(2022, 4, 30), 456),
+                ("sen1", datetime.datetime(2022, 4, 30, 12), None),
+                ("sen2", datetime.datetime(2022, 4, 30, 12), None),
+            ],
+        )
+
+        # 2022-04-28 is 19110 days after the epoch.
+        measurements = get_measurement_buckets(
+            measurements=["test_measurement"],
+            start_time="2022-04-29T00:00:00",
+            end_time="2022-04-30T23:59:59",
+            bucket="3d",
+        )
+        self.assertEqual(
+            [(m.sensor.id, m.date, m.value) for m in measurements],
+            [
+                ("sen1", datetime.datetime(2022, 4, 28), 111.5),
+                ("sen2", datetime.datetime(2022, 4, 28), 428),
+            ],
+        )
+
+        self.assertRaises(ValueError, get_measurement_buckets, measurements=["test_measurement"],
+                          start_time="2022-04-29T00:00:00", end_time="2022-04-30T00:00:00",
+                          bucket="12x")
+        self.assertRaises(ValueError, get_measurement_buckets, measurements=["test_measurement"],
+                          start_time="NOW", end_time="NOW", bucket="1h")
+
+    def test_get_percentiles(self):
+        """
+        Test percentiles query over sketches of two sensors
+
+        Expect:
+        - percentiles of the measurements of all sensors of the range
+        - only sen1 with a location filter
+        - ValueError for a percentile above 100
+        """
+        database = get_database()
+        with database.engine.begin() as conn:
+            database.insert_measurements(conn, [
+                {"series_id": series_id,
+                 "measurement_datetime": datetime.datetime(2022, 3, 1)
+                 + datetime.timedelta(minutes=i),  # noqa
+                 "measurement_value": float(i + (series_id - 1) * 100)}
+                for series_id in [1, 2]
+                for i in range(100)
+            ])
+
+        results = get_percentiles(
+            measurements=["test_measurement", "unknown"],
+            percentiles=[0, 50, 100],
+            start_time="2022-03-01T00:00:00",
+            end_time="2022-03-02T00:00:00",
+        )
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].measurement.unit, "count")
+        self.assertEqual((results[0].count, results[0].min, results[0].max), (200, 0, 199))
+        self.assertEqual(results[0].percentiles[0], Percentile(percentile=0, value=0))
+        self.assertAlmostEqual(results[0].percentiles[1].value, 100, delta=2)
+
+        results = get_percentiles(
+            measurements=["test_measurement"],
+            percentiles=[100],
+            location_names=["test_location"],
+            start_time="2022-03-01T00:00:00",
+            end_time="2022-03-02T00:00:00",
+        )
+        self.assertEqual(results[0].percentiles, [Percentile(percentile=100, value=99)])
+
+        self.assertRaises(ValueError, get_percentiles, measurements=["test_measurement"],
+                          percentiles=[101])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,239 @@
+import datetime
+import importlib
+import json
+import threading
+import unittest
+from unittest import mock
+
+import config
+
+from src.rain_server.configuration import get_database, reset_database
+from src.rain_server.server import PreforkServer, create_app, streaming
+from src.rain_server.server.batching import BatchGraphQLView
+
+
+class TestBatching(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = create_app().test_client()
+
+    def test_single_operation(self):
+        response = self.client.post("/graphql", json={"query": "{ __typename }"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {"data": {"__typename": "Query"}})
+
+    def test_batch(self):
+        operations = [{"query": f"{{ op{i}: __typename }}"} for i in range(5)]
+        response = self.client.post("/graphql", json=operations)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json,
+            [{"data": {f"op{i}": "Query"}} for i in range(5)],
+        )
+
+    def test_batch_concurrency(self):
+        threads = set()
+        execute_single = BatchGraphQLView.execute_single
+
+        def record_thread(*args, **kwargs):
+            threads.add(threading.current_thread().name)
+            return execute_single(*args, **kwargs)
+
+        with mock.patch.object(BatchGraphQLView, "execute_single", record_thread):
+            response = self.client.post("/graphql", json=[{"query": "{ __typename }"}] * 4)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(name.startswith("graphql-batch") for name in threads))
+
+    def test_batch_contexts(self):
+        contexts = []
+        get_context = BatchGraphQLView.get_context
+
+        def record_context(view, request, response):
+            context = get_context(view, request, response)
+            contexts.append(context)
+            response.headers[f"X-Operation-{len(contexts)}"] = "1"
+            return context
+
+        with mock.patch.object(BatchGraphQLView, "get_context", record_context):
+            response = self.client.post("/graphql", json=[{"query": "{ __typename }"}] * 3)
+        self.assertEqual(response.status_code, 200)
+        # One context for the request, then one per operation.
+        self.assertEqual(len({id(context["response"]) for context in contexts}), 4)
+        self.assertEqual(
+            [response.headers.get(f"X-Operation-{i}") for i in range(2, 5)], ["1"] * 3,
+        )
+
+    def test_missing_file(self):
+        # Raised by strawberry for multipart requests referencing a missing file.
+        with mock.patch.object(BatchGraphQLView, "parse_http_body", side_effect=KeyError("0")):
+            response = self.client.post("/graphql", json={"query": "{ __typename }"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_too_large(self):
+        response = self.client.post("/graphql", json=[{"query": "{ __typename }"}] * 33)
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_errors(self):
+        operations = [{"query": "{ __typename }"}, {"query": "{ unknownField }"}]
+        response = self.client.post("/graphql", json=operations)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json[0], {"data": {"__typename": "Query"}})
+        self.assertIn("errors", response.json[1])
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates an in-memory database with sensors sen1 and sen2 measuring test_measurement
+        every minute
+        """
+        reset_database()
+        database = get_database()
+        now = datetime.datetime(2022, 5, 1)
+        audit = {"d_created_date_utc": now, "d_updated_date_utc": now}
+        with database.engine.begin() as conn:
+            conn.execute(database.locations.insert(), [
+                {"location_id": "loc1", "location_name": "test_location", **audit},
+            ])
+            conn.execute(database.sensors.insert(), [
+                {"sensor_id": sensor_id, "sensor_name": f"test_{sensor_id}",
+                 "location_id": "loc1", "pubkey": "", "is_active": "Y", **audit}
+                for sensor_id in ["sen1", "sen2"]
+            ])
+            conn.execute(database.measurement_types.insert(), [
+                {"measurement_name": "test_measurement", "unit": "count",
+                 "string_format": "{}", **audit},
+            ])
+            conn.execute(database.sensor_measurements.insert(), [
+                {"sensor_id": sensor_id, "measurement_name": "test_measurement",
+                 "is_date": "N", **audit}
+                for sensor_id in ["sen1", "sen2"]
+            ])
+            database.insert_measurements(conn, [
+                {"series_id": database.series_cache.series_id(
+                    conn, sensor_id, "test_measurement", "loc1",
+                 ),
+                 "measurement_datetime": now + datetime.timedelta(minutes=i),
+                 "measurement_value": i + 0.5}
+                for i in range(25)
+                for sensor_id in ["sen1", "sen2"]
+            ])
+
+        self.client = create_app().test_client()
+        chunk_size = config.ConfigurationSet(config.config_from_dict({"stream_chunk_size": 7}))
+        with mock.patch.object(streaming, "get_server_config", return_value=chunk_size):
+            response = self.client.get("/measurements", query_string={
+                "measurement": "test_measurement",
+                "start_time": "2022-05-01T00:00:00",
+                "end_time": "2022-05-01T00:15:00",
+            })
+            self.chunks = list(response.response)
+        self.response = response
+
+    def tearDown(self) -> None:
+        reset_database()
+
+    def test_graphql_result(self):
+        """
+        Test streamed measurements
+
+        Expect:
+        - same document as the measurements GraphQL query with all fields
+        - one chunk per 7 measurements
+        """
+        query = """{
+            measurements(
+                measurements: ["test_measurement"],
+                startTime: "2022-05-01T00:00:00",
+                endTime: "2022-05-01T00:15:00",
+            ) {
+                sensor { id name location { id name } measurements { name unit defaultFormat } }
+                measurement { name unit defaultFormat }
+                date
+                value
+            }
+        }"""
+        expected = self.client.post("/graphql", json={"query": query}).json
+
+        self.assertEqual(self.response.status_code, 200)
+        self.assertEqual(self.response.content_type, "application/json")
+        self.assertEqual(json.loads(b"".join(self.chunks)), expected)
+        self.assertEqual(len(expected["data"]["measurements"]), 32)
+        self.assertEqual(len(self.chunks), 2 + 5)
+
+    def test_invalid(self):
+        """
+        Test invalid parameters
+
+        Expect:
+        - a 400 error
+        """
+        response = self.client.get("/measurements", query_string={
+            "measurement": "test_measurement",
+            "start_time": "NOW",
+            "end_time": "-1d",
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("errors", response.json)
+
+
+
+class TestPreforkServer(unittest.TestCase):
+    def setUp(self) -> None:
+        """
+        Creates a server with a fake clock, whose workers exit as soon as reaped
+        """
+        self.now = 100.0
+        self.server = PreforkServer(create_app, host="localhost", port=0, workers=1,
+                                    restart_delay=1, max_restart_delay=4)
+        patches = [
+            mock.patch("time.monotonic", side_effect=lambda: self.now),
+            mock.patch("os.waitpid", side_effect=lambda pid, options: (pid, 256)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def crash(self) -> float:
+        """Starts a worker that exits, returns the delay before the next spawn"""
+        self.server._children[1] = self.now
+        with self.assertLogs(level="ERROR"):
+            self.server._reap()
+        return self.server._spawn_after - self.now
+
+    def test_setup_before_fork(self):
+        """
+        Test starting the server
+
+        Expect:
+        - database set up once by the parent, before forking workers
+        """
+        main = importlib.import_module("src.rain_server.main")
+        calls = []
+        with mock.patch("src.rain_server.configuration.get_database",
+                        side_effect=lambda: calls.append("setup")), \
+                mock.patch.object(PreforkServer, "run", lambda server: calls.append("run")):
+            main.main("--port", "0")
+        self.assertEqual(calls, ["setup", "run"])
+
+    def test_restart_backoff(self):
+        """
+        Test workers exiting on start
+
+        Expect:
+        - replacement delayed, doubling up to max_restart_delay
+        - no spawn before the delay
+        - delay reset after a worker ran longer than max_restart_delay
+        """
+        self.assertEqual([self.crash() for _ in range(4)], [1, 2, 4, 4])
+        self.assertFalse(self.server._can_spawn())
+        self.now += 4
+        self.assertTrue(self.server._can_spawn())
+
+        self.server._children[1] = self.now
+        self.now += 5
+        with self.assertLogs(level="ERROR"):
+            self.server._reap()
+        self.assertEqual(self.server._spawn_after - self.now, 1)
+
+if __name__ == '__main__':
+    unittest.main()